@@ -8,6 +8,7 @@ import socket
 import struct
 import time
 import threading
+from mqtt_protocol import MQTTFrameDecoder, build_packet
 
 class SimpleMQTTClient:
     def __init__(self, broker_host='localhost', broker_port=1883, client_id='test_client'):
@@ -16,6 +17,7 @@ class SimpleMQTTClient:
         self.client_id = client_id
         self.socket = None
         self.connected = False
+        self.decoder = MQTTFrameDecoder()
         self.onReciveMessage = lambda topic, message: None  
     def connect(self):
         """Kết nối đến MQTT Broker"""
@@ -29,16 +31,27 @@ class SimpleMQTTClient:
 
             self.socket.send(connect_packet)
 
-            # Đợi CONNACK
-            response = self.socket.recv(1024)
-            print(f"📨 Nhận CONNACK: {response.hex()}")
+            # Đợi CONNACK - đọc tới khi có ít nhất 1 packet hoàn chỉnh
+            self.decoder.reset()
+            frames = []
+            while not frames:
+                data = self.socket.recv(1024)
+                if not data:
+                    print("❌ Broker đóng kết nối trước khi gửi CONNACK")
+                    return False
+                frames = self.decoder.feed(data)
+            first_byte, body = frames[0]
+            print(f"📨 Nhận CONNACK: {first_byte:02x} {body.hex()}")
 
-            if len(response) >= 4 and response[0] == 0x20:  # CONNACK
-                return_code = response[3]
+            if first_byte == 0x20 and len(body) >= 2:  # CONNACK
+                return_code = body[1]
                 if return_code == 0:
                     self.connected = True
                     print("✅ Kết nối thành công!")
 
+                    # Các packet đến cùng lần recv với CONNACK
+                    for first_byte, body in frames[1:]:
+                        self.handle_received_packet(first_byte, body)
                     # Start receiving thread
                     receive_thread = threading.Thread(target=self.receive_loop, daemon=True)
                     receive_thread.start()
@@ -77,14 +90,9 @@ class SimpleMQTTClient:
         variable_header = protocol_name + protocol_version + connect_flags + keep_alive
         payload = client_id_length + client_id_bytes
 
-        # Calculate remaining length
-        remaining_length = len(variable_header) + len(payload)
-
         # Fixed header
         packet_type = 0x10  # CONNECT
-        fixed_header = bytes([packet_type, remaining_length])
-
-        return fixed_header + variable_header + payload
+        return build_packet(packet_type, variable_header + payload)
 
     def subscribe(self, topic):
         """Subscribe đến một topic"""
@@ -118,13 +126,9 @@ class SimpleMQTTClient:
         variable_header = packet_id
         payload = topic_length + topic_bytes + qos
 
-        remaining_length = len(variable_header) + len(payload)
-
         # Fixed header
         packet_type = 0x82  # SUBSCRIBE with QoS 1
-        fixed_header = bytes([packet_type, remaining_length])
-
-        return fixed_header + variable_header + payload
+        return build_packet(packet_type, variable_header + payload)
 
     def publish(self, topic, message):
         """Publish message đến topic"""
@@ -158,49 +162,40 @@ class SimpleMQTTClient:
         variable_header = topic_length + topic_bytes
         payload = message_bytes
 
-        remaining_length = len(variable_header) + len(payload)
-
         # Fixed header
         packet_type = 0x30  # PUBLISH
-        fixed_header = bytes([packet_type, remaining_length])
-
-        return fixed_header + variable_header + payload
+        return build_packet(packet_type, variable_header + payload)
 
     def receive_loop(self):
         """Vòng lặp nhận tin nhắn"""
         while self.connected:
             try:
-                data = self.socket.recv(1024)
+                data = self.socket.recv(4096)
                 if not data:
                     break
 
-                self.handle_received_packet(data)
+                for first_byte, body in self.decoder.feed(data):
+                    self.handle_received_packet(first_byte, body)
 
             except Exception as e:
                 if self.connected:
                     print(f"❌ Lỗi nhận tin: {e}")
                 break
 
-    def handle_received_packet(self, data):
-        """Xử lý packet nhận được"""
-        if len(data) < 2:
-            return
-
-        packet_type = (data[0] >> 4) & 0x0F
+    def handle_received_packet(self, first_byte, body):
+        """Xử lý packet nhận được (đã tách bởi MQTTFrameDecoder)"""
+        packet_type = (first_byte >> 4) & 0x0F
 
         if packet_type == 3:  # PUBLISH
-            self.handle_publish_packet(data)
+            self.handle_publish_packet(body)
         elif packet_type == 9:  # SUBACK
             print("✅ Nhận SUBACK - Subscribe thành công!")
         elif packet_type == 13:  # PINGRESP
             print("🏓 Nhận PINGRESP")
 
-    def handle_publish_packet(self, data):
-        """Xử lý PUBLISH packet nhận được"""
+    def handle_publish_packet(self, payload):
+        """Xử lý PUBLISH packet nhận được (payload = variable header + message)"""
         try:
-            remaining_length = data[1]
-            payload = data[2:2+remaining_length]
-
             # Parse topic
             if len(payload) < 2:
                 return
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Các hàm mã hóa / giải mã MQTT 3.1.1 dùng chung cho sever_broker.py và client_MQTT_broker.py
+(bản sao của iot-backend/app/mqtt_protocol.py - sửa ở đây thì sửa cả bên đó)
+
+- Remaining Length dạng varint 1-4 byte (tối đa 268 435 455 byte)
+- MQTTFrameDecoder: giải mã luồng TCP theo kiểu incremental. TCP không giữ
+  ranh giới packet: một lần recv() có thể chứa nửa packet hoặc nhiều packet
+  dính nhau, nên mỗi kết nối giữ một decoder riêng.
+"""
+
+import struct
+
+# MQTT Control Packet Types (theo MQTT 3.1.1 specification)
+MQTT_PACKET_TYPES = {
+    1: 'CONNECT',
+    2: 'CONNACK',
+    3: 'PUBLISH',
+    4: 'PUBACK',
+    5: 'PUBREC',
+    6: 'PUBREL',
+    7: 'PUBCOMP',
+    8: 'SUBSCRIBE',
+    9: 'SUBACK',
+    10: 'UNSUBSCRIBE',
+    11: 'UNSUBACK',
+    12: 'PINGREQ',
+    13: 'PINGRESP',
+    14: 'DISCONNECT'
+}
+
+MAX_REMAINING_LENGTH = 268_435_455   # 0xFF 0xFF 0xFF 0x7F
+
+
+class MQTTProtocolError(ValueError):
+    """Packet sai định dạng - broker nên đóng kết nối"""
+
+
+def packet_type_name(first_byte):
+    """Lấy tên packet type từ byte đầu của fixed header"""
+    return MQTT_PACKET_TYPES.get((first_byte >> 4) & 0x0F, 'UNKNOWN')
+
+
+def encode_remaining_length(length):
+    """Mã hóa Remaining Length thành varint 1-4 byte"""
+    if length < 0 or length > MAX_REMAINING_LENGTH:
+        raise MQTTProtocolError(f"Remaining length ngoài giới hạn: {length}")
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length > 0:
+            byte |= 0x80
+        encoded.append(byte)
+        if length == 0:
+            return bytes(encoded)
+
+
+def decode_remaining_length(data, offset=1):
+    """
+    Giải mã Remaining Length bắt đầu tại data[offset]
+
+    Trả về (remaining_length, số byte varint) hoặc (None, 0) nếu chưa đủ dữ liệu
+    """
+    multiplier = 1
+    value = 0
+    for i in range(4):
+        if offset + i >= len(data):
+            return None, 0
+        byte = data[offset + i]
+        value += (byte & 0x7F) * multiplier
+        if not byte & 0x80:
+            return value, i + 1
+        multiplier *= 128
+    raise MQTTProtocolError("Remaining length dài hơn 4 byte")
+
+
+def build_packet(first_byte, body=b''):
+    """Đóng gói fixed header (type + flags + remaining length) với phần thân"""
+    return bytes([first_byte]) + encode_remaining_length(len(body)) + bytes(body)
+
+
+class MQTTFrameDecoder:
+    """
+    Decoder incremental cho một kết nối
+
+    feed(data) nhận bytes vừa recv(), trả về list (first_byte, body) của mọi
+    packet hoàn chỉnh; phần packet dở dang được giữ lại cho lần feed sau.
+    Buffer là một bytearray kèm con trỏ đọc: dữ liệu đã tiêu thụ chỉ bị xóa
+    một lần mỗi feed nên không copy lại buffer cho từng packet.
+    """
+
+    def __init__(self, max_packet_size=MAX_REMAINING_LENGTH):
+        self.max_packet_size = max_packet_size
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        self._buffer += data
+        buffer = self._buffer
+        view = memoryview(buffer)
+        frames = []
+        pos = 0
+        try:
+            while len(buffer) - pos >= 2:
+                remaining_length, length_bytes = decode_remaining_length(buffer, pos + 1)
+                if remaining_length is None:
+                    break
+                if remaining_length > self.max_packet_size:
+                    raise MQTTProtocolError(f"Packet quá lớn: {remaining_length} byte")
+                start = pos + 1 + length_bytes
+                end = start + remaining_length
+                if end > len(buffer):
+                    break
+                frames.append((buffer[pos], bytes(view[start:end])))
+                pos = end
+        finally:
+            view.release()
+        if pos:
+            del buffer[:pos]
+        return frames
+
+    def pending(self):
+        """Số byte của packet dở dang đang chờ"""
+        return len(self._buffer)
+
+    def reset(self):
+        self._buffer.clear()
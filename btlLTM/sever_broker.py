@@ -13,23 +13,10 @@ import struct
 import time
 from typing import Dict, List, Optional
 
-# MQTT Control Packet Types (theo MQTT 3.1.1 specification)
-MQTT_PACKET_TYPES = {
-    1: 'CONNECT',
-    2: 'CONNACK', 
-    3: 'PUBLISH',
-    4: 'PUBACK',
-    5: 'PUBREC',
-    6: 'PUBREL',
-    7: 'PUBCOMP',
-    8: 'SUBSCRIBE',
-    9: 'SUBACK',
-    10: 'UNSUBSCRIBE',
-    11: 'UNSUBACK',
-    12: 'PINGREQ',
-    13: 'PINGRESP',
-    14: 'DISCONNECT'
-}
+from mqtt_protocol import (
+    MQTT_PACKET_TYPES, MQTTFrameDecoder, build_packet,
+    decode_remaining_length, encode_remaining_length, packet_type_name
+)
 
 class SimpleMQTTBroker:
     """
@@ -115,10 +102,12 @@ class SimpleMQTTBroker:
         client_id = None
         print(f"🎯 Bắt đầu xử lý client {address}")
 
+        decoder = MQTTFrameDecoder()   # giu packet do dang giua cac lan recv
         try:
-            while self.running:
+            keep_open = True
+            while self.running and keep_open:
                 # Nhận dữ liệu từ client - đây là socket.recv()
-                data = client_socket.recv(1024)
+                data = client_socket.recv(4096)
                 if not data:
                     print(f"🔌 Client {address} đã ngắt kết nối (empty data)")
                     break
@@ -127,31 +116,32 @@ class SimpleMQTTBroker:
                 print(f"🔍 Raw bytes: {data.hex()}")
                 print(f"💡 Đây chính là MQTT packet được ESP32 gửi!")
 
-                # Parse MQTT packet - Giải mã "ngôn ngữ" MQTT
-                packet_type, payload = self.parse_mqtt_packet(data)
-                print(f"📋 Packet đã parse: {packet_type}")
+                # Một lần recv có thể chứa nửa packet hoặc nhiều packet dính nhau
+                for first_byte, payload in decoder.feed(data):
+                    packet_type = packet_type_name(first_byte)
+                    print(f"📋 Packet đã parse: {packet_type}")
 
-                # Xử lý các loại packet khác nhau
-                if packet_type == 'CONNECT':
-                    client_id = self.handle_connect(client_socket, payload, address)
+                    # Xử lý các loại packet khác nhau
+                    if packet_type == 'CONNECT':
+                        client_id = self.handle_connect(client_socket, payload, address)
 
-                elif packet_type == 'PUBLISH':
-                    print("🎯 *** ĐÂY LÀ PUBLISH - TRÁI TIM PUB/SUB! ***")
-                    self.handle_publish(client_socket, payload)
+                    elif packet_type == 'PUBLISH':
+                        print("🎯 *** ĐÂY LÀ PUBLISH - TRÁI TIM PUB/SUB! ***")
+                        self.handle_publish(client_socket, payload)
 
-                elif packet_type == 'SUBSCRIBE':
-                    print("🎯 *** ĐÂY LÀ SUBSCRIBE - ĐĂNG KÝ NHẬN TIN! ***")
-                    self.handle_subscribe(client_socket, payload, client_id)
+                    elif packet_type == 'SUBSCRIBE':
+                        print("🎯 *** ĐÂY LÀ SUBSCRIBE - ĐĂNG KÝ NHẬN TIN! ***")
+                        self.handle_subscribe(client_socket, payload, client_id)
 
-                elif packet_type == 'PINGREQ':
-                    self.handle_ping(client_socket)
+                    elif packet_type == 'PINGREQ':
+                        self.handle_ping(client_socket)
 
-                elif packet_type == 'DISCONNECT':
-                    self.cleanup_client(client_socket, client_id)
-                    break
+                    elif packet_type == 'DISCONNECT':
+                        keep_open = False
+                        break
 
-                else:
-                    print(f"⚠️ Packet type không được hỗ trợ: {packet_type}")
+                    else:
+                        print(f"⚠️ Packet type không được hỗ trợ: {packet_type}")
 
         except Exception as e:
             print(f"❌ Lỗi khi xử lý client {address}: {e}")
@@ -167,18 +157,20 @@ class SimpleMQTTBroker:
 
         Fixed Header:
         - Byte 1: Packet Type (bits 4-7) + Flags (bits 0-3)  
-        - Byte 2+: Remaining Length
+        - Byte 2+: Remaining Length (varint 1-4 byte)
+
+        Chỉ parse packet đầu tiên trong data - vòng lặp đọc socket dùng MQTTFrameDecoder
         """
         if len(data) < 2:
             return None, None
 
         # Byte đầu tiên chứa packet type
-        first_byte = data[0]
-        packet_type_num = (first_byte >> 4) & 0x0F  # Lấy 4 bits cao
-        packet_type = MQTT_PACKET_TYPES.get(packet_type_num, 'UNKNOWN')
-        # Byte thứ 2 là remaining length (simplified - thực tế phức tạp hơn)
-        remaining_length = data[1] if len(data) > 1 else 0
-        payload = data[2:2+remaining_length] if len(data) > 2 else b''
+        packet_type = packet_type_name(data[0])
+        remaining_length, length_bytes = decode_remaining_length(data, 1)
+        if remaining_length is None:
+            return None, None
+        start = 1 + length_bytes
+        payload = data[start:start+remaining_length]
         return packet_type, payload
 
     def handle_connect(self, client_socket, payload, address):
@@ -363,7 +355,7 @@ class SimpleMQTTBroker:
             if subscribed_topics:
                 # Simplified SUBACK packet
                 suback_payload = bytes([payload[0], payload[1]]) + b'\x00' * len(subscribed_topics)
-                suback = bytes([0x90, len(suback_payload)]) + suback_payload
+                suback = build_packet(0x90, suback_payload)
                 client_socket.send(suback)
                 print(f"📤 Đã gửi SUBACK cho {client_id}")
 
@@ -403,7 +395,7 @@ class SimpleMQTTBroker:
 
         packet = bytearray()
         packet.append(0x30)  # PUBLISH packet type (0011 0000)
-        packet.append(remaining_length)  # Remaining length (simplified)
+        packet.extend(encode_remaining_length(remaining_length))  # Remaining length (varint 1-4 byte)
 
         # Variable Header: Topic length + topic
         packet.extend(struct.pack(">H", len(topic_bytes)))  # Topic length (2 bytes big-endian)
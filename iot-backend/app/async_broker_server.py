@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+MQTT Broker chạy trên asyncio - engine thay thế cho SimpleMQTTBroker
+
+SimpleMQTTBroker tạo 1 thread cho mỗi ESP32 và thread đó block ở recv(1024).
+Với vài nghìn thiết bị thì stack của thread + GIL contention hết trước CPU.
+Engine này dùng asyncio streams: 1 event loop giữ toàn bộ kết nối, kết nối
+idle không tốn thread nào -> giữ được 10k+ kết nối trong một process
+(nhớ tăng `ulimit -n` của hệ điều hành).
+
+Logic CONNECT/PUBLISH/SUBSCRIBE/PINGREQ và các hook handle_connected /
+handle_disconect được kế thừa nguyên vẹn từ SimpleMQTTBroker.
+"""
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from app.broker_server import TAG, SimpleMQTTBroker
+from app.mqtt_protocol import MQTTFrameDecoder, MQTTProtocolError, packet_type_name
+from app.broker_connection import DEFAULT_QUEUE_SIZE, OVERFLOW_DROP_OLDEST, OutboundQueue, QueueOverflow
+
+# packet co hook block (xac thuc CONNECT tra database) -> thread pool; con lai xu ly ngay tren event loop
+OFFLOAD_PACKETS = frozenset({'CONNECT'})
+
+
+class AsyncClientConnection:
+    """
+    Bọc asyncio StreamWriter để có API giống socket (.send / .close)
+
+    Nhờ vậy các handler của SimpleMQTTBroker và MQTTService (vốn gọi
+    client_socket.send(...)) chạy được mà không cần sửa.
+    send() chỉ đưa packet vào OutboundQueue (an toàn khi gọi từ thread khác);
+    coroutine writer riêng của kết nối rút hàng đợi và chờ drain() của transport,
+    nên client chậm chỉ làm đầy hàng đợi của chính nó.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter, loop: asyncio.AbstractEventLoop,
+                 max_queue=DEFAULT_QUEUE_SIZE, overflow_policy=OVERFLOW_DROP_OLDEST):
+        self.writer = writer
+        self.loop = loop
+        self.address = writer.get_extra_info('peername')
+        self.closed = False
+        self._wakeup = asyncio.Event()
+        self.queue = OutboundQueue(max_queue, overflow_policy, on_ready=self._notify_writer)
+        self._writer_task = loop.create_task(self._writer_loop())
+
+    def _on_loop_thread(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def _notify_writer(self):
+        if self._on_loop_thread():
+            self._wakeup.set()
+        elif not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _writer_loop(self):
+        try:
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while True:
+                    data = self.queue.get_nowait()
+                    if data is None:
+                        break
+                    self.writer.write(data)
+                    self.queue.mark_sent(data)
+                    await self.writer.drain()
+                if self.queue.closed:
+                    break
+        except (ConnectionError, OSError) as e:
+            if not self.closed:
+                print(TAG + f"❌ Lỗi gửi tới {self.address}: {e}")
+                self.abort()
+        finally:
+            self.writer.close()
+
+    def send(self, data):
+        if self.closed:
+            raise ConnectionError("connection da dong")
+        try:
+            self.queue.put(data)
+        except QueueOverflow:
+            print(TAG + f"⚠️ Client {self.address} quá chậm, hàng đợi đầy -> ngắt kết nối")
+            self.abort()
+            raise
+        return len(data)
+
+    def close(self):
+        """Đóng sau khi writer gửi nốt các packet đang chờ"""
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.close()
+
+    def abort(self):
+        """Đóng ngay, bỏ các packet đang chờ"""
+        self.closed = True
+        self.queue.close()
+        if self._on_loop_thread():
+            self.writer.transport.abort()
+        elif not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.writer.transport.abort)
+
+    def stats(self):
+        return self.queue.stats()
+
+    def __repr__(self):
+        return f"<AsyncClientConnection {self.address}>"
+
+
+class AsyncMQTTBroker(SimpleMQTTBroker):
+    """
+    MQTT Broker dùng asyncio event loop thay vì 1 thread / 1 socket
+
+    - start() chạy event loop trong thread gọi nó (MQTTService chạy trong thread riêng)
+    - offload_handlers=True: packet có hook gọi database đồng bộ (OFFLOAD_PACKETS) và
+      cleanup_client (hook handle_disconect) chạy trong thread pool giới hạn handler_workers;
+      PINGREQ / SUBSCRIBE / PUBLISH... xử lý ngay trên event loop, không chiếm thread.
+      Packet của cùng một client vẫn được xử lý tuần tự.
+    """
+
+    def __init__(self, host='localhost', port=1883, max_queue=DEFAULT_QUEUE_SIZE, overflow_policy=OVERFLOW_DROP_OLDEST,
+                 backlog=1024, handler_workers=16, offload_handlers=True, **qos_options):
+        super().__init__(host, port, max_queue, overflow_policy, **qos_options)
+        self.backlog = backlog
+        self.handler_workers = handler_workers
+        self.offload_handlers = offload_handlers
+        self.loop = None
+        self.server = None
+        self.executor = None
+        self._stop_event = None
+        self._started = threading.Event()
+        self._client_tasks = {}              # {task: client_socket} - coroutine cua tung client dang mo
+
+    def start(self):
+        """Khởi động MQTT Broker (block cho tới khi stop())"""
+        try:
+            asyncio.run(self._serve())
+        except Exception as e:
+            print(TAG + f"❌ Lỗi khởi động async server: {e}")
+        finally:
+            self.running = False
+            self._started.set()
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        self.executor = ThreadPoolExecutor(max_workers=self.handler_workers, thread_name_prefix="mqtt-handler")
+        try:
+            self.server = await asyncio.start_server(
+                self.handle_client_async,
+                self.host,
+                self.port,
+                backlog=self.backlog,
+                reuse_address=True
+            )
+            self.running = True
+            self.start_background()
+            self._started.set()
+            print(f"\n✅ MQTT Broker (asyncio) đã khởi động tại {self.host}:{self.port}")
+            async with self.server:
+                await self._stop_event.wait()
+                await self._close_all_clients()
+        finally:
+            self.running = False
+            self.stop_background()
+            self.executor.shutdown(wait=False)
+
+    async def _close_all_clients(self, timeout=2.0):
+        """Đóng mọi kết nối để coroutine client tự kết thúc trước khi loop dừng"""
+        tasks = list(self._client_tasks)
+        for task, client_socket in list(self._client_tasks.items()):
+            client_socket.abort()
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+
+    def wait_started(self, timeout=None):
+        """Đợi tới khi server bind xong port (dùng khi start() chạy trong thread khác)"""
+        return self._started.wait(timeout)
+
+    def stop(self):
+        """Dừng broker - gọi được từ bất kỳ thread nào"""
+        self.running = False
+        self.timer_wheel.stop()
+        if self.loop and self._stop_event and not self.loop.is_closed():
+            try:
+                self.loop.call_soon_threadsafe(self._stop_event.set)
+            except RuntimeError:
+                pass  # loop da dong
+
+    async def _run_handler(self, func, *args):
+        if self.offload_handlers:
+            return await self.loop.run_in_executor(self.executor, func, *args)
+        return func(*args)
+
+    async def handle_client_async(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Coroutine xử lý một client - tương đương handle_client của engine thread
+        nhưng chỉ tốn một coroutine (vài KB) thay vì một thread
+        """
+        client_socket = AsyncClientConnection(writer, self.loop, self.max_queue, self.overflow_policy)
+        address = client_socket.address
+        client_id = None
+        decoder = MQTTFrameDecoder(self.max_packet_size)
+        task = asyncio.current_task()
+        self._client_tasks[task] = client_socket
+        print(TAG + f"\n🌟 Kết nối mới từ: {address}")
+
+        cancelled = False
+        try:
+            keep_open = True
+            while self.running and keep_open:
+                data = await reader.read(4096)
+                if not data:
+                    print(f"🔌 Client {address} đã ngắt kết nối (empty data)")
+                    break
+                for first_byte, payload in decoder.feed(data):
+                    packet_type = packet_type_name(first_byte)
+                    if packet_type in OFFLOAD_PACKETS:
+                        client_id, keep_open = await self._run_handler(
+                            self.process_packet, client_socket, address, client_id,
+                            packet_type, payload, first_byte & 0x0F
+                        )
+                    else:
+                        client_id, keep_open = self.process_packet(
+                            client_socket, address, client_id, packet_type, payload, first_byte & 0x0F
+                        )
+                    if not keep_open:
+                        break
+
+        except asyncio.CancelledError:
+            # broker dang dung - _close_all_clients huy tat ca coroutine client
+            cancelled = True
+        except MQTTProtocolError as e:
+            self.protocol_error(address, e)
+        except ConnectionError as e:
+            print(TAG + f"🔌 Kết nối {address} bị đóng: {e}")
+        except Exception as e:
+            print(TAG + f"❌ Lỗi khi xử lý client {address}: {e}")
+        finally:
+            self._client_tasks.pop(task, None)
+            if cancelled or not self.running:
+                self.cleanup_client(client_socket, client_id)
+            else:
+                await self._run_handler(self.cleanup_client, client_socket, client_id)
+
+def main():
+    broker = AsyncMQTTBroker()
+    try:
+        print("\n⏹️  Nhấn Ctrl+C để dừng broker")
+        broker.start()
+    except KeyboardInterrupt:
+        print("\n\n🛑 Đang dừng broker...")
+        broker.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Hàng đợi gửi (outbound queue) cho từng kết nối của broker
+
+Trước đây handle_publish gọi subscriber_socket.send() trực tiếp trong thread của
+client publish -> một ESP32 Wi-Fi yếu làm nghẽn luôn thiết bị đang publish.
+Giờ mỗi kết nối có một hàng đợi giới hạn và một writer riêng rút hàng đợi:
+send() chỉ đưa packet vào hàng đợi rồi trả về ngay.
+
+Khi hàng đợi đầy, áp dụng overflow policy:
+- drop_oldest: bỏ packet cũ nhất (mặc định - dữ liệu sensor mới quan trọng hơn)
+- drop_newest: bỏ packet vừa tới
+- disconnect: ngắt kết nối client quá chậm
+"""
+
+import socket
+import threading
+from collections import deque
+
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+OVERFLOW_DROP_NEWEST = "drop_newest"
+OVERFLOW_DISCONNECT = "disconnect"
+OVERFLOW_POLICIES = (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_DISCONNECT)
+
+DEFAULT_QUEUE_SIZE = 1000
+
+
+class QueueOverflow(ConnectionError):
+    """Hàng đợi đầy với policy disconnect"""
+
+
+class OutboundQueue:
+    """
+    Hàng đợi giới hạn, thread-safe, kèm bộ đếm
+
+    on_ready: callback gọi khi hàng đợi chuyển từ rỗng sang có dữ liệu
+    (writer asyncio dùng để tự đánh thức)
+    """
+
+    def __init__(self, max_size=DEFAULT_QUEUE_SIZE, overflow_policy=OVERFLOW_DROP_OLDEST, on_ready=None):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Overflow policy không hợp lệ: {overflow_policy} (chọn {list(OVERFLOW_POLICIES)})")
+        self.max_size = max_size
+        self.overflow_policy = overflow_policy
+        self.on_ready = on_ready
+        self._items = deque()
+        self._cond = threading.Condition()
+        self.closed = False
+        # bo dem
+        self.enqueued = 0
+        self.sent_packets = 0
+        self.sent_bytes = 0
+        self.dropped = 0
+        self.high_water = 0
+
+    def put(self, data):
+        """Đưa packet vào hàng đợi. Trả về False nếu packet bị bỏ; raise QueueOverflow với policy disconnect"""
+        with self._cond:
+            if self.closed:
+                raise ConnectionError("hang doi da dong")
+            if len(self._items) >= self.max_size:
+                if self.overflow_policy == OVERFLOW_DROP_NEWEST:
+                    self.dropped += 1
+                    return False
+                if self.overflow_policy == OVERFLOW_DISCONNECT:
+                    self.dropped += 1
+                    raise QueueOverflow(f"hang doi day ({self.max_size} packet)")
+                self._items.popleft()
+                self.dropped += 1
+            was_empty = not self._items
+            self._items.append(data)
+            self.enqueued += 1
+            if len(self._items) > self.high_water:
+                self.high_water = len(self._items)
+            self._cond.notify()
+        if was_empty and self.on_ready:
+            self.on_ready()
+        return True
+
+    def get(self, timeout=None):
+        """Lấy packet tiếp theo (block). Trả về None khi hàng đợi đã đóng và rỗng"""
+        with self._cond:
+            while not self._items:
+                if self.closed:
+                    return None
+                if not self._cond.wait(timeout):
+                    return None
+            return self._items.popleft()
+
+    def get_nowait(self):
+        with self._cond:
+            return self._items.popleft() if self._items else None
+
+    def mark_sent(self, data):
+        self.sent_packets += 1
+        self.sent_bytes += len(data)
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+        if self.on_ready:
+            self.on_ready()
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        return {
+            "queued": len(self._items),
+            "max_queue": self.max_size,
+            "high_water": self.high_water,
+            "overflow_policy": self.overflow_policy,
+            "enqueued": self.enqueued,
+            "sent_packets": self.sent_packets,
+            "sent_bytes": self.sent_bytes,
+            "dropped": self.dropped,
+        }
+
+
+class ThreadedClientConnection:
+    """
+    Bọc socket của engine thread: recv() đọc trực tiếp, send() đưa vào OutboundQueue
+    và một writer thread riêng gọi sendall()
+    """
+
+    def __init__(self, sock, address, max_queue=DEFAULT_QUEUE_SIZE, overflow_policy=OVERFLOW_DROP_OLDEST):
+        self.sock = sock
+        self.address = address
+        self.queue = OutboundQueue(max_queue, overflow_policy)
+        self.closed = False
+        self._writer = threading.Thread(target=self._writer_loop, daemon=True)
+        self._writer.start()
+
+    def recv(self, bufsize):
+        return self.sock.recv(bufsize)
+
+    def send(self, data):
+        if self.closed:
+            raise ConnectionError("connection da dong")
+        try:
+            self.queue.put(data)
+        except QueueOverflow:
+            print(f"⚠️ Client {self.address} quá chậm, hàng đợi đầy -> ngắt kết nối")
+            self.abort()
+            raise
+        return len(data)
+
+    def _writer_loop(self):
+        try:
+            while True:
+                data = self.queue.get()
+                if data is None:
+                    break
+                self.sock.sendall(data)
+                self.queue.mark_sent(data)
+        except OSError as e:
+            if not self.closed:
+                print(f"❌ Lỗi gửi tới {self.address}: {e}")
+                self.abort()
+        finally:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+
+    def close(self):
+        """Đóng sau khi gửi nốt các packet đang chờ (ví dụ CONNACK lỗi)"""
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.close()
+
+    def abort(self):
+        """Đóng ngay - đánh thức cả thread đang recv() và writer đang sendall()"""
+        self.closed = True
+        # shutdown truoc khi dong hang doi: writer thoat se close() socket, close() khong danh thuc recv()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.queue.close()
+
+    def stats(self):
+        return self.queue.stats()
+
+    def __repr__(self):
+        return f"<ThreadedClientConnection {self.address}>"
@@ -11,28 +11,29 @@ import socket
 import threading
 import struct
 import time
+import uuid
+from collections import OrderedDict
 from typing import Dict, List, Optional
-from app.security import verify_device_token    
-# MQTT Control Packet Types (theo MQTT 3.1.1 specification)
-MQTT_PACKET_TYPES = {
-    1: 'CONNECT',
-    2: 'CONNACK', 
-    3: 'PUBLISH',
-    4: 'PUBACK',
-    5: 'PUBREC',
-    6: 'PUBREL',
-    7: 'PUBCOMP',
-    8: 'SUBSCRIBE',
-    9: 'SUBACK',
-    10: 'UNSUBSCRIBE',
-    11: 'UNSUBACK',
-    12: 'PINGREQ',
-    13: 'PINGRESP',
-    14: 'DISCONNECT'
-}
+from app.topic_tree import TopicTree
+from app.timer_wheel import TimerWheel
+from app.retained_store import RetainedStore
+from app.broker_connection import DEFAULT_QUEUE_SIZE, OVERFLOW_DROP_OLDEST, OVERFLOW_POLICIES, ThreadedClientConnection
+from app.broker_session import (
+    DEFAULT_MAX_INFLIGHT, DEFAULT_MAX_OFFLINE, DEFAULT_MAX_RETRIES, DEFAULT_RETRY_INTERVAL,
+    DEFAULT_SESSION_EXPIRY, ClientSession
+)
+from app.mqtt_protocol import (
+    CONNACK_IDENTIFIER_REJECTED, MQTT_PACKET_TYPES, PUBLISH_RETAIN, MQTTFrameDecoder, MQTTProtocolError, PacketTooLarge,
+    build_connack, build_packet, build_puback, build_publish, decode_remaining_length, parse_connect, ConnectRefused, packet_type_name, parse_packet_id,
+    parse_publish, publish_qos
+)
+
 TAG = "MQTT Broker : "
 TOPIC_CONTRO=  "CT/"
 TOPIC_SENSOR = "SS/"
+MAX_QOS = 1   # QoS cao nhat broker cap (QoS 2 duoc ha xuong QoS 1)
+# packet lon hon -> ngat ket noi (decoder khong buffer toi 256 MB cho 1 client)
+DEFAULT_MAX_PACKET_SIZE = 256 * 1024
 
 class SimpleMQTTBroker:
     """
@@ -40,20 +41,47 @@ class SimpleMQTTBroker:
 
     Đây chính là "bộ não" mà bạn muốn hiểu:
     - TCP Socket Server lắng nghe port 1883
-    - Dictionary lưu subscriptions (topic -> list clients) 
+    - TopicTree (trie) lưu subscriptions (topic filter -> clients), hỗ trợ + và #
     - Logic Pub/Sub: ai subscribe topic nào thì nhận tin nhắn topic đó
     """
-    def __init__(self, host='localhost', port=1883):
+    def __init__(self, host='localhost', port=1883, max_queue=DEFAULT_QUEUE_SIZE, overflow_policy=OVERFLOW_DROP_OLDEST,
+                 max_inflight=DEFAULT_MAX_INFLIGHT, retry_interval=DEFAULT_RETRY_INTERVAL, max_retries=DEFAULT_MAX_RETRIES,
+                 retained_path=None, snapshot_interval=30.0,
+                 session_expiry=DEFAULT_SESSION_EXPIRY, max_offline=DEFAULT_MAX_OFFLINE, max_sessions=10000,
+                 max_packet_size=DEFAULT_MAX_PACKET_SIZE):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Overflow policy không hợp lệ: {overflow_policy} (chọn {list(OVERFLOW_POLICIES)})")
         self.host = host
         self.port = port
+        # moi ket noi co 1 hang doi gui gioi han max_queue packet + writer rieng
+        self.max_queue = max_queue
+        self.overflow_policy = overflow_policy
+        # QoS 1: moi client toi da max_inflight message chua PUBACK, gui lai sau retry_interval giay
+        self.max_inflight = max_inflight
+        self.retry_interval = retry_interval
+        self.max_retries = max_retries
+        self.timer_wheel = TimerWheel()      # 1 thread cho moi timer: gui lai QoS 1, keep alive, het han session
+        self.keep_alive_timeouts = 0         # so client bi ngat vi qua 1.5 x keep alive khong gui gi
+        # retained message: {topic: message cuoi} - retained_path != None thi snapshot ra file moi snapshot_interval giay
+        self.retained = RetainedStore(retained_path)
+        self.snapshot_interval = snapshot_interval
+        # session ben (clean_session=0): giu toi da max_sessions session offline, moi session
+        # toi da max_offline message, het han sau session_expiry giay khong ket noi lai
+        self.session_expiry = session_expiry
+        self.max_offline = max_offline
+        self.max_sessions = max_sessions
+        self.max_packet_size = max_packet_size
+        self.oversized_packets = 0           # so client bi ngat vi packet vuot max_packet_size
+        self._sessions_lock = threading.RLock()
         self.socket = None
         self.running = False
         self.handle_disconect = None
         self.handle_connected = None
         # *** CÁC CẤU TRÚC DỮ LIỆU CHÍNH - TRÁI TIM CỦA BROKER ***
-        self.clients = {}                    # {client_id: socket_object}
-        self.subscriptions = {}              # {topic: [list_of_client_sockets]} <- MAGIC HERE!
-        self.client_subscriptions = {}       # {client_socket: [list_of_topics]}
+        self.clients = {}                    # {client_id: socket_object} - client dang ket noi
+        self.sessions = {}                   # {client_id: ClientSession} - ca session offline (clean_session=0)
+        self.offline_sessions = OrderedDict()  # {client_id: ClientSession} session ben offline, theo thu tu mat ket noi
+        self.subscriptions = TopicTree()     # trie {topic filter: {session: qos}} + reverse index <- MAGIC HERE!
 
     def start(self):
         """Khởi động MQTT Broker Server"""
@@ -67,13 +95,16 @@ class SimpleMQTTBroker:
             self.socket.listen(5)  # Có thể handle 5 pending connections
 
             self.running = True
+            self.start_background()
             print(f"\n✅ MQTT Broker đã khởi động tại {self.host}:{self.port}")
             while self.running:
                 try:
                     # Accept kết nối mới - Khi ESP32 gọi client.connect()
-                    client_socket, address = self.socket.accept()
+                    raw_socket, address = self.socket.accept()
                     print(TAG + f"\n🌟 Kết nối mới từ: {address}")
-                    print(TAG + f"🔌 Socket object: {client_socket}")
+                    print(TAG + f"🔌 Socket object: {raw_socket}")
+                    # Bọc socket: send() chỉ đưa vào hàng đợi, writer thread riêng gửi đi
+                    client_socket = ThreadedClientConnection(raw_socket, address, self.max_queue, self.overflow_policy)
 
                     # Tạo thread để xử lý client này (bỏ qua threading complexity theo yêu cầu)
                     # Nhưng cần thiết để handle multiple clients
@@ -96,48 +127,106 @@ class SimpleMQTTBroker:
     def stop(self):
         """Dừng broker"""
         self.running = False
+        self.stop_background()
         if self.socket:
             self.socket.close()
 
+    def start_background(self):
+        """Nạp snapshot retained và chạy timer wheel (dùng chung cho 2 engine)"""
+        loaded = self.retained.load()
+        if loaded:
+            print(TAG + f"📦 Đã nạp {loaded} retained message từ {self.retained.snapshot_path}")
+        self.timer_wheel.start()
+        if self.retained.snapshot_path:
+            self.timer_wheel.schedule(self.snapshot_interval, self._snapshot_retained)
+
+    def stop_background(self):
+        self.timer_wheel.stop()
+        self.retained.save()
+
+    def _snapshot_retained(self):
+        self.retained.save()
+        if self.running:
+            self.timer_wheel.schedule(self.snapshot_interval, self._snapshot_retained)
+
     def handle_client(self, client_socket, address):
         """
         Xử lý một client cụ thể - Đây là vòng lặp chính của mỗi client
         Mỗi ESP32 sẽ có một thread riêng chạy function này
         """
         client_id = None
+        decoder = MQTTFrameDecoder(self.max_packet_size)   # moi ket noi 1 decoder - giu packet do dang giua cac lan recv
         print(TAG + f"🎯 Bắt đầu xử lý client {address}")
 
         try:
-            while self.running:
+            keep_open = True
+            while self.running and keep_open:
                 # Nhận dữ liệu từ client - đây là socket.recv()
-                data = client_socket.recv(1024)
+                data = client_socket.recv(4096)
                 if not data:
                     print(f"🔌 Client {address} đã ngắt kết nối (empty data)")
                     break
-                # Parse MQTT packet - Giải mã "ngôn ngữ" MQTT
-                packet_type, payload = self.parse_mqtt_packet(data)
-                # Xử lý các loại packet khác nhau
-                if packet_type == 'CONNECT':
-                    client_id = self.handle_connect(client_socket, payload, address)
-                elif packet_type == 'PUBLISH':
-                    print("🎯 *** ĐÂY LÀ PUBLISH - TRÁI TIM PUB/SUB! ***")
-                    self.handle_publish(client_socket, payload)
-                elif packet_type == 'SUBSCRIBE':
-                    print("🎯 *** ĐÂY LÀ SUBSCRIBE - ĐĂNG KÝ NHẬN TIN! ***")
-                    self.handle_subscribe(client_socket, payload, client_id)
-                elif packet_type == 'PINGREQ':
-                    self.handle_ping(client_socket)
-                elif packet_type == 'DISCONNECT':
-                    self.cleanup_client(client_socket, client_id)
-                    break
-                else:
-                    print(TAG + f"⚠️ Packet type không được hỗ trợ: {packet_type} ")
+                # Giải mã mọi packet hoàn chỉnh trong data (có thể 0, 1 hoặc nhiều packet)
+                for first_byte, payload in decoder.feed(data):
+                    packet_type = packet_type_name(first_byte)
+                    client_id, keep_open = self.process_packet(
+                        client_socket, address, client_id, packet_type, payload, first_byte & 0x0F
+                    )
+                    if not keep_open:
+                        break
 
+        except MQTTProtocolError as e:
+            self.protocol_error(address, e)
         except Exception as e:
             print(TAG + f"❌ Lỗi khi xử lý client {address}: {e}")
         finally:
             self.cleanup_client(client_socket, client_id)
 
+    def protocol_error(self, address, error):
+        """Packet sai / quá lớn (MQTTFrameDecoder) -> ngắt kết nối, không xử lý tiếp"""
+        if isinstance(error, PacketTooLarge):
+            self.oversized_packets += 1
+        print(TAG + f"⚠️ {address} vi phạm giao thức: {error} -> ngắt kết nối")
+
+    def process_packet(self, client_socket, address, client_id, packet_type, payload, flags=0):
+        """
+        Xử lý một packet đã parse - dùng chung cho engine thread và engine asyncio
+        flags: 4 bit thấp của fixed header (DUP / QoS / RETAIN của PUBLISH)
+        Trả về (client_id, keep_open): keep_open = False khi client gửi DISCONNECT
+        """
+        # moi packet tu client (ke ca PINGREQ) deu reset dong ho keep alive
+        client_socket.last_activity = time.monotonic()
+        if packet_type == 'CONNECT':
+            client_id = self.handle_connect(client_socket, payload, address)
+            if client_id is None:
+                # CONNACK lỗi đã gửi (hoặc packet hỏng) -> đóng kết nối
+                return client_id, False
+        elif client_id is None:
+            # MQTT 3.1.1: packet dau tien phai la CONNECT thanh cong
+            print(TAG + f"⚠️ {address} gửi {packet_type} khi chưa CONNECT -> ngắt kết nối")
+            return client_id, False
+        elif packet_type == 'PUBLISH':
+            print("🎯 *** ĐÂY LÀ PUBLISH - TRÁI TIM PUB/SUB! ***")
+            self.handle_publish(client_socket, payload, flags)
+        elif packet_type == 'PUBACK':
+            self.handle_puback(client_socket, payload)
+        elif packet_type == 'PUBREL':
+            # QoS 2 duoc ha xuong "at least once": chi can tra PUBCOMP
+            client_socket.send(build_packet(0x70, payload[:2]))
+        elif packet_type == 'SUBSCRIBE':
+            print("🎯 *** ĐÂY LÀ SUBSCRIBE - ĐĂNG KÝ NHẬN TIN! ***")
+            self.handle_subscribe(client_socket, payload, client_id)
+        elif packet_type == 'UNSUBSCRIBE':
+            self.handle_unsubscribe(client_socket, payload, client_id)
+        elif packet_type == 'PINGREQ':
+            self.handle_ping(client_socket)
+        elif packet_type == 'DISCONNECT':
+            # cleanup_client se duoc goi 1 lan duy nhat o finally cua vong lap doc
+            return client_id, False
+        else:
+            print(TAG + f"⚠️ Packet type không được hỗ trợ: {packet_type} ")
+        return client_id, True
+
     def parse_mqtt_packet(self, data):
         """
         Parse MQTT packet - Giải mã 'ngôn ngữ' MQTT
@@ -147,18 +236,20 @@ class SimpleMQTTBroker:
 
         Fixed Header:
         - Byte 1: Packet Type (bits 4-7) + Flags (bits 0-3)  
-        - Byte 2+: Remaining Length
+        - Byte 2+: Remaining Length (varint 1-4 byte)
+
+        Chỉ parse packet đầu tiên trong data - vòng lặp đọc socket dùng MQTTFrameDecoder
         """
         if len(data) < 2:
             return None, None
 
         # Byte đầu tiên chứa packet type
-        first_byte = data[0]
-        packet_type_num = (first_byte >> 4) & 0x0F  # Lấy 4 bits cao
-        packet_type = MQTT_PACKET_TYPES.get(packet_type_num, 'UNKNOWN')
-        # Byte thứ 2 là remaining length (simplified - thực tế phức tạp hơn)
-        remaining_length = data[1] if len(data) > 1 else 0
-        payload = data[2:2+remaining_length] if len(data) > 2 else b''
+        packet_type = packet_type_name(data[0])
+        remaining_length, length_bytes = decode_remaining_length(data, 1)
+        if remaining_length is None:
+            return None, None
+        start = 1 + length_bytes
+        payload = data[start:start+remaining_length]
         return packet_type, payload
 
     def handle_connect(self, client_socket, payload, address): # loi iiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiiii
@@ -166,23 +257,21 @@ class SimpleMQTTBroker:
         Xử lý MQTT CONNECT - Client "xin chào" broker
         """
         try:
-            # Parse client ID từ payload (simplified parsing)   
-            # Thực tế MQTT CONNECT packet phức tạp hơn nhiều
-            client_id = payload[10:10+len(payload)].decode('utf-8') # Đơn giản hóa
+            # Parse đầy đủ CONNECT (client id, will, username / password...)
+            connect = self.decode_connect(client_socket, payload)
+            if connect is None:
+                return None
+            client_id = connect.client_id
 
             # data_device = verify_device_token(client_id)
             data_device = "78"
             if(data_device is None): 
-                connack = bytes([0x20, 0x02, 0x00, 0x02])  # CONNACK với return code 2 tức là client id không hợp lệ 
+                connack = build_connack(CONNACK_IDENTIFIER_REJECTED)  # CONNACK với return code 2 tức là client id không hợp lệ 
                 client_socket.send(connack)
                 return None
             else:
-            # *** LƯU CLIENT VÀO 'BỘ NHỚ' BROKER ***
-                self.clients[client_id] = client_socket
-                self.client_subscriptions[client_socket] = []
-                # Gửi CONNACK - "Chào lại, kết nối thành công!"
-                connack = bytes([0x20, 0x02, 0x00, 0x00])  # CONNACK với return code 0
-                client_socket.send(connack)
+            # *** LƯU CLIENT VÀO 'BỘ NHỚ' BROKER *** + gửi CONNACK "Chào lại, kết nối thành công!"
+                self.register_client(client_socket, client_id, connect.clean_session, connect.keep_alive)
                 if self.handle_connected : 
                     self.handle_connected(client_socket , client_id)
                 print(TAG + f"📤 Đã gửi CONNACK cho {client_id}")
@@ -192,7 +281,125 @@ class SimpleMQTTBroker:
             print(TAG + f"❌ Lỗi xử lý CONNECT: {e} --- client_socket : {client_socket} ")
             return None
 
-    def handle_publish(self, client_socket, payload):
+    def decode_connect(self, client_socket, payload):
+        """
+        Parse CONNECT, dùng chung cho handle_connect của broker và MQTTService
+
+        - CONNECT bị từ chối (protocol không hỗ trợ...): gửi CONNACK lỗi, trả về None
+        - client id rỗng + clean session: broker tự cấp id
+        """
+        try:
+            connect = parse_connect(payload)
+        except ConnectRefused as e:
+            print(TAG + f"⚠️ Từ chối CONNECT: {e}")
+            client_socket.send(build_connack(e.return_code))
+            return None
+        if not connect.client_id:
+            connect.client_id = f"auto-{uuid.uuid4().hex[:12]}"
+        client_socket.connect_packet = connect
+        return connect
+
+    def register_client(self, client_socket, client_id, clean_session=True, keep_alive=0):
+        """
+        Gắn kết nối vừa CONNECT thành công vào session của client_id và gửi CONNACK
+
+        - clean_session = 1: bỏ session cũ (nếu có), tạo session mới
+        - clean_session = 0: dùng lại session cũ -> subscription còn nguyên, message
+          in-flight được gửi lại và hàng đợi offline được phát lại sau CONNACK
+        - client_id đang có kết nối khác (ESP32 reconnect trước khi broker phát hiện
+          kết nối cũ chết): kết nối cũ bị ngắt
+        - keep_alive > 0: ngắt client nếu quá 1.5 x keep_alive giây không nhận packet nào
+        Trả về True nếu session cũ được dùng lại (cờ session present của CONNACK)
+        """
+        with self._sessions_lock:
+            old_socket = self.clients.get(client_id)
+            session = self.sessions.get(client_id)
+            if session is not None and clean_session:
+                self._discard_session(session)
+                session = None
+            if session is not None and self.offline_sessions.get(client_id) is session:
+                del self.offline_sessions[client_id]
+            session_present = session is not None
+            if session is None:
+                session = ClientSession(
+                    client_id, None, self.timer_wheel,
+                    max_inflight=self.max_inflight,
+                    retry_interval=self.retry_interval,
+                    max_retries=self.max_retries,
+                    max_offline=self.max_offline
+                )
+                self.sessions[client_id] = session
+            session.clean_session = clean_session
+            client_socket.session = session
+            self.clients[client_id] = client_socket
+
+        if old_socket is not None and old_socket is not client_socket:
+            print(TAG + f"♻️ {client_id} kết nối lại -> đóng kết nối cũ {old_socket}")
+            session.detach(old_socket)
+            old_socket.abort()
+        client_socket.send(build_connack(0x00, session_present))
+        self.start_keep_alive(client_socket, client_id, keep_alive)
+        replayed = session.attach(client_socket)
+        if replayed:
+            print(TAG + f"📬 Đã phát lại {replayed} message offline cho {client_id}")
+        return session_present
+
+    def start_keep_alive(self, client_socket, client_id, keep_alive):
+        """
+        Theo dõi keep alive bằng timer wheel
+
+        Không hủy / đặt lại timer cho mỗi packet: process_packet chỉ ghi last_activity,
+        timer đến hạn thì so với last_activity và hẹn lại phần thời gian còn thiếu.
+        """
+        if not keep_alive:
+            return
+        client_socket.keep_alive_limit = keep_alive * 1.5
+        client_socket.last_activity = time.monotonic()
+        self.timer_wheel.schedule(client_socket.keep_alive_limit, self._check_keep_alive, client_socket, client_id)
+
+    def _check_keep_alive(self, client_socket, client_id):
+        """Callback timer wheel: ESP32 mất nguồn không gửi FIN nên phải tự phát hiện"""
+        if client_socket.closed:
+            return
+        idle = time.monotonic() - client_socket.last_activity
+        remaining = client_socket.keep_alive_limit - idle
+        if remaining > 0:
+            self.timer_wheel.schedule(remaining, self._check_keep_alive, client_socket, client_id)
+            return
+        self.keep_alive_timeouts += 1
+        print(TAG + f"⏰ {client_id} im lặng {idle:.1f}s (> 1.5 x keep alive) -> ngắt kết nối")
+        # abort() đánh thức vòng đọc -> cleanup_client -> hook handle_disconect (MQTTService báo OFFLINE)
+        client_socket.abort()
+
+    def _discard_session(self, session):
+        """Hủy hẳn session: xóa subscription và message đang giữ"""
+        with self._sessions_lock:
+            session.close()
+            self.subscriptions.remove_subscriber(session)
+            if self.sessions.get(session.client_id) is session:
+                del self.sessions[session.client_id]
+            if self.offline_sessions.get(session.client_id) is session:
+                del self.offline_sessions[session.client_id]
+
+    def _expire_session(self, session):
+        """Callback timer wheel: session bền không kết nối lại sau session_expiry giây"""
+        with self._sessions_lock:
+            if session.connection is None and self.sessions.get(session.client_id) is session:
+                print(TAG + f"⌛ Session {session.client_id} hết hạn")
+                self._discard_session(session)
+
+    def _enforce_session_limit(self):
+        """
+        Giữ tối đa max_sessions session offline - bỏ session mất kết nối lâu nhất
+        offline_sessions xếp theo thứ tự mất kết nối nên chỉ cần bỏ từ đầu (O(1) mỗi session)
+        """
+        with self._sessions_lock:
+            while len(self.offline_sessions) > self.max_sessions:
+                client_id, session = self.offline_sessions.popitem(last=False)
+                print(TAG + f"🗑️ Quá {self.max_sessions} session offline -> bỏ session {client_id}")
+                self._discard_session(session)
+
+    def handle_publish(self, client_socket, payload, flags=0):
         """
         *** ĐÂY LÀ TRÁI TIM CỦA PUB/SUB PATTERN! ***
 
@@ -203,51 +410,84 @@ class SimpleMQTTBroker:
 
         Đó chính là toàn bộ bí mật của MQTT!
         """
-        client_id_len = struct.unpack(">H", payload[8:10])[0]
-        if len(payload) >= 10 + client_id_len:
-            client_id = payload[10:10+client_id_len].decode('utf-8')
-        else:
-            client_id = None
         print(TAG + f"📝 PUBLISH RECEIVED:")
         try:
-            # Parse topic name từ MQTT PUBLISH packet
-            if len(payload) < 2:
-                print(TAG + f"❌ Payload quá ngắn ")
-                return
-
-            # 2 bytes đầu là topic length
-            topic_len = struct.unpack(">H", payload[0:2])[0]
-
-            if len(payload) < 2 + topic_len:
-                print(TAG + f"❌ Payload không đủ dài cho topic ")
-                return
-
-            # Extract topic và message
-            topic = payload[2:2+topic_len].decode('utf-8')
-            message = payload[2+topic_len:].decode('utf-8')
+            qos = publish_qos(flags)
+            topic, packet_id, message = parse_publish(payload, flags)
+            if flags & PUBLISH_RETAIN:
+                self.retain_message(topic, message, qos)
             # *** LOGIC PUB/SUB CHÍNH - ĐÂY LÀ MAGIC! ***
-
-            if topic in self.subscriptions:
-                subscribers = self.subscriptions[topic]
-                # Tạo PUBLISH packet để gửi cho subscribers
-                publish_packet = self.create_publish_packet(topic, message)
-                # *** GỬI CHO TẤT CẢ SUBSCRIBERS - ĐÂY LÀ DISTRIBUTION! ***
-                successful_sends = 0
-                for subscriber_socket in subscribers:
-                    try:
-                        subscriber_socket.send(publish_packet)
-                        successful_sends += 1
-                    except Exception as e:
-                        print(f"❌ Không thể gửi đến subscriber: {e}")
-
-                print(TAG + f"🎉 Đã gửi thành công đến {successful_sends}/{len(subscribers)} subscribers")
-
-            else:
-                print(TAG + f"📭 KHÔNG có subscriber nào cho topic '{topic}'")
+            self.route_message(topic, message, min(qos, MAX_QOS))
+            self.acknowledge_publish(client_socket, qos, packet_id)
 
         except Exception as e:
             print(TAG + f"❌ Lỗi xử lý PUBLISH: {e} ")
 
+    def retain_message(self, topic, message, qos=0):
+        """Giữ message cuối của topic cho subscriber đến sau (message rỗng = xóa)"""
+        self.retained.set(topic, message, min(qos, MAX_QOS))
+
+    def send_retained(self, client_socket, topic_filter, granted_qos):
+        """Gửi các retained message khớp filter cho client vừa subscribe (cờ RETAIN = 1)"""
+        session = client_socket.session
+        sent = 0
+        for topic, message, qos in self.retained.match(topic_filter):
+            session.deliver(topic, message, min(qos, granted_qos), retain=True)
+            sent += 1
+        return sent
+
+    def acknowledge_publish(self, client_socket, qos, packet_id):
+        """PUBACK cho QoS 1; QoS 2 trả PUBREC (broker chỉ đảm bảo at least once)"""
+        if qos == 1:
+            client_socket.send(build_puback(packet_id))
+        elif qos == 2:
+            client_socket.send(build_packet(0x50, struct.pack(">H", packet_id)))
+
+    def handle_puback(self, client_socket, payload):
+        """Subscriber xác nhận đã nhận message QoS 1 - giải phóng in-flight window"""
+        session = client_socket.session
+        packet_id = parse_packet_id(payload)
+        if not session.puback(packet_id):
+            print(TAG + f"⚠️ PUBACK cho packet id không có trong window: {packet_id}")
+
+    def route_message(self, topic, message, qos=0):
+        """
+        Gửi message cho mọi client có topic filter khớp topic (kể cả wildcard + / #)
+
+        Dùng chung cho handle_publish, MQTTService và publish từ HTTP API.
+        send() chỉ đưa packet vào hàng đợi của từng subscriber nên thời gian publish
+        không phụ thuộc subscriber chậm nhất.
+        QoS gửi đi = min(QoS của publish, QoS đã cấp cho subscription); QoS 1 đi qua
+        in-flight window của session.
+        Trả về (số packet đã vào hàng đợi, số subscriber khớp)
+        """
+        subscribers = self.subscriptions.match(topic)
+        if not subscribers:
+            print(TAG + f"📭 KHÔNG có subscriber nào cho topic '{topic}'")
+            return 0, 0
+        # Packet QoS 0 tạo 1 lần, dùng chung cho mọi subscriber QoS 0
+        publish_packet = None
+        successful_sends = 0
+        for session, granted_qos in subscribers.items():
+            try:
+                effective_qos = min(qos, granted_qos)
+                if effective_qos == 0 and publish_packet is None:
+                    publish_packet = self.create_publish_packet(topic, message)
+                # client offline (session bền) -> message vào hàng đợi offline của session
+                if session.deliver(topic, message, effective_qos, packet=publish_packet):
+                    successful_sends += 1
+            except Exception as e:
+                print(TAG + f"❌ Không thể gửi đến subscriber: {e}")
+        print(TAG + f"🎉 Đã gửi thành công đến {successful_sends}/{len(subscribers)} subscribers")
+        return successful_sends, len(subscribers)
+
+    def deliver_to_client(self, client_id, topic, message, qos=0):
+        """Gửi thẳng cho 1 client (lệnh CT/ từ HTTP API); client offline thì giữ trong session bền"""
+        session = self.sessions.get(client_id)
+        if session is None:
+            return False
+        return session.deliver(topic, message, min(qos, MAX_QOS))
+
     def handle_subscribe(self, client_socket, payload, client_id):
         """
         *** XỬ LÝ SUBSCRIBE - ĐĂNG KÝ NHẬN TIN! ***
@@ -264,7 +504,8 @@ class SimpleMQTTBroker:
             # Parse SUBSCRIBE packet
             # Skip packet identifier (2 bytes đầu)
             offset = 2
-            subscribed_topics = []
+            return_codes = bytearray()
+            granted = []                      # [(topic filter, qos)] de gui retained sau SUBACK
 
             while offset < len(payload):
                 # Parse topic name
@@ -278,40 +519,55 @@ class SimpleMQTTBroker:
                     break
 
                 topic = payload[offset:offset+topic_len].decode('utf-8')
-                
-                offset += topic_len + 1  # +1 for QoS byte (skip)
-
-
-                # Tạo danh sách subscribers cho topic này nếu chưa có
-                if topic not in self.subscriptions:
-                    self.subscriptions[topic] = []
-
-                # Thêm client socket vào danh sách subscribers
-                if client_socket not in self.subscriptions[topic]:
-                    self.subscriptions[topic].append(client_socket)
-                  
-                else:
-                    print(TAG + f"⚠️ Client đã subscribe topic này rồi ")
-
-                # Lưu subscription cho client này (để cleanup sau)
-                if topic not in self.client_subscriptions[client_socket]:
-                    self.client_subscriptions[client_socket].append(topic)
-
-                subscribed_topics.append(topic)
+                offset += topic_len
+                if offset >= len(payload):
+                    break
+                requested_qos = payload[offset]
+                offset += 1  # +1 for QoS byte
 
-            # Gửi SUBACK - "Đã đăng ký thành công!"
-            if subscribed_topics:
-                # Simplified SUBACK packet
-                suback_payload = bytes([payload[0], payload[1]]) + b'\x00' * len(subscribed_topics)
-                suback = bytes([0x90, len(suback_payload)]) + suback_payload
+                # Thêm client vào trie (trie tự lưu reverse index client -> topics để cleanup sau)
+                try:
+                    if requested_qos > 2:
+                        raise ValueError(f"QoS không hợp lệ: {requested_qos}")
+                    granted_qos = min(requested_qos, MAX_QOS)   # ha cap QoS 2 xuong QoS 1
+                    if not self.subscriptions.subscribe(client_socket.session, topic, granted_qos):
+                        print(TAG + f"⚠️ Client đã subscribe topic này rồi ")
+                    return_codes.append(granted_qos)
+                    granted.append((topic, granted_qos))
+                except ValueError as e:
+                    print(TAG + f"⚠️ {e}")
+                    return_codes.append(0x80)  # 0x80 = subscribe that bai
+
+            # Gửi SUBACK - "Đã đăng ký thành công!" (1 return code cho mỗi topic filter)
+            if return_codes:
+                suback_payload = bytes([payload[0], payload[1]]) + bytes(return_codes)
+                suback = build_packet(0x90, suback_payload)
                 client_socket.send(suback)
 
-            for topic, subscribers in self.subscriptions.items():
-                print(TAG + f"   '{topic}': {len(subscribers)} subscribers ")
+            # Retained message đi sau SUBACK - client biết ngay trạng thái hiện tại
+            for topic, granted_qos in granted:
+                self.send_retained(client_socket, topic, granted_qos)
+
+            print(TAG + f"   {client_id} đã subscribe: {list(self.subscriptions.subscriptions_of(client_socket.session))}")
 
         except Exception as e:
             print(TAG + f"❌ Lỗi xử lý SUBSCRIBE: {e} ")
 
+    def handle_unsubscribe(self, client_socket, payload, client_id):
+        """Xử lý UNSUBSCRIBE - hủy đăng ký các topic filter, trả về UNSUBACK"""
+        try:
+            offset = 2
+            while offset + 2 <= len(payload):
+                topic_len = struct.unpack(">H", payload[offset:offset+2])[0]
+                offset += 2
+                topic = payload[offset:offset+topic_len].decode('utf-8')
+                offset += topic_len
+                self.subscriptions.unsubscribe(client_socket.session, topic)
+            unsuback = build_packet(0xB0, bytes([payload[0], payload[1]]))
+            client_socket.send(unsuback)
+        except Exception as e:
+            print(TAG + f"❌ Lỗi xử lý UNSUBSCRIBE: {e} ")
+
     def handle_ping(self, client_socket):
         """Xử lý MQTT PINGREQ - Heartbeat"""
         print(f"🏓 Nhận PINGREQ, gửi PINGRESP")
@@ -319,65 +575,60 @@ class SimpleMQTTBroker:
         pingresp = bytes([0xD0, 0x00])  # PINGRESP
         client_socket.send(pingresp)
 
+    def get_client_stats(self):
+        """Bộ đếm hàng đợi gửi + session (in-flight QoS 1, hàng đợi offline) của từng client: {client_id: stats}"""
+        result = {}
+        for client_id, client_socket in list(self.clients.items()):
+            if not hasattr(client_socket, "stats"):
+                continue
+            stats = client_socket.stats()
+            session = getattr(client_socket, 'session', None)
+            if session is not None:
+                stats["session"] = session.stats()
+            result[client_id] = stats
+        return result
+
     def getAllTopic(self) : 
-        # tra ve danh sachs subrice 
-        return self.subscriptions.keys()
+        # tra ve danh sach topic filter dang co subscriber
+        return self.subscriptions.filters()
 
     def create_publish_packet(self, topic, message):
         """
-        Tạo MQTT PUBLISH packet để gửi cho subscribers
+        Tạo MQTT PUBLISH packet QoS 0 để gửi cho subscribers
 
         Đây là quá trình 'đóng gói' message theo định dạng MQTT
-        để gửi cho clients đã subscribe
+        [Fixed Header: 0x30 + remaining length][Topic length + topic][Message]
         """
-        topic_bytes = topic.encode('utf-8')
-        message_bytes = message.encode('utf-8')
-
-        # MQTT PUBLISH packet format:
-        # [Fixed Header: packet type + remaining length]
-        # [Variable Header: topic length + topic] 
-        # [Payload: message]
-
-        remaining_length = 2 + len(topic_bytes) + len(message_bytes)
-
-        packet = bytearray()
-        packet.append(0x30)  # PUBLISH packet type (0011 0000)
-        packet.append(remaining_length)  # Remaining length (simplified)
-
-        # Variable Header: Topic length + topic
-        packet.extend(struct.pack(">H", len(topic_bytes)))  # Topic length (2 bytes big-endian)
-        packet.extend(topic_bytes)
-
-        # Payload: Message
-        packet.extend(message_bytes)
-        return bytes(packet)
+        return build_publish(topic, message)
 
     def cleanup_client(self, client_socket, client_id):
         """
         Dọn dẹp khi client ngắt kết nối
-        Xóa client khỏi tất cả cấu trúc dữ liệu
+        - clean_session = 1: xóa client khỏi tất cả cấu trúc dữ liệu
+        - clean_session = 0: giữ session (subscription + hàng đợi offline) tới khi hết hạn
         """
-        if self.handle_disconect:
+        # kết nối cũ bị thay bởi kết nối mới cùng client_id thì không báo OFFLINE / không xóa client
+        is_current = client_id is not None and self.clients.get(client_id) is client_socket
+        if self.handle_disconect and is_current:
             self.handle_disconect(client_socket, client_id)
         try:
-            # Xóa client khỏi clients dictionary
-            if client_id and client_id in self.clients:
-                del self.clients[client_id]
-
-            # Xóa client khỏi tất cả subscriptions
-            topics_to_cleanup = []
-            for topic, subscribers in self.subscriptions.items():
-                if client_socket in subscribers:
-                    subscribers.remove(client_socket)
-                    if not subscribers:  # Nếu không còn subscriber nào
-                        topics_to_cleanup.append(topic)
-
-            # Xóa topics không còn subscribers
-            for topic in topics_to_cleanup:
-                del self.subscriptions[topic]
-            # Xóa client subscriptions
-            if client_socket in self.client_subscriptions:
-                del self.client_subscriptions[client_socket]
+            with self._sessions_lock:
+                # Xóa client khỏi clients dictionary
+                if is_current:
+                    del self.clients[client_id]
+
+                session = getattr(client_socket, 'session', None)
+                if session is not None and session.detach(client_socket):
+                    if session.clean_session:
+                        # Xóa khỏi tất cả subscriptions - chỉ duyệt các topic client này đã subscribe
+                        self._discard_session(session)
+                    else:
+                        session.expiry_timer = self.timer_wheel.schedule(
+                            self.session_expiry, self._expire_session, session
+                        )
+                        self.offline_sessions.pop(session.client_id, None)
+                        self.offline_sessions[session.client_id] = session
+                        self._enforce_session_limit()
 
             # Đóng socket
             try:
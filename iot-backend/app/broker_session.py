@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Trạng thái QoS 1 của từng client trên broker
+
+Broker gửi PUBLISH QoS 1 kèm packet id và giữ message trong "in-flight window"
+cho tới khi client trả PUBACK. Nếu hết retry_interval mà chưa có PUBACK thì
+gửi lại với cờ DUP (tối đa max_retries lần). Window giới hạn max_inflight
+message: khi đầy, message mới xếp vào hàng chờ (pending) và được gửi khi có
+PUBACK giải phóng chỗ - ESP32 không bị dội hàng trăm message chưa ack.
+
+Timer gửi lại nằm trên TimerWheel dùng chung của broker (không tạo thread cho
+mỗi message).
+
+Session gắn với client_id chứ không gắn với socket: client CONNECT với
+clean_session = 0 thì khi mất kết nối session vẫn được giữ (subscription,
+message in-flight, hàng đợi offline giới hạn max_offline) và được phát lại khi
+client kết nối lại. clean_session = 1 thì session bị hủy khi ngắt kết nối.
+"""
+
+import threading
+import time
+from collections import OrderedDict, deque
+from app.mqtt_protocol import PUBLISH_DUP, build_publish
+
+DEFAULT_MAX_INFLIGHT = 20
+DEFAULT_RETRY_INTERVAL = 10.0
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_MAX_PENDING = 1000
+DEFAULT_MAX_OFFLINE = 100
+DEFAULT_SESSION_EXPIRY = 3600.0
+
+
+class InflightMessage:
+    __slots__ = ('packet_id', 'topic', 'packet', 'retries', 'timer')
+
+    def __init__(self, packet_id, topic, packet):
+        self.packet_id = packet_id
+        self.topic = topic
+        self.packet = packet
+        self.retries = 0
+        self.timer = None
+
+
+class ClientSession:
+    """
+    Session của 1 client: in-flight window, cấp phát packet id, hàng đợi offline
+
+    connection: đối tượng có .send() (ThreadedClientConnection / AsyncClientConnection),
+                None khi client đang offline
+    timer_wheel: TimerWheel của broker
+    Session cũng là "subscriber" trong TopicTree của broker.
+    """
+
+    def __init__(self, client_id, connection, timer_wheel, max_inflight=DEFAULT_MAX_INFLIGHT,
+                 retry_interval=DEFAULT_RETRY_INTERVAL, max_retries=DEFAULT_MAX_RETRIES,
+                 max_pending=DEFAULT_MAX_PENDING, clean_session=True, max_offline=DEFAULT_MAX_OFFLINE):
+        self.client_id = client_id
+        self.connection = connection
+        self.clean_session = clean_session
+        self.timer_wheel = timer_wheel
+        self.max_inflight = max_inflight
+        self.retry_interval = retry_interval
+        self.max_retries = max_retries
+        self.inflight = OrderedDict()      # {packet_id: InflightMessage} - theo thứ tự gửi
+        self.pending = deque()             # [(topic, message, retain)] chờ chỗ trong window
+        self.max_pending = max_pending
+        self.offline = deque()             # [(topic, message, qos, retain)] nhan trong luc client mat ket noi
+        self.max_offline = max_offline
+        self.disconnected_at = None
+        self.expiry_timer = None
+        self._next_id = 1
+        self._lock = threading.RLock()
+        self.closed = False
+        # bo dem
+        self.acked = 0
+        self.retransmits = 0
+        self.expired = 0                   # bo sau max_retries lan gui lai
+        self.pending_dropped = 0
+        self.offline_dropped = 0
+
+    def next_packet_id(self):
+        """Packet id 1..65535, bỏ qua id còn đang in-flight"""
+        with self._lock:
+            for _ in range(65535):
+                packet_id = self._next_id
+                self._next_id = packet_id % 65535 + 1
+                if packet_id not in self.inflight:
+                    return packet_id
+            raise RuntimeError("Hết packet id khả dụng")
+
+    def deliver(self, topic, message, qos=0, retain=False, packet=None):
+        """
+        Gửi message cho client với QoS đã tính (min của publish và subscription)
+
+        packet: PUBLISH QoS 0 dựng sẵn (route_message dùng chung cho mọi subscriber)
+        Client offline + session bền -> vào hàng đợi offline (bỏ cũ nhất khi đầy)
+        Trả về True nếu message đã được gửi / xếp hàng
+        """
+        with self._lock:
+            if self.closed:
+                return False
+            if self.connection is None:
+                if self.clean_session:
+                    return False
+                if len(self.offline) >= self.max_offline:
+                    self.offline.popleft()
+                    self.offline_dropped += 1
+                self.offline.append((topic, message, qos, retain))
+                return True
+            if qos >= 1:
+                self.publish(topic, message, retain)
+                return True
+            self.connection.send(packet or build_publish(topic, message, retain=retain))
+            return True
+
+    def publish(self, topic, message, retain=False):
+        """
+        Gửi message QoS 1 - vào window nếu còn chỗ, ngược lại vào hàng chờ
+        Trả về True nếu đã gửi ngay
+        """
+        with self._lock:
+            if self.closed:
+                return False
+            if len(self.inflight) >= self.max_inflight or self.connection is None:
+                if len(self.pending) >= self.max_pending:
+                    self.pending.popleft()
+                    self.pending_dropped += 1
+                self.pending.append((topic, message, retain))
+                return False
+            return self._send_new(topic, message, retain)
+
+    def _send_new(self, topic, message, retain):
+        packet_id = self.next_packet_id()
+        packet = build_publish(topic, message, qos=1, packet_id=packet_id, retain=retain)
+        inflight = InflightMessage(packet_id, topic, packet)
+        self.inflight[packet_id] = inflight
+        inflight.timer = self.timer_wheel.schedule(self.retry_interval, self._retransmit, packet_id)
+        try:
+            self.connection.send(packet)
+        except Exception as e:
+            # giu lai trong window - timer se gui lai hoac het han
+            print(f"❌ Không thể gửi QoS 1 tới {self.client_id}: {e}")
+        return True
+
+    def puback(self, packet_id):
+        """Client xác nhận packet_id - giải phóng window và gửi message đang chờ"""
+        with self._lock:
+            inflight = self.inflight.pop(packet_id, None)
+            if inflight is None:
+                return False
+            if inflight.timer:
+                inflight.timer.cancel()
+            self.acked += 1
+            self._fill_window()
+            return True
+
+    def _fill_window(self):
+        while self.pending and len(self.inflight) < self.max_inflight and not self.closed and self.connection is not None:
+            topic, message, retain = self.pending.popleft()
+            self._send_new(topic, message, retain)
+
+    def _retransmit(self, packet_id):
+        """Callback của timer wheel: gửi lại với cờ DUP hoặc bỏ khi quá max_retries"""
+        with self._lock:
+            inflight = self.inflight.get(packet_id)
+            if inflight is None or self.closed or self.connection is None:
+                return
+            if inflight.retries >= self.max_retries:
+                del self.inflight[packet_id]
+                self.expired += 1
+                print(f"⚠️ {self.client_id} không PUBACK packet {packet_id} sau {self.max_retries} lần gửi lại -> bỏ")
+                self._fill_window()
+                return
+            inflight.retries += 1
+            self.retransmits += 1
+            packet = inflight.packet
+            dup_packet = bytes([packet[0] | PUBLISH_DUP]) + packet[1:]
+            inflight.timer = self.timer_wheel.schedule(self.retry_interval, self._retransmit, packet_id)
+            try:
+                self.connection.send(dup_packet)
+            except Exception as e:
+                print(f"❌ Không thể gửi lại packet {packet_id} tới {self.client_id}: {e}")
+
+    def attach(self, connection):
+        """
+        Client (kết nối lại) gắn vào session: gửi lại message in-flight với cờ DUP,
+        phát lại hàng đợi offline rồi lấp window từ hàng chờ
+        """
+        with self._lock:
+            self.connection = connection
+            self.disconnected_at = None
+            if self.expiry_timer:
+                self.expiry_timer.cancel()
+                self.expiry_timer = None
+            for inflight in self.inflight.values():
+                packet = inflight.packet
+                inflight.timer = self.timer_wheel.schedule(self.retry_interval, self._retransmit, inflight.packet_id)
+                try:
+                    connection.send(bytes([packet[0] | PUBLISH_DUP]) + packet[1:])
+                except Exception as e:
+                    print(f"❌ Không thể gửi lại packet {inflight.packet_id} tới {self.client_id}: {e}")
+            replayed = len(self.offline)
+            while self.offline:
+                topic, message, qos, retain = self.offline.popleft()
+                self.deliver(topic, message, qos, retain)
+            self._fill_window()
+            return replayed
+
+    def detach(self, connection):
+        """
+        Kết nối ngắt: hủy timer, giữ lại in-flight / hàng chờ cho lần kết nối sau
+        Trả về False nếu session đã chuyển sang kết nối khác (client kết nối lại trước khi dọn xong)
+        """
+        with self._lock:
+            if self.connection is not connection:
+                return False
+            self.connection = None
+            self.disconnected_at = time.monotonic()
+            self._cancel_timers()
+            return True
+
+    def _cancel_timers(self):
+        for inflight in self.inflight.values():
+            if inflight.timer:
+                inflight.timer.cancel()
+                inflight.timer = None
+
+    def close(self):
+        """Hủy session (clean session hoặc hết hạn): hủy timer, bỏ mọi message đang giữ"""
+        with self._lock:
+            self.closed = True
+            self.connection = None
+            self._cancel_timers()
+            if self.expiry_timer:
+                self.expiry_timer.cancel()
+            self.inflight.clear()
+            self.pending.clear()
+            self.offline.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "inflight": len(self.inflight),
+                "max_inflight": self.max_inflight,
+                "pending": len(self.pending),
+                "offline": len(self.offline),
+                "clean_session": self.clean_session,
+                "acked": self.acked,
+                "retransmits": self.retransmits,
+                "expired": self.expired,
+                "pending_dropped": self.pending_dropped,
+                "offline_dropped": self.offline_dropped,
+            }
@@ -23,6 +23,13 @@ class Settings(BaseSettings):
     # App Settings
     DEBUG: bool = os.getenv("DEBUG")
     PORT: int = os.getenv("PORT")
+
+    # Luu tru sensor_data cu ra file segment (app/sensor_archive.py)
+    SENSOR_ARCHIVE_DIR: str = os.getenv("SENSOR_ARCHIVE_DIR", "sensor_archive")
+    SENSOR_RETENTION_DAYS: int = os.getenv("SENSOR_RETENTION_DAYS", 30)
+    SENSOR_ARCHIVE_INTERVAL_HOURS: float = os.getenv("SENSOR_ARCHIVE_INTERVAL_HOURS", 24)   # 0 = khong tu chay
+    # Email (phan cach dau phay) cua user duoc goi endpoint quan tri (vd POST /mqtt/archive)
+    ADMIN_EMAILS: str = os.getenv("ADMIN_EMAILS", "")
     
     class Config:
         env_file = ".env"
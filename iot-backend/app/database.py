@@ -1,5 +1,7 @@
 # DB connection
 # app/core/database.py
+import asyncio
+import httpx
 from supabase import create_client, Client
 from app.config import settings
 
@@ -7,35 +9,109 @@ from app.config import settings
 supabase: Client = create_client(settings.SUPABASE_URL, settings.SUPABASE_ANON_KEY)
 supabase_admin: Client = create_client(settings.SUPABASE_URL, settings.SUPABASE_SERVICE_KEY)
 TAG = "DATABASE:-"
+RANGE_OPERATORS = ("gt", "gte", "lt", "lte")
+
+
+def _order_columns(order_by):
+    """"created_at" / "-created_at" / ["-created_at", "-id"] -> [(cột, desc)]"""
+    if not order_by:
+        return []
+    if isinstance(order_by, str):
+        order_by = [order_by]
+    return [(col[1:], True) if col.startswith("-") else (col, False) for col in order_by]
+
+
+def _quote(value):
+    """Giá trị trong biểu thức or=(...) của PostgREST - timestamp có ':' '+' ',' nên luôn đặt trong ngoặc kép"""
+    return '"' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _keyset_filter(order, cursor):
+    """
+    Điều kiện "sau cursor" cho phân trang keyset theo thứ tự order
+    cursor: row cuối của trang trước (hoặc dict chứa các cột của order_by)
+    1 cột -> (op, cột, giá trị); nhiều cột -> biểu thức or=(...) so sánh từng bậc
+    """
+    if not order:
+        raise ValueError("❌ Keyset cursor requires order_by")
+    ops = [(col, "lt" if desc else "gt", cursor[col]) for col, desc in order]
+    if len(ops) == 1:
+        return ops[0][1], ops[0][0], ops[0][2]
+    terms = []
+    for i, (col, op, value) in enumerate(ops):
+        equal = [f"{c}.eq.{_quote(v)}" for c, _, v in ops[:i]]
+        term = f"{col}.{op}.{_quote(value)}"
+        terms.append(f"and({','.join(equal + [term])})" if equal else term)
+    return "or", None, f"({','.join(terms)})"
+
+
+def _apply_filters(query, filters):
+    """eq cho từng cột; giá trị list / tuple -> in (1 query cho nhiều giá trị)"""
+    for key, value in (filters or {}).items():
+        query = query.in_(key, list(value)) if isinstance(value, (list, tuple)) else query.eq(key, value)
+    return query
+
+
 class Database:
     def __init__(self):
         self.client = supabase
         self.admin_client = supabase_admin
     
-    def execute_query(self, table: str, operation: str, data: dict = None, filters: dict = None):
-        """Generic database operation"""
+    def execute_query(self, table: str, operation: str, data: dict = None, filters: dict = None,
+                      columns: str = "*", order_by=None, ranges: dict = None, limit: int = None,
+                      offset: int = None, cursor: dict = None, on_conflict: str = None):
+        """
+        Generic database operation
+
+        insert / upsert nhận list row -> 1 request cho cả lô; upsert ghi đè row trùng on_conflict
+        (vd "device_token,virtual_pin" - cần unique index trên các cột đó)
+        filters: {"cột": giá trị} so sánh bằng, giá trị list -> in (select / update / delete)
+
+        Chỉ áp dụng cho select (đẩy xuống database thay vì lọc / cắt trong Python):
+        columns: "token_verify,value_numeric,created_at" - chỉ lấy cột cần dùng
+        order_by: "created_at" (tăng) / "-created_at" (giảm) / list nhiều cột
+        ranges: {"created_at": {"gte": "2025-01-01", "lt": "2025-02-01"}} - gt / gte / lt / lte
+                (delete cũng nhận ranges, vd xóa sensor_data đã lưu trữ)
+        limit / offset: phân trang; cursor: row cuối trang trước -> phân trang keyset theo order_by
+        """
         try:
             query = self.admin_client.table(table)
             
             if operation == "insert":
                 result = query.insert(data).execute()
+            elif operation == "upsert":
+                result = query.upsert(data, on_conflict=on_conflict or "").execute()
             elif operation == "select":
-                query = query.select("*")
-                if filters:
-                    for key, value in filters.items():
-                        query = query.eq(key, value)
+                query = _apply_filters(query.select(columns), filters)
+                for key, bounds in (ranges or {}).items():
+                    for op, value in bounds.items():
+                        if op not in RANGE_OPERATORS:
+                            raise ValueError(f"❌ Unknown range operator: {op}")
+                        query = getattr(query, op)(key, value)
+                order = _order_columns(order_by)
+                if cursor:
+                    op, key, value = _keyset_filter(order, cursor)
+                    query = query.or_(value[1:-1]) if op == "or" else getattr(query, op)(key, value)
+                for key, desc in order:
+                    query = query.order(key, desc=desc)
+                if limit is not None:
+                    start = offset or 0
+                    query = query.range(start, start + limit - 1)
+                elif offset:
+                    query = query.offset(offset)
                 result = query.execute()
             elif operation == "update":
-                query = query.update(data)
-                if filters:
-                    for key, value in filters.items():
-                        query = query.eq(key, value)
+                query = _apply_filters(query.update(data), filters)
                 result = query.execute()
             elif operation == "delete":
                 query = query.delete()
-                if filters:
-                    for k, v in filters.items():
-                        query = query.eq(k, v)
+                if filters or ranges:
+                    query = _apply_filters(query, filters)
+                    for key, bounds in (ranges or {}).items():
+                        for op, value in bounds.items():
+                            if op not in RANGE_OPERATORS:
+                                raise ValueError(f"❌ Unknown range operator: {op}")
+                            query = getattr(query, op)(key, value)
                 else:
                     # phòng trường hợp gọi xóa mà không truyền filter: chặn lại
                     raise ValueError("❌ Delete requires at least one filter to avoid deleting entire table")
@@ -46,5 +122,145 @@ class Database:
             print(f"❌ Database error: {e}")
             return None
 
+
+class AsyncDatabase:
+    """
+    Data layer bất đồng bộ cho route async def - cùng contract execute_query(table, operation, data, filters)
+
+    Database.execute_query block cả event loop của uvicorn khi gọi trong async def.
+    Lớp này gọi thẳng PostgREST của Supabase bằng 1 httpx.AsyncClient dùng chung:
+    - pool kết nối keep-alive (max_connections / max_keepalive)
+    - semaphore giới hạn số request đồng thời (max_concurrency)
+    - timeout cho mỗi request
+    Thread khác (broker MQTT) dùng submit() để chạy query trên loop của FastAPI.
+    transport: httpx transport thay thế (test dùng httpx.MockTransport)
+    """
+
+    def __init__(self, url: str = None, key: str = None, max_connections: int = 20, max_keepalive: int = 10,
+                 max_concurrency: int = 20, timeout: float = 10.0, transport=None):
+        self.url = url or settings.SUPABASE_URL
+        self.key = key or settings.SUPABASE_SERVICE_KEY
+        self.transport = transport
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.loop = None
+        self._client = None
+        self._semaphore = None
+
+    def attach_loop(self, loop):
+        """Gắn event loop của FastAPI (startup) - client / semaphore thuộc về loop này"""
+        self.loop = loop
+
+    def _get_client(self):
+        if self._client is None:
+            self.loop = self.loop or asyncio.get_running_loop()
+            self._client = httpx.AsyncClient(
+                base_url=f"{self.url.rstrip('/')}/rest/v1",
+                headers={
+                    "apikey": self.key,
+                    "Authorization": f"Bearer {self.key}",
+                    "Prefer": "return=representation",
+                },
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_keepalive),
+                timeout=self.timeout,
+                transport=self.transport,
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._client
+
+    @staticmethod
+    def _eq(value):
+        """Giá trị filter theo cú pháp PostgREST (query.eq / query.in_ của supabase)"""
+        if isinstance(value, (list, tuple)):
+            return "in.(" + ",".join(_quote(item) for item in value) + ")"
+        if value is None:
+            return "is.null"
+        if isinstance(value, bool):
+            return "eq." + ("true" if value else "false")
+        return f"eq.{value}"
+
+    @staticmethod
+    def _range_params(ranges):
+        """ranges {"cột": {"gte": ..., "lt": ...}} -> [(cột, "gte.giá trị")]"""
+        params = []
+        for key, bounds in (ranges or {}).items():
+            for op, value in bounds.items():
+                if op not in RANGE_OPERATORS:
+                    raise ValueError(f"❌ Unknown range operator: {op}")
+                params.append((key, f"{op}.{value}"))
+        return params
+
+    async def execute_query(self, table: str, operation: str, data: dict = None, filters: dict = None,
+                            columns: str = "*", order_by=None, ranges: dict = None, limit: int = None,
+                            offset: int = None, cursor: dict = None, on_conflict: str = None):
+        """Generic database operation (async) - trả về list row, None nếu lỗi. Tham số như Database"""
+        try:
+            client = self._get_client()
+            params = [(key, self._eq(value)) for key, value in (filters or {}).items()]
+            async with self._semaphore:
+                if operation == "insert":
+                    response = await client.post(f"/{table}", json=data)
+                elif operation == "upsert":
+                    response = await client.post(
+                        f"/{table}", json=data, params={"on_conflict": on_conflict} if on_conflict else None,
+                        headers={"Prefer": "resolution=merge-duplicates,return=representation"}
+                    )
+                elif operation == "select":
+                    params.append(("select", columns))
+                    params.extend(self._range_params(ranges))
+                    order = _order_columns(order_by)
+                    if cursor:
+                        op, key, value = _keyset_filter(order, cursor)
+                        params.append(("or", value) if op == "or" else (key, f"{op}.{value}"))
+                    if order:
+                        params.append(("order", ",".join(f"{key}.{'desc' if desc else 'asc'}" for key, desc in order)))
+                    if limit is not None:
+                        params.append(("limit", str(limit)))
+                    if offset:
+                        params.append(("offset", str(offset)))
+                    response = await client.get(f"/{table}", params=params)
+                elif operation == "update":
+                    response = await client.patch(f"/{table}", params=params, json=data)
+                elif operation == "delete":
+                    if not filters and not ranges:
+                        # phòng trường hợp gọi xóa mà không truyền filter: chặn lại
+                        raise ValueError("❌ Delete requires at least one filter to avoid deleting entire table")
+                    params.extend(self._range_params(ranges))
+                    response = await client.delete(f"/{table}", params=params)
+                else:
+                    raise ValueError(f"❌ Unknown operation: {operation}")
+            response.raise_for_status()
+            return response.json() if response.content else []
+
+        except Exception as e:
+            print(TAG + f"❌ Async database error: {e}")
+            return None
+
+    def submit(self, table: str, operation: str, data: dict = None, filters: dict = None, after=None):
+        """
+        Gọi từ thread khác (broker MQTT): chạy query trên loop của FastAPI, không chờ kết quả
+        after: Future của lần submit trước - query này chỉ chạy khi query đó xong (giữ thứ tự ONLINE/OFFLINE)
+        Trả về concurrent.futures.Future, None nếu chưa có loop (gọi Database.execute_query thay thế)
+        """
+        if self.loop is None or self.loop.is_closed() or not self.loop.is_running():
+            return None
+        return asyncio.run_coroutine_threadsafe(
+            self._execute_after(after, table, operation, data, filters), self.loop
+        )
+
+    async def _execute_after(self, after, table, operation, data, filters):
+        if after is not None and not after.done():
+            await asyncio.wait([asyncio.wrap_future(after)])
+        return await self.execute_query(table, operation, data, filters)
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
 # Global database instance
 db = Database()
+async_db = AsyncDatabase()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Hot tier: N reading gần nhất của mỗi (token_verify, virtual_pin) ngay trong bộ nhớ
+
+Dashboard làm mới liên tục chỉ cần vài phút gần nhất - dữ liệu vừa đi qua broker,
+không cần hỏi lại Supabase. Mỗi pin có 1 ring buffer cố định capacity phần tử,
+timestamp và value lưu trong 2 array('d') (float64 liền nhau, không tạo object
+cho mỗi reading). Số pin giới hạn max_series, bỏ pin ít dùng nhất (LRU).
+
+Ring giữ đúng mọi reading từ oldest() tới hiện tại: truy vấn bắt đầu trước oldest()
+phải lấy phần cũ hơn từ database.
+"""
+
+import threading
+from array import array
+from collections import OrderedDict
+
+DEFAULT_HOT_CAPACITY = 1000
+DEFAULT_HOT_SERIES = 10000
+
+
+class SeriesRing:
+    """Ring buffer (timestamp, value) tăng dần theo timestamp"""
+    __slots__ = ('capacity', 'timestamps', 'values', 'start', 'count')
+
+    def __init__(self, capacity=DEFAULT_HOT_CAPACITY):
+        self.capacity = capacity
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.values = array('d', bytes(8 * capacity))
+        self.start = 0
+        self.count = 0
+
+    def append(self, timestamp, value):
+        if self.count and timestamp < self.newest():
+            timestamp = self.newest()                 # giu thu tu tang dan cho tim kiem nhi phan
+        if self.count < self.capacity:
+            index = (self.start + self.count) % self.capacity
+            self.count += 1
+        else:
+            index = self.start                        # day: ghi de phan tu cu nhat
+            self.start = (self.start + 1) % self.capacity
+        self.timestamps[index] = timestamp
+        self.values[index] = value
+
+    def _at(self, i):
+        return self.timestamps[(self.start + i) % self.capacity]
+
+    def _bisect(self, timestamp):
+        """Vị trí logic đầu tiên có timestamp >= timestamp"""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._at(mid) < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def oldest(self):
+        return self._at(0) if self.count else None
+
+    def newest(self):
+        return self._at(self.count - 1) if self.count else None
+
+    def slice(self, first, last):
+        """Các điểm ở vị trí logic [first, last) theo thứ tự thời gian"""
+        points = []
+        for i in range(first, last):
+            index = (self.start + i) % self.capacity
+            points.append((self.timestamps[index], self.values[index]))
+        return points
+
+    def window(self, since=None, until=None):
+        first = self._bisect(since) if since is not None else 0
+        last = self._bisect(until) if until is not None else self.count
+        return self.slice(first, last)
+
+    def latest(self, n):
+        return self.slice(max(0, self.count - n), self.count)
+
+
+class HotSeriesStore:
+    """Ring buffer theo (token_verify, virtual_pin), LRU tối đa max_series pin"""
+
+    def __init__(self, capacity=DEFAULT_HOT_CAPACITY, max_series=DEFAULT_HOT_SERIES):
+        self.capacity = capacity
+        self.max_series = max_series
+        self._series = OrderedDict()       # {(token_verify, virtual_pin): SeriesRing}
+        self._lock = threading.Lock()
+        # bo dem
+        self.appended = 0
+        self.evicted = 0
+        self.hits = 0                      # truy van phuc vu hoan toan tu bo nho
+        self.partial = 0                   # phan cu hon lay tu database
+        self.misses = 0
+
+    def append(self, token_verify, virtual_pin, timestamp, value):
+        key = (token_verify, int(virtual_pin))
+        with self._lock:
+            ring = self._series.get(key)
+            if ring is None:
+                ring = self._series[key] = SeriesRing(self.capacity)
+                if len(self._series) > self.max_series:
+                    self._series.popitem(last=False)
+                    self.evicted += 1
+            else:
+                self._series.move_to_end(key)
+            ring.append(timestamp, value)
+            self.appended += 1
+
+    def latest(self, token_verify, virtual_pin, n):
+        """
+        n điểm mới nhất (cũ -> mới) nếu ring có đủ n điểm, ngược lại None (hỏi database)
+        """
+        with self._lock:
+            ring = self._series.get((token_verify, int(virtual_pin)))
+            if ring is None or ring.count < n:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return ring.latest(n)
+
+    def tail(self, token_verify, virtual_pin, n):
+        """Tối đa n điểm mới nhất (cũ -> mới), không đủ cũng trả về - snapshot cho WebSocket"""
+        with self._lock:
+            ring = self._series.get((token_verify, int(virtual_pin)))
+            return ring.latest(n) if ring is not None else []
+
+    def window(self, token_verify, virtual_pin, since, until=None):
+        """
+        Điểm trong [since, until) có trong ring + mốc covered_from
+        covered_from = None: ring không có gì, cả khoảng phải hỏi database
+        since < covered_from: phần [since, covered_from) phải hỏi database
+        """
+        with self._lock:
+            ring = self._series.get((token_verify, int(virtual_pin)))
+            if ring is None or not ring.count:
+                self.misses += 1
+                return [], None
+            covered_from = ring.oldest()
+            if since >= covered_from:
+                self.hits += 1
+            else:
+                self.partial += 1
+            return ring.window(max(since, covered_from), until), covered_from
+
+    def __len__(self):
+        return len(self._series)
+
+    def stats(self):
+        return {
+            "series": len(self._series),
+            "max_series": self.max_series,
+            "capacity": self.capacity,
+            "appended": self.appended,
+            "evicted": self.evicted,
+            "hits": self.hits,
+            "partial": self.partial,
+            "misses": self.misses,
+        }
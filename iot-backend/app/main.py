@@ -1,7 +1,14 @@
+import asyncio
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.routers import auth, devices, mqtt, websocket
 from app.services.mqtt_service import mqtt_service
+from app.database import async_db
+from app.websockets.mqtt_bridge import mqtt_websocket_bridge
+from app.services.sensor_service import run_archive_schedule
+from app.config import settings
+
+archive_task = None
 
 app = FastAPI(
     title="IoT Backend API",
@@ -57,6 +64,15 @@ async def health_check():
 async def startup_event():
     """Khởi động MQTT Broker khi FastAPI start"""
     print("🚀 Starting IoT Backend with MQTT integration...")
+    # Data layer async dùng loop này (broker MQTT gửi query sang qua async_db.submit)
+    async_db.attach_loop(asyncio.get_running_loop())
+    # Message MQTT (thread broker) -> task fan-out trên loop này -> WebSocket /ws/mqtt
+    mqtt_websocket_bridge.start(asyncio.get_running_loop())
+    # Lưu trữ sensor_data cũ định kỳ (POST /mqtt/archive chỉ dành cho admin)
+    global archive_task
+    interval = float(settings.SENSOR_ARCHIVE_INTERVAL_HOURS or 0)
+    if interval > 0:
+        archive_task = asyncio.get_running_loop().create_task(run_archive_schedule(interval))
     # Không tự động start MQTT broker, để user control qua API
     print("💡 Use /mqtt/start endpoint to start MQTT Broker")
 
@@ -65,6 +81,10 @@ async def shutdown_event():
     """Dừng MQTT Broker khi FastAPI shutdown"""
     print("🛑 Shutting down IoT Backend...")
     mqtt_service.stop_broker()
+    if archive_task is not None:
+        archive_task.cancel()
+    await mqtt_websocket_bridge.stop()
+    await async_db.aclose()
 
 if __name__ == "__main__":
     import uvicorn
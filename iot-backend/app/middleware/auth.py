@@ -4,6 +4,7 @@ from fastapi import HTTPException, status, Request, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from app.security import verify_token, verify_device_token
 from app.database import db
+from app.config import settings
 
 security = HTTPBearer()
 
@@ -55,6 +56,16 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(securit
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Could not validate credentials" + str(e)
         )
+def get_admin_user(current_user: dict = Depends(get_current_user)):
+    """Chỉ user có email trong ADMIN_EMAILS - endpoint quản trị (xóa / lưu trữ dữ liệu của mọi user)"""
+    admins = {email.strip().lower() for email in (settings.ADMIN_EMAILS or "").split(",") if email.strip()}
+    if (current_user.get("email") or "").lower() not in admins:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin privileges required"
+        )
+    return current_user
+
 def get_current_device(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Middleware để get current ESP32 device từ device token"""
     try:
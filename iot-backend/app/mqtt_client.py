@@ -8,15 +8,32 @@ import socket
 import struct
 import time
 import threading
+from app.mqtt_protocol import (
+    MQTTFrameDecoder, build_packet, build_puback, build_publish,
+    parse_packet_id, parse_publish, publish_qos
+)
 
 class SimpleMQTTClient:
-    def __init__(self, broker_host='localhost', broker_port=1883, client_id='test_client'):
+    def __init__(self, broker_host='localhost', broker_port=1883, client_id='test_client', clean_session=True,
+                 keep_alive=60):
         self.broker_host = broker_host
         self.broker_port = broker_port
         self.client_id = client_id
+        self.clean_session = clean_session   # False: broker giu subscription + message offline khi mat ket noi
+        self.session_present = False
+        self.keep_alive = keep_alive         # giay; broker ngat ket noi neu qua 1.5 x keep_alive khong nhan gi
+        self.auto_ping = True                # tu gui PINGREQ moi keep_alive / 2 giay
+        self._stop_ping = threading.Event()
         self.socket = None
         self.connected = False
+        self.decoder = MQTTFrameDecoder()
         self.onReciveMessage = lambda topic, message: None  
+        # QoS 1
+        self._next_packet_id = 1
+        self.pending_acks = {}       # {packet_id: (topic, message)} - publish QoS 1 chua nhan PUBACK
+        self.auto_ack = True         # tu dong PUBACK khi nhan PUBLISH QoS 1
+        self.unacked = {}            # {packet_id: topic} - message QoS 1 da nhan nhung chua ack (auto_ack=False)
+        self.granted_qos = []        # return code cua SUBACK gan nhat
     def connect(self):
         """Kết nối đến MQTT Broker"""
         try:
@@ -29,16 +46,31 @@ class SimpleMQTTClient:
 
             self.socket.send(connect_packet)
 
-            # Đợi CONNACK
-            response = self.socket.recv(1024)
-            print(f"📨 Nhận CONNACK: {response.hex()}")
+            # Đợi CONNACK - đọc tới khi có ít nhất 1 packet hoàn chỉnh
+            self.decoder.reset()
+            frames = []
+            while not frames:
+                data = self.socket.recv(1024)
+                if not data:
+                    print("❌ Broker đóng kết nối trước khi gửi CONNACK")
+                    return False
+                frames = self.decoder.feed(data)
+            first_byte, body = frames[0]
+            print(f"📨 Nhận CONNACK: {first_byte:02x} {body.hex()}")
 
-            if len(response) >= 4 and response[0] == 0x20:  # CONNACK
-                return_code = response[3]
+            if first_byte == 0x20 and len(body) >= 2:  # CONNACK
+                return_code = body[1]
                 if return_code == 0:
                     self.connected = True
+                    self.session_present = bool(body[0] & 0x01)
+                    if self.keep_alive and self.auto_ping:
+                        self._stop_ping.clear()
+                        threading.Thread(target=self._ping_loop, daemon=True).start()
                     print("✅ Kết nối thành công!")
 
+                    # Các packet đến cùng lần recv với CONNACK
+                    for first_byte, body in frames[1:]:
+                        self.handle_received_packet(first_byte, body)
                     # Start receiving
                     self.receive_loop()
 
@@ -62,11 +94,11 @@ class SimpleMQTTClient:
         # Protocol version (3.1.1 = 4)
         protocol_version = b"\x04"
 
-        # Connect flags (clean session = 1)
-        connect_flags = b"\x02"
+        # Connect flags (bit 1 = clean session)
+        connect_flags = b"\x02" if self.clean_session else b"\x00"
 
-        # Keep alive (60 seconds)
-        keep_alive = b"\x00\x3C"
+        # Keep alive (mặc định 60 giây)
+        keep_alive = struct.pack(">H", self.keep_alive)
 
         # Client ID
         client_id_bytes = self.client_id.encode('utf-8')
@@ -76,24 +108,24 @@ class SimpleMQTTClient:
         variable_header = protocol_name + protocol_version + connect_flags + keep_alive
         payload = client_id_length + client_id_bytes
 
-        # Calculate remaining length
-        remaining_length = len(variable_header) + len(payload)
-
         # Fixed header
         packet_type = 0x10  # CONNECT
-        fixed_header = bytes([packet_type, remaining_length])
+        return build_packet(packet_type, variable_header + payload)
 
-        return fixed_header + variable_header + payload
+    def next_packet_id(self):
+        packet_id = self._next_packet_id
+        self._next_packet_id = packet_id % 65535 + 1
+        return packet_id
 
-    def subscribe(self, topic):
-        """Subscribe đến một topic"""
+    def subscribe(self, topic, qos=0):
+        """Subscribe đến một topic (qos: QoS yêu cầu, broker có thể hạ cấp)"""
         if not self.connected:
             print("❌ Chưa kết nối!")
             return False
 
         try:
             # Tạo SUBSCRIBE packet
-            subscribe_packet = self.create_subscribe_packet(topic)
+            subscribe_packet = self.create_subscribe_packet(topic, qos)
             print(f"📤 Gửi SUBSCRIBE '{topic}': {subscribe_packet.hex()}")
 
             self.socket.send(subscribe_packet)
@@ -103,36 +135,39 @@ class SimpleMQTTClient:
             print(f"❌ Lỗi subscribe: {e}")
             return False
 
-    def create_subscribe_packet(self, topic):
+    def create_subscribe_packet(self, topic, qos=0):
         """Tạo MQTT SUBSCRIBE packet"""
-        # Packet identifier (random)
-        packet_id = b"\x00\x01"
+        # Packet identifier
+        packet_id = struct.pack(">H", self.next_packet_id())
 
         # Topic filter
         topic_bytes = topic.encode('utf-8')
         topic_length = struct.pack(">H", len(topic_bytes))
-        qos = b"\x00"  # QoS 0
+        qos = bytes([qos])  # QoS yêu cầu
 
         # Variable header + Payload  
         variable_header = packet_id
         payload = topic_length + topic_bytes + qos
 
-        remaining_length = len(variable_header) + len(payload)
-
         # Fixed header
         packet_type = 0x82  # SUBSCRIBE with QoS 1
-        fixed_header = bytes([packet_type, remaining_length])
-
-        return fixed_header + variable_header + payload
+        return build_packet(packet_type, variable_header + payload)
 
-    def publish(self, topic, message):
-        """Publish message đến topic"""
+    def publish(self, topic, message, qos=0, retain=False):
+        """Publish message đến topic (qos=1: chờ PUBACK, xem pending_acks; retain: broker giữ message cuối)"""
         if not self.connected:
             return "CHua ket noi toi broker "
 
         try:
             # Tạo PUBLISH packet
-            publish_packet = self.create_publish_packet(topic, message)
+            if qos > 0:
+                packet_id = self.next_packet_id()
+                self.pending_acks[packet_id] = (topic, message)
+                publish_packet = build_publish(topic, message, qos=qos, packet_id=packet_id, retain=retain)
+            elif retain:
+                publish_packet = build_publish(topic, message, retain=True)
+            else:
+                publish_packet = self.create_publish_packet(topic, message)
 
             self.socket.send(publish_packet)
             return True
@@ -153,56 +188,58 @@ class SimpleMQTTClient:
         variable_header = topic_length + topic_bytes
         payload = message_bytes
 
-        remaining_length = len(variable_header) + len(payload)
-
         # Fixed header
         packet_type = 0x30  # PUBLISH
-        fixed_header = bytes([packet_type, remaining_length])
+        return build_packet(packet_type, variable_header + payload)
 
-        return fixed_header + variable_header + payload
+    def _ping_loop(self):
+        """Gửi PINGREQ định kỳ để broker không coi client là đã chết"""
+        while self.connected and not self._stop_ping.wait(self.keep_alive / 2):
+            try:
+                self.socket.send(bytes([0xC0, 0x00]))  # PINGREQ
+            except OSError:
+                break
 
     def receive_loop(self):
         """Vòng lặp nhận tin nhắn"""
         while self.connected:
             try:
-                data = self.socket.recv(1024)
+                data = self.socket.recv(4096)
                 if not data:
                     break
 
-                self.handle_received_packet(data)
+                for first_byte, body in self.decoder.feed(data):
+                    self.handle_received_packet(first_byte, body)
 
             except Exception as e:
                 if self.connected:
                     print(f"❌ Lỗi nhận tin: {e}")
                 break
 
-    def handle_received_packet(self, data):
-        """Xử lý packet nhận được"""
-        if len(data) < 2:
-            return
-
-        packet_type = (data[0] >> 4) & 0x0F
+    def handle_received_packet(self, first_byte, body):
+        """Xử lý packet nhận được (đã tách bởi MQTTFrameDecoder)"""
+        packet_type = (first_byte >> 4) & 0x0F
 
         if packet_type == 3:  # PUBLISH
-            self.handle_publish_packet(data)
+            self.handle_publish_packet(body, first_byte & 0x0F)
+        elif packet_type == 4:  # PUBACK
+            self.pending_acks.pop(parse_packet_id(body), None)
         elif packet_type == 9:  # SUBACK
-            print("✅ Nhận SUBACK - Subscribe thành công!")
+            self.granted_qos = list(body[2:])
+            print(f"✅ Nhận SUBACK - Subscribe thành công! QoS được cấp: {self.granted_qos}")
         elif packet_type == 13:  # PINGRESP
             print("🏓 Nhận PINGRESP")
 
-    def handle_publish_packet(self, data):
-        """Xử lý PUBLISH packet nhận được"""
+    def handle_publish_packet(self, payload, flags=0):
+        """Xử lý PUBLISH packet nhận được (payload = variable header + message)"""
         try:
-            remaining_length = data[1]
-            payload = data[2:2+remaining_length]
-
-            # Parse topic
-            if len(payload) < 2:
-                return
-
-            topic_length = struct.unpack(">H", payload[0:2])[0]
-            topic = payload[2:2+topic_length].decode('utf-8')
-            message = payload[2+topic_length:].decode('utf-8')
+            topic, packet_id, message = parse_publish(payload, flags)
+            message = message.decode('utf-8')
+            if publish_qos(flags) >= 1:
+                if self.auto_ack:
+                    self.ack(packet_id)
+                else:
+                    self.unacked[packet_id] = topic
             try:
                 # Invoke callback if provided
                 self.onReciveMessage(topic, message)
@@ -213,9 +250,15 @@ class SimpleMQTTClient:
         except Exception as e:
             print(f"❌ Lỗi parse PUBLISH: {e}")
 
+    def ack(self, packet_id):
+        """Gửi PUBACK cho message QoS 1 đã nhận"""
+        self.unacked.pop(packet_id, None)
+        self.socket.send(build_puback(packet_id))
+
     def disconnect(self):
         """Ngắt kết nối"""
         self.connected = False
+        self._stop_ping.set()
         if self.socket:
             try:
                 # Gửi DISCONNECT packet
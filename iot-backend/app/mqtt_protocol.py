@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""
+Các hàm mã hóa / giải mã MQTT 3.1.1 dùng chung cho broker và client
+
+- Remaining Length dạng varint 1-4 byte (tối đa 268 435 455 byte)
+- MQTTFrameDecoder: giải mã luồng TCP theo kiểu incremental. TCP không giữ
+  ranh giới packet: một lần recv() có thể chứa nửa packet hoặc nhiều packet
+  dính nhau, nên mỗi kết nối giữ một decoder riêng.
+"""
+
+import struct
+
+# MQTT Control Packet Types (theo MQTT 3.1.1 specification)
+MQTT_PACKET_TYPES = {
+    1: 'CONNECT',
+    2: 'CONNACK',
+    3: 'PUBLISH',
+    4: 'PUBACK',
+    5: 'PUBREC',
+    6: 'PUBREL',
+    7: 'PUBCOMP',
+    8: 'SUBSCRIBE',
+    9: 'SUBACK',
+    10: 'UNSUBSCRIBE',
+    11: 'UNSUBACK',
+    12: 'PINGREQ',
+    13: 'PINGRESP',
+    14: 'DISCONNECT'
+}
+
+MAX_REMAINING_LENGTH = 268_435_455   # 0xFF 0xFF 0xFF 0x7F
+
+
+class MQTTProtocolError(ValueError):
+    """Packet sai định dạng - broker nên đóng kết nối"""
+
+
+class PacketTooLarge(MQTTProtocolError):
+    """Remaining length vượt max_packet_size của decoder"""
+
+
+def packet_type_name(first_byte):
+    """Lấy tên packet type từ byte đầu của fixed header"""
+    return MQTT_PACKET_TYPES.get((first_byte >> 4) & 0x0F, 'UNKNOWN')
+
+
+def encode_remaining_length(length):
+    """Mã hóa Remaining Length thành varint 1-4 byte"""
+    if length < 0 or length > MAX_REMAINING_LENGTH:
+        raise MQTTProtocolError(f"Remaining length ngoài giới hạn: {length}")
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length > 0:
+            byte |= 0x80
+        encoded.append(byte)
+        if length == 0:
+            return bytes(encoded)
+
+
+def decode_remaining_length(data, offset=1):
+    """
+    Giải mã Remaining Length bắt đầu tại data[offset]
+
+    Trả về (remaining_length, số byte varint) hoặc (None, 0) nếu chưa đủ dữ liệu
+    """
+    multiplier = 1
+    value = 0
+    for i in range(4):
+        if offset + i >= len(data):
+            return None, 0
+        byte = data[offset + i]
+        value += (byte & 0x7F) * multiplier
+        if not byte & 0x80:
+            return value, i + 1
+        multiplier *= 128
+    raise MQTTProtocolError("Remaining length dài hơn 4 byte")
+
+
+def build_packet(first_byte, body=b''):
+    """Đóng gói fixed header (type + flags + remaining length) với phần thân"""
+    return bytes([first_byte]) + encode_remaining_length(len(body)) + bytes(body)
+
+
+class MQTTFrameDecoder:
+    """
+    Decoder incremental cho một kết nối
+
+    feed(data) nhận bytes vừa recv(), trả về list (first_byte, body) của mọi
+    packet hoàn chỉnh; phần packet dở dang được giữ lại cho lần feed sau.
+    Buffer là một bytearray kèm con trỏ đọc: dữ liệu đã tiêu thụ chỉ bị xóa
+    một lần mỗi feed nên không copy lại buffer cho từng packet.
+    """
+
+    def __init__(self, max_packet_size=MAX_REMAINING_LENGTH):
+        self.max_packet_size = max_packet_size
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        self._buffer += data
+        buffer = self._buffer
+        view = memoryview(buffer)
+        frames = []
+        pos = 0
+        try:
+            while len(buffer) - pos >= 2:
+                remaining_length, length_bytes = decode_remaining_length(buffer, pos + 1)
+                if remaining_length is None:
+                    break
+                if remaining_length > self.max_packet_size:
+                    raise PacketTooLarge(f"Packet quá lớn: {remaining_length} byte (tối đa {self.max_packet_size})")
+                start = pos + 1 + length_bytes
+                end = start + remaining_length
+                if end > len(buffer):
+                    break
+                frames.append((buffer[pos], bytes(view[start:end])))
+                pos = end
+        finally:
+            view.release()
+        if pos:
+            del buffer[:pos]
+        return frames
+
+    def pending(self):
+        """Số byte của packet dở dang đang chờ"""
+        return len(self._buffer)
+
+    def reset(self):
+        self._buffer.clear()
+
+
+# ================================
+# PUBLISH / PUBACK
+# ================================
+
+PUBLISH_DUP = 0x08
+PUBLISH_RETAIN = 0x01
+
+
+def publish_qos(flags):
+    """QoS nằm ở bit 1-2 của 4 bit flags"""
+    return (flags >> 1) & 0x03
+
+
+def parse_publish(payload, flags=0):
+    """
+    Tách PUBLISH thành (topic, packet_id, message_bytes)
+    packet_id chỉ có khi QoS > 0, ngược lại là None
+    """
+    if len(payload) < 2:
+        raise MQTTProtocolError("PUBLISH quá ngắn")
+    topic_len = struct.unpack_from(">H", payload, 0)[0]
+    offset = 2 + topic_len
+    if len(payload) < offset:
+        raise MQTTProtocolError("PUBLISH không đủ dài cho topic")
+    topic = bytes(payload[2:offset]).decode('utf-8')
+    packet_id = None
+    if publish_qos(flags) > 0:
+        if len(payload) < offset + 2:
+            raise MQTTProtocolError("PUBLISH QoS > 0 thiếu packet id")
+        packet_id = struct.unpack_from(">H", payload, offset)[0]
+        offset += 2
+    return topic, packet_id, bytes(payload[offset:])
+
+
+def build_publish(topic, message, qos=0, packet_id=None, dup=False, retain=False):
+    """Đóng gói PUBLISH; message có thể là str hoặc bytes"""
+    topic_bytes = topic.encode('utf-8')
+    message_bytes = message.encode('utf-8') if isinstance(message, str) else bytes(message)
+    first_byte = 0x30 | (qos << 1)
+    if dup:
+        first_byte |= PUBLISH_DUP
+    if retain:
+        first_byte |= PUBLISH_RETAIN
+    body = struct.pack(">H", len(topic_bytes)) + topic_bytes
+    if qos > 0:
+        body += struct.pack(">H", packet_id)
+    return build_packet(first_byte, body + message_bytes)
+
+
+def build_puback(packet_id):
+    return build_packet(0x40, struct.pack(">H", packet_id))
+
+
+def parse_packet_id(payload):
+    """Packet id 2 byte đầu của PUBACK / PUBREC / PUBREL / PUBCOMP / SUBACK"""
+    if len(payload) < 2:
+        raise MQTTProtocolError("Thiếu packet id")
+    return struct.unpack_from(">H", payload, 0)[0]
+
+
+# ================================
+# CONNECT
+# ================================
+
+CONNECT_USERNAME = 0x80
+CONNECT_PASSWORD = 0x40
+CONNECT_WILL_RETAIN = 0x20
+CONNECT_WILL_QOS = 0x18
+CONNECT_WILL = 0x04
+CONNECT_CLEAN_SESSION = 0x02
+CONNECT_RESERVED = 0x01
+
+# CONNACK return code
+CONNACK_ACCEPTED = 0x00
+CONNACK_BAD_PROTOCOL = 0x01
+CONNACK_IDENTIFIER_REJECTED = 0x02
+CONNACK_BAD_CREDENTIALS = 0x04
+CONNACK_NOT_AUTHORIZED = 0x05
+
+SUPPORTED_PROTOCOLS = {("MQTT", 4), ("MQIsdp", 3)}   # MQTT 3.1.1 va 3.1 (paho cu)
+
+
+class ConnectRefused(MQTTProtocolError):
+    """CONNECT hợp lệ về cú pháp nhưng bị từ chối - broker trả CONNACK với return_code rồi đóng"""
+
+    def __init__(self, return_code, message):
+        super().__init__(message)
+        self.return_code = return_code
+
+
+class ConnectPacket:
+    """
+    Kết quả parse CONNECT
+
+    Chuỗi (client_id, will_topic, username) được decode; will_message và password
+    là memoryview trỏ thẳng vào payload gốc (không copy) - bytes(...) khi cần.
+    """
+    __slots__ = ('protocol_name', 'protocol_level', 'flags', 'keep_alive', 'client_id',
+                 'will_topic', 'will_message', 'username', 'password')
+
+    @property
+    def clean_session(self):
+        return bool(self.flags & CONNECT_CLEAN_SESSION)
+
+    @property
+    def will_qos(self):
+        return (self.flags & CONNECT_WILL_QOS) >> 3
+
+    @property
+    def will_retain(self):
+        return bool(self.flags & CONNECT_WILL_RETAIN)
+
+    def __repr__(self):
+        return (f"<ConnectPacket {self.protocol_name}/{self.protocol_level} client_id={self.client_id!r} "
+                f"keep_alive={self.keep_alive} flags=0x{self.flags:02x}>")
+
+
+def _read_field(view, offset, what):
+    """Đọc trường 2 byte độ dài + dữ liệu, trả về (memoryview, offset mới)"""
+    if offset + 2 > len(view):
+        raise MQTTProtocolError(f"CONNECT thiếu {what}")
+    length = (view[offset] << 8) | view[offset + 1]
+    start = offset + 2
+    end = start + length
+    if end > len(view):
+        raise MQTTProtocolError(f"CONNECT: {what} dài hơn packet")
+    return view[start:end], end
+
+
+def _read_string(view, offset, what):
+    field, offset = _read_field(view, offset, what)
+    try:
+        return str(field, 'utf-8'), offset
+    except UnicodeDecodeError:
+        raise MQTTProtocolError(f"CONNECT: {what} không phải UTF-8")
+
+
+def parse_connect(payload):
+    """
+    Parse CONNECT (variable header + payload) theo MQTT 3.1.1 mục 3.1
+
+    [protocol name][level][flags][keep alive][client id][will topic][will message][username][password]
+    Các trường will / username / password chỉ có khi cờ tương ứng bật, nên
+    không thể cắt cứng payload[10:] làm client id.
+    Raise MQTTProtocolError nếu sai cú pháp, ConnectRefused nếu phải trả CONNACK lỗi.
+    """
+    view = memoryview(payload)
+    packet = ConnectPacket()
+    packet.protocol_name, offset = _read_string(view, 0, "protocol name")
+    if offset + 4 > len(view):
+        raise MQTTProtocolError("CONNECT thiếu level / flags / keep alive")
+    packet.protocol_level = view[offset]
+    flags = packet.flags = view[offset + 1]
+    packet.keep_alive = (view[offset + 2] << 8) | view[offset + 3]
+    offset += 4
+
+    if (packet.protocol_name, packet.protocol_level) not in SUPPORTED_PROTOCOLS:
+        raise ConnectRefused(CONNACK_BAD_PROTOCOL,
+                             f"Protocol không hỗ trợ: {packet.protocol_name} level {packet.protocol_level}")
+    if flags & CONNECT_RESERVED:
+        raise MQTTProtocolError("CONNECT: bit reserved phải bằng 0")
+    if not flags & CONNECT_WILL and flags & (CONNECT_WILL_QOS | CONNECT_WILL_RETAIN):
+        raise MQTTProtocolError("CONNECT: will QoS / retain bật khi không có will")
+    if (flags & CONNECT_WILL_QOS) >> 3 > 2:
+        raise MQTTProtocolError("CONNECT: will QoS không hợp lệ")
+
+    packet.client_id, offset = _read_string(view, offset, "client id")
+    packet.will_topic = packet.will_message = None
+    packet.username = packet.password = None
+    if flags & CONNECT_WILL:
+        packet.will_topic, offset = _read_string(view, offset, "will topic")
+        packet.will_message, offset = _read_field(view, offset, "will message")
+    if flags & CONNECT_USERNAME:
+        packet.username, offset = _read_string(view, offset, "username")
+    if flags & CONNECT_PASSWORD:
+        packet.password, offset = _read_field(view, offset, "password")
+
+    if not packet.client_id and not packet.clean_session:
+        # client id rong chi hop le khi clean session = 1 (broker tu cap id)
+        raise ConnectRefused(CONNACK_IDENTIFIER_REJECTED, "Client id rỗng với clean session = 0")
+    return packet
+
+
+def build_connack(return_code=0, session_present=False):
+    """CONNACK: byte 1 bit 0 = session present, byte 2 = return code"""
+    return bytes([0x20, 0x02, 0x01 if session_present else 0x00, return_code])
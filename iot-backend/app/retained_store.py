@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Kho retained message của broker
+
+PUBLISH có cờ RETAIN: broker giữ lại message cuối cùng của topic đó và gửi
+ngay cho client nào SUBSCRIBE sau này (kể cả subscribe bằng wildcard).
+Dashboard / ESP32 vừa khởi động biết được trạng thái hiện tại của CT/ và SS/
+mà không phải chờ lần publish tiếp theo hay hỏi database.
+
+- Bộ nhớ: {topic: (message_bytes, qos)} - mỗi topic đúng 1 message
+- PUBLISH retained với message rỗng = xóa retained message của topic
+- snapshot_path (tùy chọn): ghi ra file JSON để giữ qua lần khởi động lại broker
+"""
+
+import base64
+import json
+import os
+import threading
+from app.topic_tree import MULTI_LEVEL, SINGLE_LEVEL, topic_matches
+
+
+class RetainedStore:
+    def __init__(self, snapshot_path=None):
+        self.snapshot_path = snapshot_path
+        self._messages = {}          # {topic: (message_bytes, qos)}
+        self._lock = threading.Lock()
+        self.dirty = False           # co thay doi chua ghi snapshot
+
+    def set(self, topic, message, qos=0):
+        """Lưu retained message; message rỗng thì xóa. Trả về True nếu kho thay đổi"""
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        with self._lock:
+            if not message:
+                changed = self._messages.pop(topic, None) is not None
+            else:
+                changed = self._messages.get(topic) != (message, qos)
+                self._messages[topic] = (bytes(message), qos)
+            if changed:
+                self.dirty = True
+            return changed
+
+    def get(self, topic):
+        with self._lock:
+            return self._messages.get(topic)
+
+    def match(self, topic_filter):
+        """[(topic, message_bytes, qos)] của mọi topic khớp filter"""
+        with self._lock:
+            if SINGLE_LEVEL not in topic_filter and MULTI_LEVEL not in topic_filter:
+                item = self._messages.get(topic_filter)
+                return [(topic_filter, item[0], item[1])] if item else []
+            return [
+                (topic, message, qos)
+                for topic, (message, qos) in self._messages.items()
+                if topic_matches(topic_filter, topic)
+            ]
+
+    def __len__(self):
+        return len(self._messages)
+
+    def load(self):
+        """Đọc snapshot (nếu có). Trả về số message đã nạp"""
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return 0
+        try:
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            with self._lock:
+                self._messages = {
+                    topic: (base64.b64decode(message), qos)
+                    for topic, (message, qos) in data.items()
+                }
+                self.dirty = False
+            return len(self._messages)
+        except (OSError, ValueError) as e:
+            print(f"❌ Không đọc được snapshot retained {self.snapshot_path}: {e}")
+            return 0
+
+    def save(self):
+        """Ghi snapshot nếu có thay đổi (ghi file tạm rồi os.replace để không hỏng file cũ)"""
+        if not self.snapshot_path or not self.dirty:
+            return False
+        with self._lock:
+            data = {
+                topic: [base64.b64encode(message).decode('ascii'), qos]
+                for topic, (message, qos) in self._messages.items()
+            }
+            self.dirty = False
+        tmp_path = self.snapshot_path + ".tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.snapshot_path)
+            return True
+        except OSError as e:
+            self.dirty = True
+            print(f"❌ Không ghi được snapshot retained {self.snapshot_path}: {e}")
+            return False
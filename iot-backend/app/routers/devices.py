@@ -3,12 +3,18 @@
 from unittest import result
 from fastapi import APIRouter, HTTPException, Depends, status
 from typing import List
-import secrets
 from pydantic.type_adapter import P
-from app.schemas.device import DeviceRegister, DeviceResponse, DeviceConfigRequest, DeviceUpdateRequest
+from app.schemas.device import (
+    BulkDeviceConfigRequest, BulkDeviceRegister, DeviceRegister, DeviceResponse, DeviceConfigRequest, DeviceUpdateRequest
+)
 from app.middleware.auth import get_current_user
-from app.security import create_device_token, verify_device_token
-from app.database import db
+from app.security import verify_device_token
+import asyncio
+from app.database import db, async_db
+from app.services.device_service import (
+    bulk_config_pins, bulk_register_devices, bulk_response, bulk_size_error, create_device, device_auth_cache,
+    pin_registry
+)
 
 router = APIRouter(prefix="/devices", tags=["Device Management"])
 #đăng ký thiết bị
@@ -17,75 +23,23 @@ def register_device(
     device_data: DeviceRegister,
     current_user: dict = Depends(get_current_user)
 ):
-    """Đăng ký ESP32 device mới"""
+    """Đăng ký ESP32 device mới (device_token sinh trong device_service như bulkRegister)"""
     try:
-        # Check if device name already exists for this user
-        existing_devices = db.execute_query(
-            table="devices",
-            operation="select",
-            filters={"user_id": current_user["id"], "device_name": device_data.device_name}
-        )
-        
-        if existing_devices:
-            return{
-                "success": False,
-                "message": "Device name already exists"
-            }
-        print(f"🔍 Device data: {device_data}") 
-        print(f"🔍 Current user: {current_user}") 
-        # Create device in database first to get ID
-        new_device = db.execute_query(
-            table="devices",
-            operation="insert",
-            data={
-                "user_id": current_user["id"],
-                "device_name": device_data.device_name,
-                "device_type": device_data.device_type.value,
-                # "mac_address": device_data.mac_address,
-                # "device_config": device_data.device_config,
-                # "device_token": "temp_token"  # Temporary token
-            }
-        )
-        
-        if not new_device:
-            return{
+        result = create_device(current_user["id"], device_data)
+        if not result["success"]:
+            return {
                 "success": False,
-                "message": "Failed to create device"
+                "message": result["message"]
             }
-        
-        device = new_device[0]
-        
-        # Create device JWT token
-        device_token = create_device_token(str(current_user["id"]),str(device["device_token"]), device_data.device_type.value)
-        token_verify = secrets.token_hex(16)
-        # Update device với real token
-        updated_device = db.execute_query(
-            table="devices",
-            operation="update",
-            data={"device_access_token": device_token , "token_verify" : token_verify},
-            filters={"id": device["id"]}
-        )
-        
-        # Set default permissions cho master devices
-        # if device_data.device_type == "master":
-        #     await db.execute_query(
-        #         table="device_permissions",
-        #         operation="insert",
-        #         data={
-        #             "device_id": device["id"],
-        #             "permission_type": "ai_chat",
-        #             "permission_level": "read"
-        #         }
-        #     )
-        
+        device = result["device"]
         return {
             "success": True,
             "device": {
                 "id": device["id"],
                 "device_name": device["device_name"],
                 "device_type": device["device_type"],
-                "device_access_token": device_token,
-                "token_verify" : token_verify
+                "device_access_token": device["device_access_token"],
+                "token_verify": device["token_verify"]
             },
             "message": "Device registered successfully"
         }
@@ -98,6 +52,26 @@ def register_device(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Device registration failed: {str(e)}"
         )
+#đăng ký nhiều thiết bị 1 lần
+@router.post("/bulkRegister", response_model=dict)
+def bulk_register(
+    bulk_data: BulkDeviceRegister,
+    current_user: dict = Depends(get_current_user)
+):
+    """Đăng ký nhiều ESP32 device: kiểm tra tên trước, ghi cả lô bằng 1 insert, trả kết quả từng thiết bị"""
+    error = bulk_size_error(bulk_data.devices)
+    if error:
+        return {
+            "success": False,
+            "message": error
+        }
+    try:
+        return bulk_response(bulk_register_devices(current_user["id"], bulk_data.devices))
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Bulk device registration failed: {str(e)}"
+        )
 #lay thong tin chi tiet cua thiet bi chi dinh 
 @router.get("/getDevice", response_model=dict)
 async def get_device(
@@ -106,7 +80,7 @@ async def get_device(
 ):
     """Get device details"""
     try:
-        devices = db.execute_query(
+        devices = await async_db.execute_query(
             table="devices",
             operation="select",
             filters={"user_id": current_user["id"], "id": device_id}
@@ -142,6 +116,8 @@ def update_device(
                 "is_active": device_data.is_active
             }
         )
+        # is_active / device_type đổi -> CONNECT sau phải đọc lại từ database
+        device_auth_cache.invalidate(device_token=device_data.device_token)
         if not devices:
             return{
                 "success": False,
@@ -163,20 +139,25 @@ async def get_devices(
 ):
     """Get all devices of user"""
     try:
-        devices = db.execute_query(
+        devices = await async_db.execute_query(
             table="devices",
             operation="select",
             filters={"user_id": current_user["id"]}
         )
+        if devices is None:
+            raise RuntimeError("database error")
+        expired = []
         for device in devices:
             if not verify_device_token(device["device_access_token"]) :
                 device["is_active"] = False
-                db.execute_query(
+                expired.append(async_db.execute_query(
                     table="devices",
                     operation="update",
                     data={"is_active": False},
                     filters={"id": device["id"]}
-                )
+                ))
+        # cập nhật song song trên pool kết nối thay vì lần lượt
+        await asyncio.gather(*expired)
         
         return {
             "success": True,
@@ -287,11 +268,14 @@ def config_device(
                     }
                 )
             if not result:
+                pin_registry.load_device(device_Config.device_token, force=True)
                 return {
                     "success": False,
                     "message": "Failed to update device pins"
                 }
 
+        # nạp lại cấu hình pin cho MQTT (SS/ và device-command tra trong bộ nhớ)
+        pin_registry.load_device(device_Config.device_token, force=True)
         return {
             "success": True,
             "message": "Device Updated successfully"
@@ -304,6 +288,26 @@ def config_device(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Device registration failed: {str(e)}"
         )
+#config pin cho nhieu thiet bi 1 lan
+@router.post("/bulkConfigPin", response_model=dict)
+def bulk_config_pin(
+    bulk_config: BulkDeviceConfigRequest,
+    current_user: dict = Depends(get_current_user)
+):
+    """Config pin cho nhiều thiết bị: kiểm tra trước, ghi mọi pin bằng 1 upsert, trả kết quả từng thiết bị"""
+    error = bulk_size_error(bulk_config.devices)
+    if error:
+        return {
+            "success": False,
+            "message": error
+        }
+    try:
+        return bulk_response(bulk_config_pins(current_user["id"], bulk_config.devices))
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Bulk pin configuration failed: {str(e)}"
+        )
 @router.delete("/deleteConfigPin", response_model=dict)
 def delete_config_pin(
     device_token: str,
@@ -317,6 +321,7 @@ def delete_config_pin(
             operation="delete",
             filters={"device_token": device_token, "virtual_pin": int(virtual_pin)}
         )
+        pin_registry.load_device(device_token, force=True)
         if not result:
             return{
                 "success": False,
@@ -400,6 +405,8 @@ def delete_device(
                 "success": False,
                 "message": "Failed to delete device"
             }
+        device_auth_cache.invalidate(token_verify=devices[0].get("token_verify"), device_token=device_token)
+        pin_registry.invalidate(device_token)
         return {"success": True, "message": "Device deleted successfully"}
         
     except HTTPException:
@@ -2,14 +2,22 @@
 # app/routers/mqtt.py
 from email import message
 import json
-from fastapi import APIRouter, HTTPException, Depends, status
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, HTTPException, Depends, Query, status
+from fastapi.responses import JSONResponse, StreamingResponse
 from typing import List, Dict, Optional, Self
 from pydantic import BaseModel
-from app.middleware.auth import get_current_user
+from app.middleware.auth import get_current_user, get_admin_user
 from app.services.mqtt_service import mqtt_service
+from app.services.device_service import pin_registry
+from app.services.sensor_service import (
+    DEFAULT_PAGE_SIZE, MAX_BUCKETS, MAX_PAGE_SIZE, MAX_POINTS, aggregate_history, archive_sensor_data,
+    decode_cursor, downsample_history, encode_cursor, fetch_history_page, history_window, iter_history,
+    query_sensor_data, rollup_for, sensor_archive, window_seconds
+)
 from app.broker_server import TOPIC_CONTRO , TOPIC_SENSOR
-from app.database import db
+from app.broker_connection import DEFAULT_QUEUE_SIZE, OVERFLOW_DROP_OLDEST
+from app.broker_session import DEFAULT_MAX_INFLIGHT, DEFAULT_RETRY_INTERVAL
+from app.database import db, async_db
 router = APIRouter(prefix="/mqtt", tags=["MQTT Management"])
 TAG = "MQTT ROUTER"
 # Pydantic models
@@ -58,15 +66,35 @@ def get_mqtt_status():
         )
 
 @router.post("/start")
-def start_mqtt_broker():
-    """Khởi động MQTT Broker"""
+def start_mqtt_broker(
+    engine: str = "thread",
+    max_queue: int = DEFAULT_QUEUE_SIZE,
+    overflow_policy: str = OVERFLOW_DROP_OLDEST,
+    max_inflight: int = DEFAULT_MAX_INFLIGHT,
+    retry_interval: float = DEFAULT_RETRY_INTERVAL
+):
+    """
+    Khởi động MQTT Broker
+    - engine: thread | asyncio
+    - max_queue / overflow_policy: hàng đợi gửi của mỗi client (drop_oldest | drop_newest | disconnect)
+    - max_inflight / retry_interval: số message QoS 1 chưa PUBACK tối đa mỗi client, thời gian chờ trước khi gửi lại
+    """
     try:
         if mqtt_service.running:
             return {"message": "MQTT Broker đã đang chạy"}
             
-        mqtt_service.start_broker(host= "localhost" , port= 1883)
+        mqtt_service.start_broker(
+            host= "localhost" , port= 1883, engine=engine,
+            max_queue=max_queue, overflow_policy=overflow_policy,
+            max_inflight=max_inflight, retry_interval=retry_interval
+        )
 
-        return {"message": "MQTT Broker đã khởi động thành công"}
+        return {"message": "MQTT Broker đã khởi động thành công", "engine": engine}
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -166,6 +194,72 @@ def get_topics():
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to get topics: {str(e)}"
         )
+@router.get("/clients")
+def get_clients_stats():
+    """Bộ đếm hàng đợi gửi của từng client (queued, sent, dropped...)"""
+    try:
+        stats = mqtt_service.get_client_stats()
+        return {"clients": stats, "count": len(stats)}
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to get client stats: {str(e)}"
+        )
+@router.get("/pins")
+def get_pin_stats():
+    """Bộ đếm của registry cấu hình pin: số thiết bị / pin trong bộ nhớ, hits, misses"""
+    try:
+        return mqtt_service.get_pin_stats()
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to get pin stats: {str(e)}"
+        )
+@router.get("/ingest")
+def get_ingest_stats():
+    """Pipeline ghi sensor data: queued, high_water, inserted, failed, last/avg/max_flush_ms..."""
+    try:
+        return mqtt_service.get_ingest_stats()
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to get ingest stats: {str(e)}"
+        )
+@router.get("/archive")
+def get_archive_stats():
+    """Lưu trữ sensor_data: watermark (row cũ hơn nằm trong file segment), số block đã ghi / đọc / bỏ qua"""
+    return sensor_archive.stats()
+
+@router.post("/archive")
+def archive_sensor(
+    before: Optional[str] = None,
+    current_user: dict = Depends(get_admin_user)
+):
+    """
+    Chuyển sensor_data cũ (của mọi user) ra file segment rồi xóa khỏi database - chỉ admin
+    (bình thường chạy tự động mỗi SENSOR_ARCHIVE_INTERVAL_HOURS giờ)
+    before: mốc created_at (ISO 8601), không được muộn hơn bây giờ - SENSOR_RETENTION_DAYS ngày (mặc định)
+    """
+    try:
+        return archive_sensor_data(before)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to archive sensor data: {str(e)}"
+        )
+@router.get("/retained")
+def get_retained_messages(topic_filter: str = "#"):
+    """Giá trị cuối (retained) của các topic khớp filter, vd SS/{token_verify}/# - dùng để dựng UI ban đầu"""
+    try:
+        messages = mqtt_service.get_retained(topic_filter)
+        return {"messages": messages, "count": len(messages)}
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to get retained messages: {str(e)}"
+        )
 # deeeeeeeeee sauuuuuuuuuuuuuuuuuuuuuuuuuuuuuuuuuuuuuuuuuuuu
 @router.get("/topics/{topic}/subscribers")
 def get_topic_subscribers(topic: str):
@@ -226,17 +320,16 @@ def send_device_command(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="MQTT Broker chưa khởi động"
             )
-        device_pin = db.execute_query(
-            table="device_pins",
-            operation="select",
-            filters={"device_token": mqtt_service.device_tokens[device_command.token_verify]["device_token"], "virtual_pin": device_command.virtual_pin}
+        device_pin = pin_registry.get(
+            mqtt_service.device_tokens[device_command.token_verify]["device_token"],
+            device_command.virtual_pin
         )
         if not device_pin:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Device pin không tồn tại"
             )
-        if not device_pin[0]["pin_type"] == "OUTPUT":
+        if not device_pin["pin_type"] == "OUTPUT":
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Device pin không phải là OUTPUT"
@@ -276,33 +369,204 @@ def get_sensor_data(
     token_verify: str,
     limit: int = 10,
     virtual_pin : int = 0,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    order: str = "asc",
+    columns: str = "*",
     current_user: dict = Depends(get_current_user)
 ):
-    """Lấy sensor data từ database"""
+    """
+    Lấy sensor data
+    since / until: khoảng created_at (ISO 8601), order: asc | desc (desc = mới nhất trước)
+    columns: chỉ lấy các cột cần, vd "value_numeric,created_at"
+    Khoảng gần đây lấy từ hot tier trong bộ nhớ (source = hot), phần cũ hơn từ database -
+    database lọc, sắp xếp và limit, không tải cả lịch sử của pin về rồi cắt
+    """
     try:
-        
-        # Lấy sensor data từ database
-        sensor_data = db.execute_query(
-            table="sensor_data",
-            operation="select",
-            filters={"token_verify": token_verify , "virtual_pin" : virtual_pin}
+        if order not in ("asc", "desc"):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="order phải là asc hoặc desc"
+            )
+        # limit 0 thi lay het
+        sensor_data, source = query_sensor_data(
+            mqtt_service.hot_series, token_verify, virtual_pin, limit, since, until, order == "desc", columns
         )
         
         if not sensor_data:
             return {"message": "Không có sensor data", "data": []}
-            
-        # Limit results
-        if(limit > 0 and limit < len(sensor_data)):
-            sensor_data = sensor_data[:limit]
 
-        # limit 0 thi lay het
         return {
             "message": "Sensor data retrieved successfully",
             "data": sensor_data,
-            "count": len(sensor_data)
+            "count": len(sensor_data),
+            "source": source
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Failed to get sensor data: {str(e)}"
         )
+
+async def require_own_device(token_verify: str, current_user: dict):
+    """404 nếu token_verify không phải thiết bị của current_user - không phân biệt với device không tồn tại"""
+    devices = await async_db.execute_query(
+        table="devices",
+        operation="select",
+        columns="id",
+        filters={"token_verify": token_verify, "user_id": current_user["id"]},
+        limit=1
+    )
+    if devices is None:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Database error")
+    if not devices:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Device not found")
+
+@router.get("/sensor-history")
+async def get_sensor_history(
+    token_verify: str,
+    virtual_pin: int,
+    from_: Optional[str] = Query(None, alias="from"),
+    to: Optional[str] = None,
+    limit: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    order: str = "asc",
+    format: str = "json",
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Lịch sử sensor cho biểu đồ, vd 24h gần nhất của pin 3: ?token_verify=..&virtual_pin=3
+    from / to: khoảng created_at [from, to) ISO 8601 - thiếu from thì lấy 24h trước to (hoặc bây giờ)
+    format=json: 1 trang tối đa limit row + next_cursor (truyền lại qua cursor để lấy trang sau)
+    format=ndjson: stream cả khoảng thời gian, mỗi dòng 1 row, database đọc từng trang limit row
+    """
+    try:
+        if order not in ("asc", "desc"):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="order phải là asc hoặc desc")
+        if format not in ("json", "ndjson"):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="format phải là json hoặc ndjson")
+        if not 0 < limit <= MAX_PAGE_SIZE:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"limit phải trong khoảng 1..{MAX_PAGE_SIZE}")
+        try:
+            bounds = history_window(from_, to)
+            after = decode_cursor(cursor) if cursor else None
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+        descending = order == "desc"
+        await require_own_device(token_verify, current_user)
+
+        if format == "ndjson":
+            async def stream():
+                try:
+                    async for row in iter_history(token_verify, virtual_pin, bounds, descending, after, limit):
+                        yield json.dumps(row, separators=(',', ':')) + "\n"
+                except RuntimeError as e:
+                    # header 200 da gui - bao loi bang dong cuoi
+                    yield json.dumps({"error": str(e)}) + "\n"
+            return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+        rows = await fetch_history_page(token_verify, virtual_pin, bounds, descending, after, limit)
+        if rows is None:
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Database error")
+        return {
+            "data": rows,
+            "count": len(rows),
+            "from": bounds["gte"],
+            "to": bounds.get("lt"),
+            "next_cursor": encode_cursor(rows[-1]) if len(rows) == limit else None
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to get sensor history: {str(e)}"
+        )
+
+@router.get("/sensor-aggregate")
+async def get_sensor_aggregate(
+    token_verify: str,
+    virtual_pin: int,
+    from_: Optional[str] = Query(None, alias="from"),
+    to: Optional[str] = None,
+    resolution: float = 3600,
+    source: str = "auto",
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    min / max / avg / count / last của value_numeric theo bucket resolution giây (mặc định 1 giờ)
+    from / to như /sensor-history. Số bucket tối đa MAX_BUCKETS - tăng resolution nếu khoảng quá dài
+    source: auto (rollup nếu resolution là bội số của 1m / 1h, ngược lại raw) | rollup | raw
+    Rollup chỉ có dữ liệu từ lúc broker bắt đầu ghi sensor_rollups - dữ liệu cũ hơn dùng source=raw
+    """
+    try:
+        if source not in ("auto", "rollup", "raw"):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="source phải là auto, rollup hoặc raw")
+        try:
+            bounds = history_window(from_, to)
+            start, end = window_seconds(bounds)
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+        if resolution <= 0 or (end - start) / resolution > MAX_BUCKETS:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"resolution phải > 0 và cho tối đa {MAX_BUCKETS} bucket (tối thiểu {(end - start) / MAX_BUCKETS:.0f}s)"
+            )
+        await require_own_device(token_verify, current_user)
+        if source == "auto":
+            source = "rollup" if rollup_for(resolution) else "raw"
+        try:
+            buckets = await aggregate_history(token_verify, virtual_pin, bounds, resolution,
+                                              source, mqtt_service.sensor_rollups)
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+        return {
+            "from": bounds["gte"],
+            "to": bounds.get("lt"),
+            "resolution": resolution,
+            "source": source,
+            "buckets": buckets,
+            "count": len(buckets)
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to aggregate sensor data: {str(e)}"
+        )
+
+@router.get("/sensor-downsample")
+async def get_sensor_downsample(
+    token_verify: str,
+    virtual_pin: int,
+    from_: Optional[str] = Query(None, alias="from"),
+    to: Optional[str] = None,
+    points: int = 1000,
+    current_user: dict = Depends(get_current_user)
+):
+    """Tối đa points điểm [t, value] chọn bằng LTTB - giữ hình dạng đường khi vẽ khoảng dài"""
+    try:
+        if not 3 <= points <= MAX_POINTS:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"points phải trong khoảng 3..{MAX_POINTS}")
+        try:
+            bounds = history_window(from_, to)
+        except ValueError as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+        await require_own_device(token_verify, current_user)
+        data = await downsample_history(token_verify, virtual_pin, bounds, points)
+        return {
+            "from": bounds["gte"],
+            "to": bounds.get("lt"),
+            "points": data,
+            "count": len(data)
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Failed to downsample sensor data: {str(e)}"
+        )
@@ -1,13 +1,17 @@
 # WebSocket endpoints
 # app/routers/websocket.py
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import HTMLResponse
 import json
 import uuid
-from app.websockets.mqtt_bridge import mqtt_websocket_bridge
+from app.websockets.mqtt_bridge import mqtt_websocket_bridge, parse_initial
+from app.services.mqtt_service import mqtt_service
+from app.services.sensor_service import query_sensor_data
 from app.middleware.auth import get_current_user
 
 router = APIRouter(prefix="/ws", tags=["WebSocket"])
+MAX_TOPICS_PER_REQUEST = 100
 
 @router.websocket("/mqtt")
 async def websocket_mqtt_endpoint(websocket: WebSocket):
@@ -17,17 +21,41 @@ async def websocket_mqtt_endpoint(websocket: WebSocket):
     Protocol:
     - Client gửi: {"action": "subscribe", "topic": "sensor/device1/1"}
     - Server gửi: {"type": "mqtt_message", "topic": "sensor/device1/1", "message": "25.5"}
+    - topic là MQTT filter (SS/+/1, SS/<token_verify>/#); nhiều topic 1 lần:
+      {"action": "subscribe" | "unsubscribe", "topics": ["SS/a/1", "SS/b/#"]}
+      -> {"type": "subscription" | "unsubscription", "topics": {"SS/a/1": true, ...}, "success": ...}
+    - subscribe kèm "mode" / "interval_ms" (50..60000, mặc định 1000) để giãn nhịp theo từng subscription:
+      "all" (mặc định) mỗi message gửi ngay; "latest" chỉ giá trị mới nhất của mỗi topic, tối đa 1 lần / interval;
+      "batch" mọi message của topic trong interval gom thành
+      {"type": "mqtt_batch", "topic": ..., "messages": [[seq, "<timestamp>", "<message>"], ...]}
+      (binary: type (uint8 = 2) | độ dài topic (uint16) | số message (uint16) | topic
+       | mỗi message: seq (uint64) | timestamp (float64) | độ dài (uint32) | message)
+    - ?format=binary hoặc {"action": "format", "format": "binary" | "json"}: mqtt_message gửi dạng frame nhị phân
+      type (uint8 = 1) | seq (uint64) | timestamp (float64) | độ dài topic (uint16) | topic | message (big-endian, utf-8)
+    - subscribe kèm "snapshot": "last" | N (1..1000 điểm gần nhất) -> trước mọi delta nhận
+      {"type": "snapshot", "stream": ..., "seq": S, "messages": [{"topic", "message"}], "series": {topic: [[ts, value]]}}
+      rồi mqtt_message / mqtt_batch có "seq" > S (seq tăng dần, chung mọi topic của stream)
+    - Kết nối lại: subscribe kèm "resume_from": <seq cuối đã nhận>, "stream": <stream cũ>
+      -> {"type": "replay", "seq": S, "from": ..., "messages": [[seq, ts, topic, message], ...]};
+      stream khác (server khởi động lại) hoặc seq quá cũ -> snapshot với "reset": true
+    - Client gửi: {"action": "history", "topic": "SS/<token_verify>/<pin>", "limit": 100, "since": "..."}
+      -> {"type": "history", "topic": ..., "data": [...], "source": "hot" | "hot+database" | "database"}
+      dữ liệu gần đây lấy từ hot tier trong bộ nhớ, database chỉ cho phần cũ hơn
     """
     connection_id = str(uuid.uuid4())
     
     try:
-        await mqtt_websocket_bridge.connect(websocket, connection_id)
+        frame_format = websocket.query_params.get("format", "json")
+        await mqtt_websocket_bridge.connect(websocket, connection_id, frame_format)
         
         # Gửi welcome message
         await websocket.send_text(json.dumps({
             "type": "connection",
             "message": "Connected to MQTT WebSocket Bridge",
-            "connection_id": connection_id
+            "connection_id": connection_id,
+            "format": mqtt_websocket_bridge.senders[connection_id].frame_format,
+            "stream": mqtt_websocket_bridge.stream,
+            "seq": mqtt_websocket_bridge.seq
         }))
         
         while True:
@@ -37,13 +65,49 @@ async def websocket_mqtt_endpoint(websocket: WebSocket):
             
             action = message.get("action")
             topic = message.get("topic")
+            topics = message.get("topics")
+            if isinstance(topics, list):
+                topics = [item for item in topics if isinstance(item, str)][:MAX_TOPICS_PER_REQUEST]
             
-            if action == "subscribe":
+            mode = message.get("mode", "all")
+            interval_ms = message.get("interval_ms")
+            initial = None
+            if action == "subscribe" and ("snapshot" in message or "resume_from" in message):
+                initial = parse_initial(message.get("snapshot"), message.get("resume_from"))
+                if initial is None:
+                    await websocket.send_text(json.dumps({
+                        "type": "error",
+                        "message": "snapshot phải là \"last\" hoặc số điểm 1..1000, resume_from là seq >= 0"
+                    }))
+                    continue
+            
+            if action in ("subscribe", "unsubscribe") and topics:
+                if action == "subscribe":
+                    results = await mqtt_websocket_bridge.subscribe_topics(connection_id, topics, mode, interval_ms)
+                    subscribed = [item for item, success in results.items() if success]
+                    if initial and subscribed:
+                        # ngay sau subscribe, truoc moi await: snapshot luon den truoc delta
+                        mqtt_websocket_bridge.send_initial(connection_id, subscribed, *initial, message.get("stream"))
+                else:
+                    results = await mqtt_websocket_bridge.unsubscribe_topics(connection_id, topics)
+                response = {
+                    "type": "subscription" if action == "subscribe" else "unsubscription",
+                    "topics": results,
+                    "success": all(results.values())
+                }
+                if action == "subscribe":
+                    response["mode"] = mode
+                await websocket.send_text(json.dumps(response))
+
+            elif action == "subscribe":
                 if topic:
-                    success = await mqtt_websocket_bridge.subscribe_topic(connection_id, topic)
+                    success = await mqtt_websocket_bridge.subscribe_topic(connection_id, topic, mode, interval_ms)
+                    if initial and success:
+                        mqtt_websocket_bridge.send_initial(connection_id, [topic], *initial, message.get("stream"))
                     await websocket.send_text(json.dumps({
                         "type": "subscription",
                         "topic": topic,
+                        "mode": mode,
                         "success": success,
                         "message": f"Subscribed to {topic}" if success else f"Failed to subscribe to {topic}"
                     }))
@@ -68,6 +132,18 @@ async def websocket_mqtt_endpoint(websocket: WebSocket):
                         "message": "Topic is required for unsubscribe action"
                     }))
                     
+            elif action == "format":
+                frame_format = message.get("format")
+                success = mqtt_websocket_bridge.set_format(connection_id, frame_format)
+                await websocket.send_text(json.dumps({
+                    "type": "format",
+                    "format": frame_format,
+                    "success": success
+                }))
+
+            elif action == "history":
+                await websocket.send_text(json.dumps(await _history(topic, message)))
+
             elif action == "ping":
                 await websocket.send_text(json.dumps({
                     "type": "pong",
@@ -87,6 +163,28 @@ async def websocket_mqtt_endpoint(websocket: WebSocket):
         print(f"❌ WebSocket error: {e}")
         mqtt_websocket_bridge.disconnect(connection_id)
 
+async def _history(topic, message):
+    """Lịch sử gần đây của topic SS/<token_verify>/<virtual_pin> (cũ -> mới)"""
+    parts = topic.split("/") if topic else []
+    if len(parts) != 3 or parts[0] != "SS" or not parts[2].isdigit():
+        return {"type": "error", "message": "history cần topic dạng SS/<token_verify>/<virtual_pin>"}
+    limit = message.get("limit", 100)
+    if not isinstance(limit, int) or not 1 <= limit <= 5000:
+        return {"type": "error", "message": "limit phải trong khoảng 1..5000"}
+    since = message.get("since")
+    try:
+        rows, source = await run_in_threadpool(
+            query_sensor_data, mqtt_service.hot_series, parts[1], int(parts[2]), limit, since, None, since is None
+        )
+    except ValueError:
+        return {"type": "error", "message": "since phải là thời điểm ISO 8601"}
+    if rows is None:
+        return {"type": "error", "message": "Không đọc được sensor data"}
+    if since is None:
+        rows.reverse()
+    return {"type": "history", "topic": topic, "data": rows, "count": len(rows), "source": source}
+
+
 @router.get("/mqtt/test")
 async def websocket_test_page():
     """Test page cho WebSocket MQTT Bridge"""
@@ -253,7 +351,7 @@ def get_websocket_topics():
     """Lấy thông tin tất cả topics và subscribers"""
     try:
         topics = []
-        for topic in mqtt_websocket_bridge.topic_subscriptions:
+        for topic in mqtt_websocket_bridge.subscriptions.filters():
             topics.append(mqtt_websocket_bridge.get_topic_info(topic))
         return {
             "topics": topics,
@@ -261,3 +359,11 @@ def get_websocket_topics():
         }
     except Exception as e:
         return {"error": f"Failed to get topics: {str(e)}"}
+
+@router.get("/mqtt/stats")
+def get_websocket_stats():
+    """Fan-out MQTT -> WebSocket: inbox, message đã phát, số message bị bỏ (inbox đầy / client chậm)"""
+    try:
+        return mqtt_websocket_bridge.get_stats()
+    except Exception as e:
+        return {"error": f"Failed to get stats: {str(e)}"}
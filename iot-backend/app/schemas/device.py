@@ -22,6 +22,8 @@ class DeviceRegister(BaseModel):
     device_type: DeviceType  # 'master' or 'slave'
     # mac_address: Optional[str] = None
     # device_config: Optional[dict] = {}
+class BulkDeviceRegister(BaseModel):
+    devices: List[DeviceRegister]
 class DeviceUpdateRequest(BaseModel):
     device_token: str
     device_name: str
@@ -44,6 +46,8 @@ class PinConfig(BaseModel):
 class DeviceConfigRequest(BaseModel):
     device_token: str
     pins: List[PinConfig]
+class BulkDeviceConfigRequest(BaseModel):
+    devices: List[DeviceConfigRequest]
 class DeviceResponse(BaseModel):
     id: str
     device_name: str
@@ -1,6 +1,6 @@
 # app/core/security.py
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import List, Optional, Tuple
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from app.config import settings
@@ -64,13 +64,20 @@ def verify_device(token: str) -> Optional[dict]:
         return None
 def create_device_token(user_id: str, device_id: str, device_type: str) -> str:
     """Create JWT token for ESP32 devices"""
-    data = {
-        "sub": device_id,
-        "user_id": user_id,
-        "device_type": device_type,
-        "type": "device_token"
-    }
-    return create_access_token(data , timedelta(minutes=settings.ACCESS_TOKEN_DEVICE_MINUTES))
+    return create_device_tokens(user_id, [(device_id, device_type)])[0]
+
+def create_device_tokens(user_id: str, devices: List[Tuple[str, str]]) -> List[str]:
+    """JWT cho nhiều thiết bị của 1 user - devices: [(device_id, device_type)], hạn ACCESS_TOKEN_DEVICE_MINUTES"""
+    expires_delta = timedelta(minutes=settings.ACCESS_TOKEN_DEVICE_MINUTES)
+    return [
+        create_access_token({
+            "sub": device_id,
+            "user_id": user_id,
+            "device_type": device_type,
+            "type": "device_token"
+        }, expires_delta)
+        for device_id, device_type in devices
+    ]
 
 def verify_device_token(token: str) -> Optional[dict]:
     """Verify ESP32 device token"""
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+Lưu trữ sensor_data cũ ra file segment dạng cột, nén - bảng sensor_data không phình mãi,
+lịch sử cũ đọc từ đĩa thay vì Supabase (egress)
+
+Mỗi thiết bị mỗi ngày (UTC) 1 file <root>/<token_verify>/<YYYY-MM-DD>.seg, chỉ ghi nối thêm.
+File là chuỗi block, mỗi lần xuất ghi thêm block:
+    header BLOCK_HEADER: magic, count, first_ms, last_ms, comp_len, crc32 (của body)
+    body zlib: virtual_pin uint16[count] | delta timestamp ms uint32[count]
+               | delta id int64[count] | value float32[count]
+               | độ dài value_string uint32[count] (NULL_STRING = null) | value_string utf-8 nối liền
+Row trong block sắp theo (created_at, id); delta timestamp tính từ first_ms, delta id tính từ 0.
+Đọc bằng mmap: block nằm ngoài khoảng cần đọc bị bỏ qua theo header, không giải nén.
+Block hỏng / ghi dở (sai magic, thiếu byte, crc sai) -> bỏ phần còn lại của file đó.
+Cùng id xuất hiện 2 lần (xuất lại sau khi dừng giữa chừng) -> chỉ giữ 1.
+
+watermark: mọi row có created_at < watermark đã nằm trong segment (và được xóa khỏi database).
+"""
+
+import mmap
+import os
+import struct
+import threading
+import zlib
+from datetime import datetime, timedelta, timezone
+import numpy as np
+
+TAG = "SENSOR_ARCHIVE"
+
+MAGIC = b"SSG2"
+NULL_STRING = 0xFFFFFFFF
+BLOCK_HEADER = struct.Struct("<4sIqqII")
+WATERMARK_FILE = "WATERMARK"
+SEGMENT_SUFFIX = ".seg"
+ZLIB_LEVEL = 6
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+ONE_MS = timedelta(milliseconds=1)
+
+
+def iso_to_ms(created_at):
+    """ISO 8601 -> mili giây epoch (số nguyên, không sai số float)"""
+    moment = datetime.fromisoformat(created_at)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return (moment - EPOCH) // ONE_MS
+
+
+def ms_to_iso(ms):
+    return (EPOCH + timedelta(milliseconds=int(ms))).isoformat()
+
+
+def day_of(ms):
+    return (EPOCH + timedelta(milliseconds=int(ms))).strftime("%Y-%m-%d")
+
+
+def encode_block(pins, timestamps_ms, ids, values, strings=None):
+    """1 block (header + body nén). Mọi timestamp phải cùng 1 ngày UTC. strings: value_string (None = null)"""
+    ts = np.asarray(timestamps_ms, dtype=np.int64)
+    ids = np.asarray(ids, dtype=np.int64)
+    order = np.lexsort((ids, ts))
+    ts, ids = ts[order], ids[order]
+    pins = np.asarray(pins, dtype=np.uint16)[order]
+    values = np.asarray(values, dtype=np.float64)[order].astype(np.float32)    # None -> NaN
+    if ts[-1] - ts[0] > 0xFFFFFFFF:
+        raise ValueError("block vượt quá 1 ngày")
+    encoded = [None if strings is None or strings[i] is None else strings[i].encode('utf-8') for i in order.tolist()]
+    lengths = np.array([NULL_STRING if item is None else len(item) for item in encoded], dtype=np.uint32)
+    body = zlib.compress(
+        pins.tobytes()
+        + np.diff(ts, prepend=ts[0]).astype(np.uint32).tobytes()
+        + np.diff(ids, prepend=0).tobytes()
+        + values.tobytes()
+        + lengths.tobytes()
+        + b"".join(item for item in encoded if item),
+        ZLIB_LEVEL
+    )
+    return BLOCK_HEADER.pack(MAGIC, ts.size, int(ts[0]), int(ts[-1]), len(body), zlib.crc32(body)) + body
+
+
+def decode_block(count, first_ms, body):
+    """body đã kiểm crc -> (pins, timestamps_ms, ids, values float32, value_string object[])"""
+    raw = zlib.decompress(body)
+    pins = np.frombuffer(raw, np.uint16, count, 0)
+    offset = 2 * count
+    ts = first_ms + np.cumsum(np.frombuffer(raw, np.uint32, count, offset), dtype=np.int64)
+    offset += 4 * count
+    ids = np.cumsum(np.frombuffer(raw, np.int64, count, offset))
+    offset += 8 * count
+    values = np.frombuffer(raw, np.float32, count, offset)
+    offset += 4 * count
+    strings = np.full(count, None, dtype=object)
+    lengths = np.frombuffer(raw, np.uint32, count, offset).tolist()
+    offset += 4 * count
+    for i, length in enumerate(lengths):
+        if length != NULL_STRING:
+            strings[i] = raw[offset:offset + length].decode('utf-8')
+            offset += length
+    return pins, ts, ids, values, strings
+
+
+def _empty():
+    return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32),
+            np.empty(0, dtype=object))
+
+
+class SegmentArchive:
+    """Thư mục segment của toàn bộ thiết bị + watermark"""
+
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()          # 1 luong ghi tai 1 thoi diem
+        self._watermark = None
+        self._watermark_loaded = False
+        # bo dem
+        self.rows_written = 0
+        self.blocks_written = 0
+        self.blocks_read = 0
+        self.blocks_skipped = 0
+        self.corrupt_blocks = 0
+
+    def _device_dir(self, token_verify):
+        if not token_verify or os.sep in token_verify or token_verify.startswith("."):
+            raise ValueError(f"token_verify không hợp lệ: {token_verify!r}")
+        return os.path.join(self.root, token_verify)
+
+    @property
+    def watermark(self):
+        """ms epoch, None nếu chưa xuất lần nào"""
+        if not self._watermark_loaded:
+            try:
+                with open(os.path.join(self.root, WATERMARK_FILE)) as f:
+                    self._watermark = int(f.read().strip())
+            except FileNotFoundError:
+                self._watermark = None
+            self._watermark_loaded = True
+        return self._watermark
+
+    def set_watermark(self, ms):
+        os.makedirs(self.root, exist_ok=True)
+        path = os.path.join(self.root, WATERMARK_FILE)
+        with open(path + ".tmp", "w") as f:
+            f.write(str(int(ms)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        self._watermark, self._watermark_loaded = int(ms), True
+
+    def append(self, token_verify, pins, timestamps_ms, ids, values, strings=None):
+        """
+        Ghi nối thêm các row của 1 thiết bị (tách theo ngày UTC, mỗi ngày 1 block). Trả về số block
+        strings: value_string của từng row (None = null)
+        """
+        ts = np.asarray(timestamps_ms, dtype=np.int64)
+        if ts.size == 0:
+            return 0
+        pins, ids, values = np.asarray(pins), np.asarray(ids), np.asarray(values, dtype=np.float64)
+        strings = np.array(strings if strings is not None else [None] * ts.size, dtype=object)
+        days = ts // 86400000
+        directory = self._device_dir(token_verify)
+        blocks = 0
+        with self._lock:
+            os.makedirs(directory, exist_ok=True)
+            for day in np.unique(days).tolist():
+                mask = days == day
+                block = encode_block(pins[mask], ts[mask], ids[mask], values[mask], strings[mask])
+                with open(os.path.join(directory, day_of(day * 86400000) + SEGMENT_SUFFIX), "ab") as f:
+                    f.write(block)
+                    f.flush()
+                    os.fsync(f.fileno())
+                blocks += 1
+            self.blocks_written += blocks
+            self.rows_written += ts.size
+        return blocks
+
+    def read(self, token_verify, virtual_pin, start_ms, end_ms, cursor=None, descending=False, limit=None,
+             with_strings=False):
+        """
+        Row của pin trong [start_ms, end_ms) sắp theo (timestamp, id) (descending: ngược lại)
+        cursor: (ms, id) của row cuối trang trước - chỉ lấy row sau nó theo thứ tự đọc
+        Trả về (timestamps_ms, ids, values float32) - with_strings: thêm value_string (object[]);
+        đọc tới khi đủ limit row thì dừng
+        """
+        directory = self._device_dir(token_verify)
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return _empty()
+        if cursor is not None:
+            # bo qua file / block truoc cursor (trang sau khong giai nen lai tu dau khoang)
+            if descending:
+                end_ms = min(end_ms, cursor[0] + 1)
+            else:
+                start_ms = max(start_ms, cursor[0])
+        first_day, last_day = day_of(start_ms), day_of(max(start_ms, end_ms - 1))
+        files = sorted((name for name in names
+                        if name.endswith(SEGMENT_SUFFIX) and first_day <= name[:-len(SEGMENT_SUFFIX)] <= last_day),
+                       reverse=descending)
+        parts, total = [], 0
+        for name in files:
+            ts, ids, values, strings = self._read_file(os.path.join(directory, name), virtual_pin, start_ms, end_ms)
+            if cursor is not None and ts.size:
+                if descending:
+                    mask = (ts < cursor[0]) | ((ts == cursor[0]) & (ids < cursor[1]))
+                else:
+                    mask = (ts > cursor[0]) | ((ts == cursor[0]) & (ids > cursor[1]))
+                ts, ids, values, strings = ts[mask], ids[mask], values[mask], strings[mask]
+            if descending:
+                ts, ids, values, strings = ts[::-1], ids[::-1], values[::-1], strings[::-1]
+            parts.append((ts, ids, values, strings))
+            total += ts.size
+            if limit is not None and total >= limit:
+                break
+        columns = [np.concatenate(column) for column in zip(*parts)] if parts else list(_empty())
+        if limit is not None:
+            columns = [column[:limit] for column in columns]
+        return tuple(columns) if with_strings else tuple(columns[:3])
+
+    def _read_file(self, path, virtual_pin, start_ms, end_ms):
+        parts = []
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return _empty()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                offset = 0
+                while offset < size:
+                    body_at = offset + BLOCK_HEADER.size
+                    if body_at > size:
+                        self._corrupt(path, offset)
+                        break
+                    magic, count, first_ms, last_ms, comp_len, crc = BLOCK_HEADER.unpack_from(mm, offset)
+                    if magic != MAGIC or body_at + comp_len > size:
+                        self._corrupt(path, offset)
+                        break
+                    offset = body_at + comp_len
+                    if last_ms < start_ms or first_ms >= end_ms:
+                        self.blocks_skipped += 1
+                        continue
+                    body = mm[body_at:offset]
+                    if zlib.crc32(body) != crc:
+                        self._corrupt(path, body_at - BLOCK_HEADER.size)
+                        break
+                    self.blocks_read += 1
+                    pins, ts, ids, values, strings = decode_block(count, first_ms, body)
+                    mask = (pins == virtual_pin) & (ts >= start_ms) & (ts < end_ms)
+                    parts.append((ts[mask], ids[mask], values[mask], strings[mask]))
+        if not parts:
+            return _empty()
+        ts, ids, values, strings = (np.concatenate(column) for column in zip(*parts))
+        ids, first = np.unique(ids, return_index=True)             # bo row xuat trung
+        ts, values, strings = ts[first], values[first], strings[first]
+        order = np.lexsort((ids, ts))
+        return ts[order], ids[order], values[order], strings[order]
+
+    def _corrupt(self, path, offset):
+        self.corrupt_blocks += 1
+        print(TAG + f" Block hỏng {path} @ {offset} - bỏ phần còn lại của file")
+
+    def stats(self):
+        watermark = self.watermark
+        return {
+            "root": self.root,
+            "watermark": ms_to_iso(watermark) if watermark is not None else None,
+            "rows_written": self.rows_written,
+            "blocks_written": self.blocks_written,
+            "blocks_read": self.blocks_read,
+            "blocks_skipped": self.blocks_skipped,
+            "corrupt_blocks": self.corrupt_blocks,
+        }
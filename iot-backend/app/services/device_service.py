@@ -1 +1,396 @@
-# Device management
\ No newline at end of file
+# Device management
+# app/services/device_service.py
+import secrets
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Iterable, List, Optional, Tuple
+from app.database import db
+from app.security import create_device_tokens, verify_device_token
+
+TAG = "DEVICE_SERVICE"
+MAX_BULK_ITEMS = 500
+PIN_CONFLICT = "device_token,virtual_pin"
+
+
+class DeviceAuthCache:
+    """
+    Cache xác thực thiết bị cho MQTT CONNECT, key = token_verify
+
+    Không có cache: mỗi CONNECT = 1 select Supabase + 1 lần decode JWT. Broker khởi
+    động lại -> hàng nghìn ESP32 kết nối lại cùng lúc và xếp hàng chờ HTTP.
+    - TTL + LRU: entry sống tối đa ttl giây, giữ tối đa max_size thiết bị
+    - Cache âm: token không tồn tại / JWT không hợp lệ được nhớ negative_ttl giây
+      (thiết bị sai token gửi CONNECT liên tục không dội thẳng vào database)
+    - warm(): nạp toàn bộ devices bằng 1 query khi broker khởi động
+    - invalidate(): gọi khi /devices/updateDevice, /devices/registerDevide... đổi thiết bị
+    """
+
+    def __init__(self, ttl: float = 300.0, negative_ttl: float = 10.0, max_size: int = 10000):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()      # {token_verify: (device, data_device, expires_at)}
+        self._by_device_token = {}         # {device_token: token_verify} - de invalidate theo device_token
+        self._lock = threading.Lock()
+        self._generation = 0               # tang moi lan invalidate - ket qua query cu khong duoc ghi de len
+        # bo dem
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def authenticate(self, token_verify: str) -> Tuple[Optional[dict], Optional[dict]]:
+        """
+        Trả về (device, data_device) giống luồng cũ của handle_connect:
+        device = hàng trong bảng devices (None nếu không có),
+        data_device = kết quả verify_device_token (None nếu không hợp lệ)
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(token_verify)
+            if entry is not None and entry[2] > now:
+                self._entries.move_to_end(token_verify)
+                if entry[1] is None:
+                    self.negative_hits += 1
+                else:
+                    self.hits += 1
+                return entry[0], entry[1]
+            self.misses += 1
+            generation = self._generation
+
+        devices = db.execute_query(
+            table="devices",
+            operation="select",
+            filters={"token_verify": token_verify}
+        )
+        if devices is None:
+            # loi database - khong cache de lan sau thu lai
+            return None, None
+        device = devices[0] if devices else None
+        data_device = verify_device_token(device["device_access_token"]) if device else None
+        self._store(token_verify, device, data_device, generation)
+        return device, data_device
+
+    def _store(self, token_verify, device, data_device, generation=None):
+        ttl = self.ttl if data_device is not None else self.negative_ttl
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries[token_verify] = (device, data_device, time.monotonic() + ttl)
+            self._entries.move_to_end(token_verify)
+            if device and device.get("device_token"):
+                self._by_device_token[device["device_token"]] = token_verify
+            while len(self._entries) > self.max_size:
+                old_token, (old_device, _, _) = self._entries.popitem(last=False)
+                if old_device and self._by_device_token.get(old_device.get("device_token")) == old_token:
+                    del self._by_device_token[old_device["device_token"]]
+                self.evictions += 1
+
+    def warm(self) -> int:
+        """Nạp trước mọi thiết bị bằng 1 query. Trả về số thiết bị hợp lệ đã nạp"""
+        devices = db.execute_query(table="devices", operation="select")
+        if not devices:
+            return 0
+        loaded = 0
+        for device in devices[:self.max_size]:
+            token_verify = device.get("token_verify")
+            if not token_verify or not device.get("device_access_token"):
+                continue
+            data_device = verify_device_token(device["device_access_token"])
+            self._store(token_verify, device, data_device)
+            if data_device is not None:
+                loaded += 1
+        print(TAG + f" Đã nạp {loaded}/{len(devices)} thiết bị vào cache xác thực")
+        return loaded
+
+    def invalidate(self, token_verify: Optional[str] = None, device_token: Optional[str] = None):
+        """Xóa entry theo token_verify hoặc device_token (thiết bị vừa được sửa / đăng ký / xóa)"""
+        with self._lock:
+            self._generation += 1
+            if device_token is not None:
+                mapped = self._by_device_token.pop(device_token, None)
+                if mapped is not None:
+                    self._entries.pop(mapped, None)
+            if token_verify is not None:
+                entry = self._entries.pop(token_verify, None)
+                if entry and entry[0] and entry[0].get("device_token"):
+                    self._by_device_token.pop(entry[0]["device_token"], None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._by_device_token.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class PinRegistry:
+    """
+    Cấu hình pin trong bộ nhớ, {device_token: {virtual_pin: {pin_type, data_type, pin_label}}}
+
+    Kiểm tra pin INPUT (SS/) / OUTPUT (/mqtt/device-command) không còn select device_pins
+    cho mỗi message: pin của 1 thiết bị được nạp cả loạt bằng 1 query (khi thiết bị
+    CONNECT hoặc lần tra đầu tiên) và nạp lại khi /devices/configPin ghi cấu hình mới.
+    Thiết bị đã nạp mà không có pin -> trả None luôn, không hỏi lại database.
+    Nạp lại / bỏ 1 thiết bị = 1 thao tác dict, không quét pin của thiết bị khác.
+    """
+
+    def __init__(self):
+        self._devices = {}                 # {device_token: {virtual_pin: pin}} - chi thiet bi da nap day du
+        self._lock = threading.Lock()
+        # bo dem
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+
+    def load_device(self, device_token: str, force: bool = False) -> Optional[int]:
+        """Nạp mọi pin của thiết bị bằng 1 query. Trả về số pin, None nếu lỗi database"""
+        if not force and device_token in self._devices:
+            return None
+        rows = db.execute_query(
+            table="device_pins",
+            operation="select",
+            filters={"device_token": device_token}
+        )
+        if rows is None:
+            if force:
+                # cấu hình cũ có thể đã sai - lần tra sau hỏi lại database
+                self.invalidate(device_token)
+            return None
+        self._replace([device_token], rows)
+        return len(rows)
+
+    def load_devices(self, device_tokens: Iterable[str]) -> Optional[int]:
+        """Nạp lại pin của nhiều thiết bị bằng 1 query (filter in). Trả về số pin, None nếu lỗi database"""
+        device_tokens = list(device_tokens)
+        if not device_tokens:
+            return 0
+        rows = db.execute_query(
+            table="device_pins",
+            operation="select",
+            filters={"device_token": device_tokens}
+        )
+        if rows is None:
+            for device_token in device_tokens:
+                self.invalidate(device_token)
+            return None
+        self._replace(device_tokens, rows)
+        return len(rows)
+
+    def _replace(self, device_tokens, rows):
+        fresh = {device_token: {} for device_token in device_tokens}
+        for row in rows:
+            fresh.setdefault(row["device_token"], {})[int(row["virtual_pin"])] = {
+                "pin_type": row.get("pin_type"),
+                "data_type": row.get("data_type"),
+                "pin_label": row.get("pin_label"),
+            }
+        with self._lock:
+            self._devices.update(fresh)
+            self.loads += 1
+
+    def get(self, device_token: str, virtual_pin: int) -> Optional[dict]:
+        """Cấu hình của pin, None nếu thiết bị không có pin này"""
+        virtual_pin = int(virtual_pin)
+        with self._lock:
+            pins = self._devices.get(device_token)
+            if pins is not None:
+                self.hits += 1
+                return pins.get(virtual_pin)
+            self.misses += 1
+        self.load_device(device_token, force=True)
+        return self.peek(device_token, virtual_pin)
+
+    def peek(self, device_token: str, virtual_pin: int) -> Optional[dict]:
+        """Như get() nhưng không bao giờ hỏi database - dùng trên luồng publish"""
+        with self._lock:
+            pins = self._devices.get(device_token)
+            return pins.get(int(virtual_pin)) if pins is not None else None
+
+    def invalidate(self, device_token: str):
+        """Bỏ pin của thiết bị (thiết bị bị xóa) - lần tra sau nạp lại từ database"""
+        with self._lock:
+            self._devices.pop(device_token, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            pins = sum(len(device_pins) for device_pins in self._devices.values())
+        return {
+            "devices": len(self._devices),
+            "pins": pins,
+            "hits": self.hits,
+            "misses": self.misses,
+            "loads": self.loads,
+        }
+
+
+# Global cache instance
+device_auth_cache = DeviceAuthCache()
+pin_registry = PinRegistry()
+
+
+def new_device_token() -> str:
+    """device_token của thiết bị mới - nơi duy nhất sinh device_token (không dùng default của database)"""
+    return str(uuid.uuid4())
+
+
+def bulk_size_error(items) -> Optional[str]:
+    """Lỗi số lượng item của request hàng loạt, None nếu hợp lệ"""
+    if not items or len(items) > MAX_BULK_ITEMS:
+        return f"devices must contain 1..{MAX_BULK_ITEMS} items"
+    return None
+
+
+def bulk_response(results) -> dict:
+    """Response của request hàng loạt: tổng hợp + kết quả từng item (success chỉ True khi mọi item thành công)"""
+    succeeded = sum(1 for result in results if result["success"])
+    return {
+        "success": succeeded == len(results),
+        "count": len(results),
+        "succeeded": succeeded,
+        "failed": len(results) - succeeded,
+        "results": results
+    }
+
+
+def create_device(user_id, item) -> dict:
+    """Đăng ký 1 thiết bị - cùng đường ghi với bulk_register_devices. Trả về kết quả của item"""
+    return bulk_register_devices(user_id, [item])[0]
+
+
+def bulk_register_devices(user_id, items) -> List[dict]:
+    """
+    Đăng ký nhiều thiết bị: 1 select (tên đã dùng) + 1 insert cả lô
+    device_token sinh sẵn (new_device_token) nên JWT + token_verify ghi luôn trong insert,
+    không còn select / insert / update cho từng thiết bị
+    Kết quả theo thứ tự items: {index, device_name, success, message, device?}
+    Raise RuntimeError nếu database lỗi khi kiểm tra tên
+    """
+    existing = db.execute_query(
+        table="devices",
+        operation="select",
+        columns="device_name",
+        filters={"user_id": user_id}
+    )
+    if existing is None:
+        raise RuntimeError("database error")
+    taken = {device["device_name"] for device in existing}
+    results, accepted, requested = [], [], set()
+    for index, item in enumerate(items):
+        result = {"index": index, "device_name": item.device_name, "success": False}
+        results.append(result)
+        if not item.device_name.strip():
+            result["message"] = "Device name is required"
+        elif item.device_name in taken:
+            result["message"] = "Device name already exists"
+        elif item.device_name in requested:
+            result["message"] = "Device name appears more than once in request"
+        else:
+            requested.add(item.device_name)
+            accepted.append((result, item))
+    if not accepted:
+        return results
+
+    device_tokens = [new_device_token() for _ in accepted]
+    access_tokens = create_device_tokens(
+        str(user_id), [(device_token, item.device_type.value) for device_token, (_, item) in zip(device_tokens, accepted)]
+    )
+    rows = [{
+        "user_id": user_id,
+        "device_name": item.device_name,
+        "device_type": item.device_type.value,
+        "device_token": device_token,
+        "device_access_token": access_token,
+        "token_verify": secrets.token_hex(16),
+    } for device_token, access_token, (_, item) in zip(device_tokens, access_tokens, accepted)]
+    inserted = db.execute_query(table="devices", operation="insert", data=rows)
+    if inserted is None:
+        for result, _ in accepted:
+            result["message"] = "Failed to create device"
+        return results
+
+    by_token = {device["device_token"]: device for device in inserted}
+    for (result, _), row in zip(accepted, rows):
+        device = by_token.get(row["device_token"], row)
+        # token_verify mới có thể đang nằm trong cache âm
+        device_auth_cache.invalidate(token_verify=row["token_verify"], device_token=row["device_token"])
+        result.update(success=True, message="Device registered successfully", device={
+            "id": device.get("id"),
+            "device_name": row["device_name"],
+            "device_type": row["device_type"],
+            "device_token": row["device_token"],
+            "device_access_token": row["device_access_token"],
+            "token_verify": row["token_verify"],
+        })
+    print(TAG + f" Đăng ký {len(rows)}/{len(results)} thiết bị bằng 1 insert")
+    return results
+
+
+def bulk_config_pins(user_id, items) -> List[dict]:
+    """
+    Cấu hình pin cho nhiều thiết bị: 1 select (thiết bị của user) + 1 upsert device_pins
+    (on_conflict device_token,virtual_pin - unique index trong migrations/001_device_pins_unique.sql)
+    + 1 select nạp lại pin_registry
+    Kiểm tra mọi item trước khi ghi; item lỗi bị bỏ qua, các item hợp lệ ghi chung 1 lần
+    Kết quả theo thứ tự items: {index, device_token, success, message, pins}
+    Raise RuntimeError nếu database lỗi khi đọc thiết bị
+    """
+    devices = db.execute_query(
+        table="devices",
+        operation="select",
+        columns="device_token,device_type",
+        filters={"user_id": user_id}
+    )
+    if devices is None:
+        raise RuntimeError("database error")
+    device_types = {str(device["device_token"]): device["device_type"] for device in devices}
+    results, accepted, rows, seen = [], [], [], set()
+    for index, item in enumerate(items):
+        result = {"index": index, "device_token": item.device_token, "success": False, "pins": len(item.pins)}
+        results.append(result)
+        pins = [pin.virtual_pin for pin in item.pins]
+        if item.device_token not in device_types:
+            result["message"] = "Device not found"
+        elif device_types[item.device_token] == "MASTER":
+            result["message"] = "Master device cannot be configured"
+        elif item.device_token in seen:
+            result["message"] = "Device appears more than once in request"
+        elif len(set(pins)) != len(pins):
+            result["message"] = "Duplicate virtual_pin"
+        else:
+            seen.add(item.device_token)
+            accepted.append(result)
+            rows.extend({
+                "device_token": item.device_token,
+                "virtual_pin": pin.virtual_pin,
+                "pin_label": pin.pin_label,
+                "pin_type": pin.pin_type.value,
+                "data_type": pin.data_type.value,
+                "ai_keywords": pin.ai_keywords if pin.pin_type.value == "OUTPUT" else ""
+            } for pin in item.pins)
+    if not accepted:
+        return results
+
+    written = db.execute_query(table="device_pins", operation="upsert", data=rows, on_conflict=PIN_CONFLICT) \
+        if rows else []
+    if written is None:
+        print(TAG + f" ❌ Upsert device_pins lỗi - kiểm tra unique index ({PIN_CONFLICT}) đã chạy migration chưa")
+    for result in accepted:
+        if written is None:
+            result["message"] = "Failed to update device pins"
+        else:
+            result.update(success=True, message="Device Updated successfully")
+    # nạp lại cấu hình pin cho MQTT (SS/ và device-command tra trong bộ nhớ)
+    pin_registry.load_devices(result["device_token"] for result in accepted)
+    return results
@@ -6,13 +6,29 @@ import struct
 import threading
 import json
 import time
+from datetime import datetime, timezone
 from typing import Dict, List, Callable, Optional
 from unittest import result
-from app.broker_server import TAG, TOPIC_CONTRO, TOPIC_SENSOR , SimpleMQTTBroker
-from app.database import db
+from app.broker_server import TAG, TOPIC_CONTRO, TOPIC_SENSOR , MAX_QOS, SimpleMQTTBroker
+from app.mqtt_protocol import CONNACK_IDENTIFIER_REJECTED, PUBLISH_RETAIN, build_connack, parse_publish, publish_qos
+from app.async_broker_server import AsyncMQTTBroker
+from app.database import db, async_db
 from app.mqtt_client import SimpleMQTTClient
-from app.security import verify_device_token
+from app.services.device_service import device_auth_cache, pin_registry
+from app.services.sensor_service import SensorIngestPipeline, SensorRollups
+from app.hot_series import HotSeriesStore
+from app.topic_tree import TopicTree
 TAG = "MQTT_SERVICE"
+# engine broker: "thread" = 1 thread / 1 socket, "asyncio" = 1 event loop cho mọi kết nối
+BROKER_ENGINES = {
+    "thread": SimpleMQTTBroker,
+    "asyncio": AsyncMQTTBroker,
+}
+
+
+def numeric_value(message: str) -> float:
+    """value_numeric của sensor_data: message là số không âm thì lấy số, ngược lại 0"""
+    return float(message) if message.replace('.', '', 1).isdigit() else 0
 
 class MQTTService:
     """
@@ -33,6 +49,22 @@ class MQTTService:
         self.running = False
         self.client_running = False
         self.device_tokens = {}     # {device_token: device_info}
+        self._status_updates = {}   # {client_id: Future} - lan cap nhat connection_status gan nhat
+        self._status_lock = threading.Lock()
+        # SS/ -> sensor_data ghi theo lô trên worker riêng, không chặn luồng publish
+        # rollup 1m / 1h cộng dồn sau khi lô insert thành công, bucket đóng được ghi vào sensor_rollups
+        self.sensor_rollups = SensorRollups()
+        self.sensor_pipeline = SensorIngestPipeline(prepare=self._prepare_sensor_rows,
+                                                    on_tick=self.sensor_rollups.collect,
+                                                    on_inserted=self.sensor_rollups.add_rows)
+        # N reading gần nhất mỗi pin trong bộ nhớ - dashboard không phải hỏi Supabase
+        self.hot_series = HotSeriesStore()
+        # handler theo topic filter (+ / #) - chạy trên thread của broker, phải nhanh và thread-safe
+        # (WebSocket bridge chỉ đẩy message vào hàng đợi của event loop)
+        # đếm tham chiếu: mỗi add cần 1 remove, handler bị gỡ khi về 0
+        self.message_handlers = TopicTree()
+        self._handler_refs = {}     # {(topic_filter, handler): so lan dang ky}
+        self._handlers_lock = threading.Lock()
 
     def start_client(self , host='localhost', port=1883 , token = "client-1"):
         if self.client_running : 
@@ -46,15 +78,25 @@ class MQTTService:
         )
         self.client_thread.start()
 
-    def start_broker(self, host='localhost', port=1883):
+    def start_broker(self, host='localhost', port=1883, engine="thread", **broker_options):
 
-        """Khởi động MQTT Broker trong thread riêng"""
+        """
+        Khởi động MQTT Broker trong thread riêng
+        broker_options: max_queue, overflow_policy (drop_oldest | drop_newest | disconnect),
+                        max_inflight, retry_interval, max_retries (QoS 1),
+                        retained_path, snapshot_interval (retained message),
+                        session_expiry, max_offline, max_sessions (session bền clean_session=0)
+                        max_packet_size (byte, packet lớn hơn -> ngắt kết nối)
+        """
         if self.running:
             print(TAG + "⚠️ MQTT Broker đã đang chạy")
             return
-            
-        self.broker = SimpleMQTTBroker(host, port)
+        if engine not in BROKER_ENGINES:
+            raise ValueError(f"Engine broker không hợp lệ: {engine} (chọn {list(BROKER_ENGINES)})")
+
+        self.broker = BROKER_ENGINES[engine](host, port, **broker_options)
         self.running = True
+        self.sensor_pipeline.start()
         
         # Chạy broker trong thread riêng để không block FastAPI
         self.broker_thread = threading.Thread(
@@ -63,7 +105,7 @@ class MQTTService:
         )
         self.broker_thread.start()
         
-        print(f"🚀 MQTT Service đã khởi động tại {host}:{port}")
+        print(f"🚀 MQTT Service đã khởi động tại {host}:{port} (engine={engine})")
         
     def _run_client(self):
         try:
@@ -83,6 +125,8 @@ class MQTTService:
             self.broker.handle_connect = self.handle_connect
             self.broker.handle_connected = self.handle_connected
             self.broker.handle_disconect = self.handle_disconect
+            # Nạp trước cache xác thực: ESP32 kết nối lại hàng loạt không phải chờ Supabase
+            device_auth_cache.warm()
             self.broker.start()
         except Exception as e:
             print(TAG + f"❌ Lỗi chạy MQTT Broker: {e}")
@@ -92,37 +136,27 @@ class MQTTService:
 
     def handle_connect(self, client_socket, payload, address) : 
         try:
-            # Parse client ID từ payload (simplified parsing)   
-            # Thực tế MQTT CONNECT packet phức tạp hơn nhiều
+            # Parse đầy đủ CONNECT - client id (token_verify) đúng cả khi có will / username / password
             print(TAG + f"ket noi tu client {client_socket} {address}")
-            client_id = payload[12:12+len(payload)].decode('utf-8') # Đơn giản hóa\
-            if not client_id :
-                print(TAG + f"loi roi ket noi do client_id None")
-                return
-            device = db.execute_query(
-                table="devices",
-                operation="select",
-                filters={"token_verify" : client_id.strip()}
-            )
+            connect = self.broker.decode_connect(client_socket, payload)
+            if connect is None:
+                return None
+            client_id = connect.client_id
+            # Tra cache trước, chỉ query database khi miss / hết hạn
+            device, data_device = device_auth_cache.authenticate(client_id.strip())
             print(TAG + f" device {device} token_verify-{repr(client_id)}")
-            if not device : 
-                data_device = None
-            else:
-                
-                data_device = verify_device_token(device[0]["device_access_token"])
 
             if(data_device is None): 
-                connack = bytes([0x20, 0x02, 0x00, 0x02])  # CONNACK với return code 2 tức là client id không hợp lệ 
+                connack = build_connack(CONNACK_IDENTIFIER_REJECTED)  # CONNACK với return code 2 tức là client id không hợp lệ 
                 client_socket.send(connack)
                 return None
             else:
             # *** LƯU CLIENT VÀO 'BỘ NHỚ' BROKER ***
-                self.broker.clients[client_id] = client_socket
-                self.broker.client_subscriptions[client_socket] = []
-                self.device_tokens[client_id] = device[0]
-                # Gửi CONNACK - "Chào lại, kết nối thành công!"
-                connack = bytes([0x20, 0x02, 0x00, 0x00])  # CONNACK với return code 0
-                client_socket.send(connack)
+                self.device_tokens[client_id] = device
+                # nạp cấu hình pin 1 lần - SS/ và device-command tra trong bộ nhớ
+                pin_registry.load_device(device["device_token"])
+                # Gửi CONNACK - "Chào lại, kết nối thành công!" + phát lại message offline nếu clean_session = 0
+                self.broker.register_client(client_socket, client_id, connect.clean_session, connect.keep_alive)
                 self.handle_connected(client_socket , client_id)
                 return client_id
 
@@ -131,30 +165,43 @@ class MQTTService:
             return None
 
     def handle_connected(self ,client_socket , client_id ):
-        result = db.execute_query(
-            table="devices",
-            operation="update",
-            data={"connection_status": "ONLINE"},
-            filters={"token_verify": client_id}
-        )
-        if not result :
-            print(TAG + f'Khong the chuyen thiet bi sang ON')
+        self._set_connection_status(client_id, "ONLINE")
 
     def handle_disconect(self , client_socket, client_id):
         """
             -khong chac hoat dong
             -mac du da dung _handle_device_status 
         """
-        result = db.execute_query(
-            table="devices",
-            operation="update",
-            data={"connection_status": "OFFLINE"},
-            filters={"token_verify": client_id}
-        )
+        self._set_connection_status(client_id, "OFFLINE")
+
+    def _set_connection_status(self, client_id, connection_status):
+        """
+        Cập nhật connection_status trên loop của FastAPI (async_db) - thread của broker
+        không chờ Supabase. Các lần cập nhật của cùng client chạy đúng thứ tự.
+        Chưa có loop (chạy broker ngoài FastAPI) -> gọi đồng bộ như cũ
+        """
+        filters = {"token_verify": client_id}
+        data = {"connection_status": connection_status}
+        with self._status_lock:
+            future = async_db.submit("devices", "update", data, filters, after=self._status_updates.get(client_id))
+            if future is not None:
+                self._status_updates[client_id] = future
+                future.add_done_callback(lambda f: self._status_done(client_id, f, connection_status))
+                return
+        self._status_done(client_id, None, connection_status, db.execute_query(
+            table="devices", operation="update", data=data, filters=filters
+        ))
+
+    def _status_done(self, client_id, future, connection_status, result=None):
+        if future is not None:
+            with self._status_lock:
+                if self._status_updates.get(client_id) is future:
+                    del self._status_updates[client_id]
+            result = None if future.cancelled() or future.exception() else future.result()
         if not result :
-            print(TAG + f'Khong the chuyen thiet bi sang OFF')
+            print(TAG + f'Khong the chuyen thiet bi {client_id} sang {connection_status}')
 
-    def _enhanced_handle_publish(self, client_socket, payload):
+    def _enhanced_handle_publish(self, client_socket, payload, flags=0):
         """
         Enhanced publish handler - Tích hợp với database
         
@@ -163,20 +210,19 @@ class MQTTService:
         2. Lưu vào database nếu là sensor data
         3. Gọi message handlers
         4. Forward cho subscribers
+        5. PUBACK cho publisher nếu QoS 1
         """
         try:
-            # Parse MQTT packet
-            if len(payload) < 2:
-                return
-                
-            topic_len = struct.unpack(">H", payload[0:2])[0]
-            if len(payload) < 2 + topic_len:
-                return
-                
-            topic = payload[2:2+topic_len].decode('utf-8')
-            message = payload[2+topic_len:].decode('utf-8')
+            # Parse MQTT packet (packet id chỉ có khi QoS > 0)
+            qos = publish_qos(flags)
+            topic, packet_id, message = parse_publish(payload, flags)
+            message = message.decode('utf-8')
             
             print(f"📨 MQTT Message: {topic} -> {message}")
+            # chi giu message co co RETAIN (nhu SimpleMQTTBroker.handle_publish); lenh CT/ tu HOST
+            # da retain trong publish_message_CT
+            if flags & PUBLISH_RETAIN:
+                self.broker.retain_message(topic, message, qos)
             
             # Xử lý sensor data
             if topic.startswith(TOPIC_SENSOR):
@@ -186,69 +232,63 @@ class MQTTService:
             # elif topic.startswith("device/"):
             #     self._handle_device_status(topic, message)
                 
-            # Gọi custom handlers
-            # self._call_message_handlers(topic, message)
+            # Gọi custom handlers (WebSocket bridge)
+            self._call_message_handlers(topic, message)
             
-            # Forward cho subscribers (original logic)
-            if topic in self.broker.subscriptions:
-                subscribers = self.broker.subscriptions[topic]
-                publish_packet = self.broker.create_publish_packet(topic, message)
-                
-                for subscriber_socket in subscribers:
-                    try:
-                        subscriber_socket.send(publish_packet)
-                    except Exception as e:
-                        print(TAG + f"❌ Không thể gửi đến subscriber: {e}")
+            # Forward cho subscribers (khớp cả wildcard + / #)
+            self.broker.route_message(topic, message, min(qos, MAX_QOS))
+            self.broker.acknowledge_publish(client_socket, qos, packet_id)
                         
         except Exception as e:
             print(f"❌ Lỗi xử lý MQTT message: {e}")
             
     def _handle_sensor_data(self, topic: str, message: str):
-        
-        """Xử lý sensor data từ MQTT"""
+        """
+        Xử lý sensor data từ MQTT: ghi vào hot tier (pin INPUT đã có trong pin_registry)
+        rồi đưa reading vào hàng đợi ghi theo lô (kiểm tra device_pin + insert chạy trên worker)
+        """
         try:
-            # Parse topic: SS/{device_token}/{virtual_pin}
+            # Parse topic: SS/{token_verify}/{virtual_pin}
             parts = topic.split('/')
             if len(parts) >= 3:
-                token_verify = parts[1]
-                virtual_pin = int(parts[2])
+                token_verify, virtual_pin, received_at = parts[1], int(parts[2]), time.time()
+                device = self.device_tokens.get(token_verify)
+                pin = pin_registry.peek(device["device_token"], virtual_pin) if device else None
+                if pin and pin["pin_type"] == "INPUT":
+                    self.hot_series.append(token_verify, virtual_pin, received_at, numeric_value(message))
+                self.sensor_pipeline.submit((topic, token_verify, virtual_pin, message, received_at))
+        except Exception as e:
+            print(f"❌ Lỗi xử lý sensor data: {e}")
+
+    def _prepare_sensor_rows(self, readings) -> List[dict]:
+        """
+        Chạy trên worker của sensor_pipeline: kiểm tra device_pin (pin_registry) rồi dựng row sensor_data
+        """
+        rows = []
+        for topic, token_verify, virtual_pin, message, received_at in readings:
+            try:
                 device_token = self.device_tokens[token_verify]["device_token"]
-                result = db.execute_query(
-                    table="device_pins",
-                    operation="select",
-                    filters={"device_token": device_token, "virtual_pin": virtual_pin}
-                )
-                if not result:
+                pin = pin_registry.get(device_token, virtual_pin)
+                if not pin:
                     print(TAG + f" Khoong tim thay device_pin {device_token} {virtual_pin}")
                     self.publish_message_fromHOST(topic, "ERROR_DEVICE_PIN_NOT_FOUND")
-                    return False
-                elif not result[0]["pin_type"] == "INPUT":
+                    continue
+                elif not pin["pin_type"] == "INPUT":
                     print(TAG + f" Device pin {token_verify} - {virtual_pin} khong phai la INPUT")
                     self.publish_message_fromHOST(topic, "ERROR_DEVICE_PIN_NOT_TYPE_INPUT")
-                    return False
+                    continue
 
-                # Lưu vào database
-                sensor_data = {
+                rows.append({
                     "token_verify": token_verify,
                     "virtual_pin": virtual_pin,
                     "value_string": message,
-                    "value_numeric": float(message) if message.replace('.', '', 1).isdigit() else 0
-                }
-                
-                result = db.execute_query(
-                    table="sensor_data",
-                    operation="insert",
-                    data=sensor_data
-                )
-                
-                if result:
-                    print(f"✅ Đã lưu sensor data: {sensor_data} --- clients {token_verify}" )
-                else:
-                    print(f"❌ Không thể lưu sensor data -- client {token_verify}")
-                    
-        except Exception as e:
-            print(f"❌ Lỗi xử lý sensor data: {e}")
-            
+                    "value_numeric": numeric_value(message),
+                    # thoi diem broker nhan - trung moc voi hot tier, khong phai luc ca lo duoc insert
+                    "created_at": datetime.fromtimestamp(received_at, timezone.utc).isoformat()
+                })
+            except Exception as e:
+                print(f"❌ Lỗi xử lý sensor data {topic}: {e}")
+        return rows
 
     # xxxxxxxxxxxxxxxxxxxxxxx
     def _handle_device_status(self, topic: str, message: str):
@@ -276,20 +316,40 @@ class MQTTService:
     
             
     def _call_message_handlers(self, topic: str, message: str):
-        """Gọi các message handlers đã đăng ký"""
-        if topic in self.message_handlers:
-            for handler in self.message_handlers[topic]:
-                try:
-                    handler(topic, message)
-                except Exception as e:
-                    print(f"❌ Lỗi trong message handler: {e}")
+        """Gọi các message handlers có filter khớp topic (mỗi handler 1 lần, trên thread của client publish)"""
+        if not len(self.message_handlers):
+            return
+        for handler in self.message_handlers.match(topic):
+            try:
+                handler(topic, message)
+            except Exception as e:
+                print(f"❌ Lỗi trong message handler: {e}")
                     
     def add_message_handler(self, topic: str, handler: Callable):
-        """Đăng ký handler cho topic cụ thể"""
-        if topic not in self.message_handlers:
-            self.message_handlers[topic] = []
-        self.message_handlers[topic].append(handler)
-        print(f"📝 Đã đăng ký handler cho topic: {topic}")
+        """
+        Đăng ký handler cho topic filter (hỗ trợ + / #). Trả về số lần đăng ký hiện tại
+        Raise ValueError nếu filter không hợp lệ
+        """
+        key = (topic, handler)
+        with self._handlers_lock:
+            count = self._handler_refs.get(key, 0)
+            if count == 0:
+                self.message_handlers.subscribe(handler, topic)
+                print(f"📝 Đã đăng ký handler cho topic: {topic}")
+            self._handler_refs[key] = count + 1
+            return count + 1
+
+    def remove_message_handler(self, topic: str, handler: Callable):
+        """Bỏ 1 lần đăng ký - handler chỉ bị gỡ khi số lần đăng ký về 0. Trả về số lần còn lại"""
+        key = (topic, handler)
+        with self._handlers_lock:
+            count = self._handler_refs.get(key, 0)
+            if count <= 1:
+                self._handler_refs.pop(key, None)
+                self.message_handlers.unsubscribe(handler, topic)
+                return 0
+            self._handler_refs[key] = count - 1
+            return count - 1
 
 
     def publish_message_CT(self , client_id , virtualPin ,  message):
@@ -300,8 +360,12 @@ class MQTTService:
             # Tạo MQTT PUBLISH packet
             #CT/{device_token}/virtualpin 
             topic = TOPIC_CONTRO + client_id +"/"+str(virtualPin)
-            publish_packet = self.broker.create_publish_packet(topic, message)
-            self.broker.clients.get(client_id).send(publish_packet)
+            # giu lenh cuoi: ESP32 khoi dong lai / dashboard subscribe sau van biet trang thai
+            self.broker.retain_message(topic, message)
+            # ESP32 mat Wi-Fi vai giay: lenh nam trong hang doi offline cua session (clean_session=0)
+            if not self.broker.deliver_to_client(client_id, topic, message):
+                print(TAG + f"❌ Client {client_id} không có session trên broker")
+                return False
             print(TAG + f"📤 Đã publish: {topic} -> {message}")
             return True
             
@@ -309,25 +373,17 @@ class MQTTService:
             print(TAG + f"❌ Lỗi khi gửi messsage CT {client_id}" + str(e))
             return False
 
-    def publish_message_fromHOST(self, topic: str, message: str):
+    def publish_message_fromHOST(self, topic: str, message: str, retain: bool = False):
         """Publish message qua MQTT (từ HTTP API)"""
         if not self.broker or not self.running:
             print("❌ MQTT Broker chưa khởi động")
             return False
             
         try:
-            # Tạo MQTT PUBLISH packet
-            publish_packet = self.broker.create_publish_packet(topic, message)
-            
-            # Gửi cho tất cả subscribers
-            if topic in self.broker.subscriptions:
-                subscribers = self.broker.subscriptions[topic]
-                for subscriber_socket in subscribers:
-                    try:
-                        subscriber_socket.send(publish_packet)
-                    except Exception as e:
-                        print(f"❌ Không thể gửi message: {e}")
-                        
+            if retain:
+                self.broker.retain_message(topic, message)
+            # Gửi cho tất cả subscribers có filter khớp topic
+            self.broker.route_message(topic, message)
             print(TAG + f"📤 Đã publish: {topic} -> {message}")
             return True
             
@@ -336,15 +392,39 @@ class MQTTService:
             return False
             
     def get_subscribers_count(self, topic: str) -> int:
-        """Lấy số lượng subscribers cho topic"""
-        if self.broker and topic in self.broker.subscriptions:
-            return len(self.broker.subscriptions[topic])
+        """Lấy số lượng subscribers đăng ký đúng topic filter này"""
+        if self.broker:
+            return len(self.broker.subscriptions.subscribers(topic))
         return 0
         
+    def get_client_stats(self) -> Dict[str, dict]:
+        """Bộ đếm hàng đợi gửi (queued / sent / dropped) của từng client"""
+        if self.broker:
+            return self.broker.get_client_stats()
+        return {}
+
+    def get_pin_stats(self) -> dict:
+        """Bộ đếm hit / miss của pin_registry"""
+        return pin_registry.stats()
+
+    def get_ingest_stats(self) -> dict:
+        """Độ sâu hàng đợi + thời gian flush của pipeline ghi sensor data, bộ đếm rollup / hot tier"""
+        return {**self.sensor_pipeline.stats(), "rollups": self.sensor_rollups.stats(),
+                "hot_series": self.hot_series.stats()}
+
+    def get_retained(self, topic_filter: str = "#") -> List[dict]:
+        """Retained message khớp topic filter - trạng thái hiện tại của CT/ và SS/ không cần hỏi database"""
+        if not self.broker:
+            return []
+        return [
+            {"topic": topic, "message": message.decode('utf-8', errors='replace'), "qos": qos}
+            for topic, message, qos in self.broker.retained.match(topic_filter)
+        ]
+
     def get_all_topics(self) -> List[str]:
         """Lấy danh sách tất cả topics"""
         if self.broker:
-            return list(self.broker.subscriptions.keys())
+            return self.broker.getAllTopic()
         return []
         
     def stop_broker(self):
@@ -352,6 +432,8 @@ class MQTTService:
         if self.broker:
             self.broker.stop()
         self.running = False
+        # ghi nốt sensor data còn trong hàng đợi
+        self.sensor_pipeline.stop()
         print("🛑 MQTT Service đã dừng")
 
     def stop_client(self):
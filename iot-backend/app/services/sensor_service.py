@@ -0,0 +1,797 @@
+# Sensor data ingestion
+# app/services/sensor_service.py
+"""
+Ghi sensor data (SS/{token_verify}/{virtual_pin}) vào database theo lô, tách khỏi luồng publish
+
+Trước đây mỗi message SS/ = 1 select device_pins + 1 insert sensor_data ngay trong
+thread của client publish -> Supabase chậm 200ms thì broker forward chậm 200ms.
+Giờ handler publish chỉ đưa reading vào hàng đợi giới hạn rồi trả về ngay, một
+worker thread rút hàng đợi:
+- gom lô khi đủ batch_size reading hoặc reading cũ nhất đã chờ flush_interval giây
+- prepare(items) -> rows: kiểm tra pin / dựng row ngay trên worker (không chặn broker)
+- insert cả lô bằng 1 request, lỗi thì thử lại với backoff lũy thừa (tối đa max_retries)
+- hàng đợi đầy thì bỏ reading cũ nhất (giống OutboundQueue drop_oldest)
+
+Đọc lịch sử (biểu đồ): fetch_history_page / iter_history phân trang keyset theo
+(created_at, id) trong khoảng thời gian - database lọc, sắp xếp, limit.
+aggregate_history / downsample_history: gom bucket / LTTB bằng NumPy (app/timeseries.py),
+response giới hạn theo resolution / số điểm chứ không theo số row thô.
+SensorRollups: rollup 1m / 1h cập nhật dần khi ingest, ghi vào bảng sensor_rollups khi
+bucket đóng - truy vấn khoảng dài chỉ đọc row đã gộp sẵn.
+query_sensor_data: khoảng gần đây lấy từ hot tier (app/hot_series.py), chỉ phần cũ hơn hỏi database.
+archive_sensor_data: chuyển row cũ hơn SENSOR_RETENTION_DAYS ra file segment (app/sensor_archive.py)
+rồi xóa khỏi database; lịch sử trước watermark của archive đọc từ segment (cùng keyset).
+"""
+
+import asyncio
+
+import base64
+import json
+import threading
+import time
+from array import array
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Callable, List, Optional
+import numpy as np
+from app.config import settings
+from app.database import db, async_db
+from app.sensor_archive import SegmentArchive, iso_to_ms, ms_to_iso
+from app.timeseries import bucket_aggregate, lttb, merge_buckets, to_epoch
+
+TAG = "SENSOR_INGEST"
+
+DEFAULT_BATCH_SIZE = 200
+DEFAULT_FLUSH_INTERVAL = 1.0
+DEFAULT_MAX_QUEUE = 10000
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_RETRY_BACKOFF = 0.5
+DEFAULT_MAX_BACKOFF = 30.0
+
+# Lich su sensor (bieu do): keyset theo (created_at, id) - id phan biet cac row cung 1 lo insert
+HISTORY_ORDER = ("created_at", "id")
+HISTORY_COLUMNS = "id,virtual_pin,value_numeric,value_string,created_at"
+DEFAULT_HISTORY_WINDOW = timedelta(hours=24)
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 5000
+SERIES_COLUMNS = "id,created_at,value_numeric"
+MAX_BUCKETS = 5000
+MAX_POINTS = 5000
+
+# Rollup lien tuc: {ten: do dai bucket (giay)}
+ROLLUP_RESOLUTIONS = {"1m": 60, "1h": 3600}
+ROLLUP_TABLE = "sensor_rollups"
+ROLLUP_COLUMNS = "bucket_start,count,sum,min,max,last,last_at"
+DEFAULT_ROLLUP_GRACE = 5.0
+
+# Luu tru: row cu hon watermark nam trong file segment, khong con trong sensor_data
+ARCHIVE_COLUMNS = "id,token_verify,virtual_pin,value_numeric,value_string,created_at"
+ARCHIVE_ROW_COLUMNS = ("id", "token_verify", "virtual_pin", "value_numeric", "value_string", "created_at")
+ARCHIVE_FLUSH_ROWS = 50000               # tong row dang gom (moi thiet bi) -> ghi het ra segment
+ARCHIVE_DELETE_CHUNK = 500                # id moi request delete ... id=in.(...)
+sensor_archive = SegmentArchive(settings.SENSOR_ARCHIVE_DIR)
+
+
+class SensorIngestPipeline:
+    """
+    Hàng đợi ghi sau (write-behind) cho bảng sensor_data
+
+    prepare: callback nhận list reading, trả về list row để insert (bỏ reading không hợp lệ)
+             None -> reading đã là row
+    on_tick: callback(force) gọi sau mỗi lô và ít nhất mỗi flush_interval giây (force=True khi dừng),
+             trả về [(table, rows)] cần ghi thêm - vd rollup của các bucket vừa đóng
+    on_inserted: callback(rows) gọi sau khi 1 lô đã insert thành công - vd cộng vào rollup
+                 (lô bị bỏ sau max_retries thì không gọi)
+    """
+
+    def __init__(self, prepare: Optional[Callable[[list], List[dict]]] = None, table: str = "sensor_data",
+                 batch_size: int = DEFAULT_BATCH_SIZE, flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+                 max_queue: int = DEFAULT_MAX_QUEUE, max_retries: int = DEFAULT_MAX_RETRIES,
+                 retry_backoff: float = DEFAULT_RETRY_BACKOFF, max_backoff: float = DEFAULT_MAX_BACKOFF,
+                 on_tick: Optional[Callable[[bool], list]] = None,
+                 on_inserted: Optional[Callable[[List[dict]], None]] = None):
+        self.prepare = prepare
+        self.on_tick = on_tick
+        self.on_inserted = on_inserted
+        self.table = table
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.max_backoff = max_backoff
+        self._items = deque()              # [(enqueued_at, reading)]
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._flush_requested = False
+        self._thread = None
+        self.running = False
+        # bo dem
+        self.enqueued = 0
+        self.dropped = 0                   # hang doi day - bo reading cu nhat
+        self.rejected = 0                  # prepare loai bo (pin khong ton tai / khong phai INPUT)
+        self.inserted = 0
+        self.batches = 0
+        self.retries = 0
+        self.failed = 0                    # row bo sau max_retries lan thu lai
+        self.high_water = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self._total_flush_ms = 0.0
+        self.last_wait_ms = 0.0            # reading cu nhat cua lo da cho trong hang doi bao lau
+        self.tick_inserted = {}            # {table: so row} ghi qua on_tick
+        self.tick_failed = {}
+
+    def submit(self, reading) -> bool:
+        """Đưa reading vào hàng đợi (không block). Trả về False nếu pipeline đã dừng"""
+        with self._cond:
+            if not self.running:
+                return False
+            if len(self._items) >= self.max_queue:
+                self._items.popleft()
+                self.dropped += 1
+            self._items.append((time.monotonic(), reading))
+            self.enqueued += 1
+            if len(self._items) > self.high_water:
+                self.high_water = len(self._items)
+            if len(self._items) >= self.batch_size:
+                self._cond.notify()
+        return True
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self.running = True
+        self._thread = threading.Thread(target=self._run, name="sensor-ingest", daemon=True)
+        self._thread.start()
+        print(TAG + f" 🚀 Ghi sensor data theo lô (batch_size={self.batch_size}, flush_interval={self.flush_interval}s)")
+
+    def stop(self, timeout: float = 10.0):
+        """Dừng nhận reading mới, ghi nốt phần còn lại trong hàng đợi rồi dừng worker"""
+        with self._cond:
+            if not self.running:
+                return
+            self.running = False
+            self._stop.set()
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join(timeout)
+        print(TAG + f" 🛑 Đã dừng - {self.inserted} row đã ghi, {len(self._items)} reading còn lại")
+
+    def flush(self):
+        """Yêu cầu worker ghi ngay lô hiện tại (không chờ flush_interval)"""
+        with self._cond:
+            self._flush_requested = True
+            self._cond.notify()
+
+    def _take_batch(self):
+        """Chờ tới khi đủ batch_size, reading cũ nhất quá flush_interval, flush() hoặc stop()"""
+        with self._cond:
+            while True:
+                if self._items:
+                    waited = time.monotonic() - self._items[0][0]
+                    if (len(self._items) >= self.batch_size or waited >= self.flush_interval
+                            or self._flush_requested or self._stop.is_set()):
+                        break
+                    self._cond.wait(self.flush_interval - waited)
+                elif self._stop.is_set():
+                    return None
+                else:
+                    self._flush_requested = False
+                    if not self._cond.wait(self.flush_interval) and self.on_tick and not self._items:
+                        return []          # ranh - van goi on_tick de dong bucket het han
+            self._flush_requested = False
+            count = min(self.batch_size, len(self._items))
+            batch = [self._items.popleft() for _ in range(count)]
+        self.last_wait_ms = (time.monotonic() - batch[0][0]) * 1000
+        return [reading for _, reading in batch]
+
+    def _run(self):
+        while True:
+            readings = self._take_batch()
+            if readings is None:
+                self._tick(force=True)
+                return
+            if readings:
+                try:
+                    rows = self.prepare(readings) if self.prepare else readings
+                except Exception as e:
+                    print(TAG + f" ❌ Lỗi chuẩn bị lô {len(readings)} reading: {e}")
+                    rows = []
+                self.rejected += len(readings) - len(rows)
+                if rows:
+                    if self._insert(rows):
+                        self.inserted += len(rows)
+                        self._inserted(rows)
+                    else:
+                        self.failed += len(rows)
+            self._tick()
+
+    def _inserted(self, rows):
+        if not self.on_inserted:
+            return
+        try:
+            self.on_inserted(rows)
+        except Exception as e:
+            print(TAG + f" ❌ Lỗi on_inserted: {e}")
+
+    def _tick(self, force=False):
+        if not self.on_tick:
+            return
+        try:
+            extra = self.on_tick(force)
+        except Exception as e:
+            print(TAG + f" ❌ Lỗi on_tick: {e}")
+            return
+        for table, rows in extra:
+            counter = self.tick_inserted if self._insert(rows, table) else self.tick_failed
+            counter[table] = counter.get(table, 0) + len(rows)
+
+    def _insert(self, rows, table=None):
+        """Insert 1 lô, thử lại với backoff lũy thừa; khi đang dừng thì không chờ backoff. Trả về True nếu ghi được"""
+        table = table or self.table
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            result = db.execute_query(table=table, operation="insert", data=rows)
+            if result is not None:
+                break
+            if attempt >= self.max_retries:
+                print(TAG + f" ❌ Bỏ lô {len(rows)} row {table} sau {self.max_retries} lần thử lại")
+                break
+            delay = min(self.retry_backoff * (2 ** attempt), self.max_backoff)
+            attempt += 1
+            self.retries += 1
+            print(TAG + f" ⚠️ Insert lô {len(rows)} row {table} lỗi - thử lại lần {attempt} sau {delay:.1f}s")
+            self._stop.wait(delay)
+        elapsed_ms = (time.monotonic() - started) * 1000
+        self.batches += 1
+        self.last_flush_ms = elapsed_ms
+        self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+        self._total_flush_ms += elapsed_ms
+        return result is not None
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "queued": len(self._items),
+            "max_queue": self.max_queue,
+            "high_water": self.high_water,
+            "batch_size": self.batch_size,
+            "flush_interval": self.flush_interval,
+            "enqueued": self.enqueued,
+            "dropped": self.dropped,
+            "rejected": self.rejected,
+            "inserted": self.inserted,
+            "failed": self.failed,
+            "batches": self.batches,
+            "retries": self.retries,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "avg_flush_ms": round(self._total_flush_ms / self.batches, 2) if self.batches else 0.0,
+            "max_flush_ms": round(self.max_flush_ms, 2),
+            "last_wait_ms": round(self.last_wait_ms, 2),
+            "tick_inserted": dict(self.tick_inserted),
+            "tick_failed": dict(self.tick_failed),
+        }
+
+
+class RollupBucket:
+    __slots__ = ('start', 'count', 'sum', 'min', 'max', 'last', 'last_at')
+
+    def __init__(self, start, timestamp, value):
+        self.start = start
+        self.count = 1
+        self.sum = value
+        self.min = value
+        self.max = value
+        self.last = value
+        self.last_at = timestamp
+
+    def add(self, timestamp, value):
+        self.count += 1
+        self.sum += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        if timestamp >= self.last_at:
+            self.last = value
+            self.last_at = timestamp
+
+
+class SensorRollups:
+    """
+    Rollup 1 phút / 1 giờ của value_numeric, cập nhật dần theo từng reading (không tính lại từ row thô)
+
+    Mỗi (token_verify, virtual_pin, resolution) giữ 1 bucket đang mở trong bộ nhớ. Reading thuộc
+    bucket mới -> bucket cũ đóng; bucket không có reading mới thì đóng khi quá hạn + grace giây.
+    collect() (on_tick của SensorIngestPipeline) trả về row của các bucket đã đóng để ghi vào
+    bảng sensor_rollups. Lưu sum thay vì avg: nhiều row cùng bucket (ghi nốt khi dừng broker
+    rồi chạy lại) vẫn gộp chính xác khi đọc.
+    """
+
+    def __init__(self, resolutions: dict = None, table: str = ROLLUP_TABLE, grace: float = DEFAULT_ROLLUP_GRACE):
+        self.resolutions = dict(resolutions or ROLLUP_RESOLUTIONS)
+        self.table = table
+        self.grace = grace
+        self._open = {}                    # {(token_verify, virtual_pin, resolution): RollupBucket}
+        self._closed = []                  # row cho ghi
+        self._lock = threading.Lock()
+        # bo dem
+        self.added = 0
+        self.late = 0                      # reading thuoc bucket da dong - bo qua
+        self.closed_buckets = 0
+
+    def add(self, token_verify: str, virtual_pin: int, timestamp: float, value: float):
+        with self._lock:
+            self.added += 1
+            for name, seconds in self.resolutions.items():
+                key = (token_verify, virtual_pin, name)
+                start = timestamp - timestamp % seconds
+                bucket = self._open.get(key)
+                if bucket is None:
+                    self._open[key] = RollupBucket(start, timestamp, value)
+                elif bucket.start == start:
+                    bucket.add(timestamp, value)
+                elif start > bucket.start:
+                    self._close(key, bucket)
+                    self._open[key] = RollupBucket(start, timestamp, value)
+                else:
+                    self.late += 1
+
+    def add_rows(self, rows: List[dict]):
+        """Cộng các row sensor_data đã insert (on_inserted của SensorIngestPipeline)"""
+        for row in rows:
+            self.add(row["token_verify"], row["virtual_pin"], to_epoch(row["created_at"]), row["value_numeric"])
+
+    def _close(self, key, bucket):
+        token_verify, virtual_pin, name = key
+        self._closed.append({
+            "token_verify": token_verify,
+            "virtual_pin": virtual_pin,
+            "resolution": name,
+            "bucket_start": _iso(bucket.start),
+            "count": bucket.count,
+            "sum": bucket.sum,
+            "min": bucket.min,
+            "max": bucket.max,
+            "last": bucket.last,
+            "last_at": _iso(bucket.last_at),
+        })
+        self.closed_buckets += 1
+
+    def collect(self, force: bool = False, now: float = None) -> list:
+        """Đóng bucket quá hạn (force: mọi bucket) và trả về [(table, rows)] cần ghi"""
+        now = time.time() if now is None else now
+        with self._lock:
+            for key, bucket in list(self._open.items()):
+                if force or now >= bucket.start + self.resolutions[key[2]] + self.grace:
+                    self._close(key, bucket)
+                    del self._open[key]
+            rows, self._closed = self._closed, []
+        return [(self.table, rows)] if rows else []
+
+    def open_buckets(self, token_verify: str, virtual_pin: int, name: str) -> List[dict]:
+        """Bucket đang mở (chưa ghi database) của pin - để truy vấn thấy cả dữ liệu mới nhất"""
+        with self._lock:
+            bucket = self._open.get((token_verify, virtual_pin, name))
+            if bucket is None:
+                return []
+            return [{"bucket_start": _iso(bucket.start), "count": bucket.count, "sum": bucket.sum,
+                     "min": bucket.min, "max": bucket.max, "last": bucket.last, "last_at": _iso(bucket.last_at)}]
+
+    def stats(self) -> dict:
+        return {
+            "open": len(self._open),
+            "pending": len(self._closed),
+            "added": self.added,
+            "late": self.late,
+            "closed_buckets": self.closed_buckets,
+        }
+
+
+def encode_cursor(row: dict) -> str:
+    """Cursor mờ (base64url JSON) từ row cuối của trang"""
+    data = json.dumps({key: row[key] for key in HISTORY_ORDER}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> dict:
+    """Raise ValueError nếu cursor hỏng"""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return {key: data[key] for key in HISTORY_ORDER}
+    except Exception as e:
+        raise ValueError(f"cursor không hợp lệ: {e}")
+
+
+def history_window(start: Optional[str], end: Optional[str]):
+    """Khoảng created_at [start, end) - thiếu start thì lấy DEFAULT_HISTORY_WINDOW trước end (hoặc bây giờ)"""
+    if start is None:
+        end_time = datetime.fromisoformat(end) if end else datetime.now(timezone.utc)
+        start = (end_time - DEFAULT_HISTORY_WINDOW).isoformat()
+    bounds = {"gte": start}
+    if end:
+        bounds["lt"] = end
+    return bounds
+
+
+def _archive_split(bounds: dict):
+    """
+    Tách khoảng thời gian theo watermark của sensor_archive
+    None: cả khoảng nằm trong database; ngược lại (start_ms, end_ms) đọc từ segment
+    + bounds phần còn lại trong database (None nếu không có)
+    """
+    watermark = sensor_archive.watermark
+    start_ms = iso_to_ms(bounds["gte"])
+    if watermark is None or start_ms >= watermark:
+        return None
+    end_ms = min(iso_to_ms(bounds["lt"]), watermark) if "lt" in bounds else watermark
+    db_bounds = None
+    if "lt" not in bounds or iso_to_ms(bounds["lt"]) > watermark:
+        db_bounds = dict(bounds, gte=ms_to_iso(watermark))
+    return start_ms, end_ms, db_bounds
+
+
+async def _read_archive(token_verify: str, virtual_pin: int, start_ms: int, end_ms: int, descending: bool = False,
+                        cursor: Optional[dict] = None, limit: Optional[int] = None):
+    """sensor_archive.read chạy trên thread pool (mmap + giải nén không chặn event loop)"""
+    key = (iso_to_ms(cursor["created_at"]), int(cursor["id"])) if cursor else None
+    return await asyncio.get_running_loop().run_in_executor(
+        None, sensor_archive.read, token_verify, virtual_pin, start_ms, end_ms, key, descending, limit, True
+    )
+
+
+def _archive_rows(token_verify, virtual_pin, timestamps, ids, values, strings, columns):
+    """Row dạng sensor_data từ segment"""
+    wanted = ARCHIVE_ROW_COLUMNS if columns == "*" else [col.strip() for col in columns.split(",")]
+    rows = []
+    for ts, row_id, value, text in zip(timestamps.tolist(), ids.tolist(), values.astype(str).tolist(),
+                                       strings.tolist()):
+        row = {"id": row_id, "token_verify": token_verify, "virtual_pin": virtual_pin,
+               "value_numeric": None if value == "nan" else float(value), "value_string": text,
+               "created_at": ms_to_iso(ts)}
+        rows.append({key: row[key] for key in wanted if key in row})
+    return rows
+
+
+async def fetch_history_page(token_verify: str, virtual_pin: int, bounds: dict, descending: bool = False,
+                             cursor: Optional[dict] = None, page_size: int = DEFAULT_PAGE_SIZE,
+                             columns: str = HISTORY_COLUMNS) -> Optional[list]:
+    """
+    1 trang lịch sử của pin theo keyset - database lọc khoảng thời gian, sắp xếp và limit
+    Phần trước watermark đọc từ segment lưu trữ; 1 trang có thể nối phần cuối segment với đầu database
+    """
+    split = _archive_split(bounds)
+    if split is None:
+        return await _select_history(token_verify, virtual_pin, bounds, descending, cursor, page_size, columns)
+    start_ms, end_ms, db_bounds = split
+    in_archive = cursor is not None and iso_to_ms(cursor["created_at"]) < sensor_archive.watermark
+    rows = []
+    if not descending:
+        if cursor is not None and not in_archive:
+            if db_bounds is None:
+                return []
+            return await _select_history(token_verify, virtual_pin, db_bounds, False, cursor, page_size, columns)
+        ts, ids, values, strings = await _read_archive(token_verify, virtual_pin, start_ms, end_ms, False, cursor,
+                                                       page_size)
+        rows = _archive_rows(token_verify, virtual_pin, ts, ids, values, strings, columns)
+        if len(rows) < page_size and db_bounds is not None:
+            more = await _select_history(token_verify, virtual_pin, db_bounds, False, None,
+                                         page_size - len(rows), columns)
+            if more is None:
+                return None
+            rows.extend(more)
+        return rows
+    if not in_archive:
+        if db_bounds is not None:
+            rows = await _select_history(token_verify, virtual_pin, db_bounds, True, cursor, page_size, columns)
+            if rows is None or len(rows) == page_size:
+                return rows
+        cursor = None
+    ts, ids, values, strings = await _read_archive(token_verify, virtual_pin, start_ms, end_ms, True, cursor,
+                                                   page_size - len(rows))
+    rows.extend(_archive_rows(token_verify, virtual_pin, ts, ids, values, strings, columns))
+    return rows
+
+
+async def _select_history(token_verify, virtual_pin, bounds, descending, cursor, page_size, columns):
+    return await async_db.execute_query(
+        table="sensor_data",
+        operation="select",
+        filters={"token_verify": token_verify, "virtual_pin": virtual_pin},
+        columns=columns,
+        order_by=[("-" if descending else "") + key for key in HISTORY_ORDER],
+        ranges={"created_at": bounds},
+        limit=page_size,
+        cursor=cursor,
+    )
+
+
+async def iter_history(token_verify: str, virtual_pin: int, bounds: dict, descending: bool = False,
+                       cursor: Optional[dict] = None, page_size: int = DEFAULT_PAGE_SIZE,
+                       columns: str = HISTORY_COLUMNS) -> AsyncIterator[dict]:
+    """
+    Duyệt toàn bộ khoảng thời gian theo từng trang keyset - chỉ giữ 1 trang trong bộ nhớ
+    Raise RuntimeError nếu database lỗi giữa chừng
+    """
+    while True:
+        rows = await fetch_history_page(token_verify, virtual_pin, bounds, descending, cursor, page_size, columns)
+        if rows is None:
+            raise RuntimeError("database error")
+        for row in rows:
+            yield row
+        if len(rows) < page_size:
+            return
+        cursor = {key: rows[-1][key] for key in HISTORY_ORDER}
+
+
+def window_seconds(bounds: dict):
+    """(start, end) giây epoch của khoảng thời gian - thiếu 'lt' thì end = bây giờ"""
+    end = to_epoch(bounds["lt"]) if "lt" in bounds else time.time()
+    return to_epoch(bounds["gte"]), end
+
+
+async def load_series(token_verify: str, virtual_pin: int, bounds: dict):
+    """
+    Đọc (timestamp, value_numeric) của khoảng thời gian vào 2 array('d') - chỉ lấy cột cần dùng
+    Phần trước watermark đọc thẳng mảng cột từ segment, không dựng row
+    """
+    timestamps, values = array('d'), array('d')
+    split = _archive_split(bounds)
+    if split is not None:
+        start_ms, end_ms, bounds = split
+        ts, _, vs, _ = await _read_archive(token_verify, virtual_pin, start_ms, end_ms)
+        timestamps.frombytes((ts / 1000.0).tobytes())
+        values.frombytes(vs.astype('float64').tobytes())
+        if bounds is None:
+            return timestamps, values
+    async for row in iter_history(token_verify, virtual_pin, bounds, page_size=MAX_PAGE_SIZE, columns=SERIES_COLUMNS):
+        value = row.get("value_numeric")
+        timestamps.append(to_epoch(row["created_at"]))
+        values.append(float("nan") if value is None else value)
+    return timestamps, values
+
+
+def _iso(seconds: float) -> str:
+    return datetime.fromtimestamp(seconds, timezone.utc).isoformat()
+
+
+def archive_sensor_data(before: Optional[str] = None, archive: Optional[SegmentArchive] = None) -> dict:
+    """
+    Chuyển sensor_data có created_at < before (mặc định: cũ hơn SENSOR_RETENTION_DAYS ngày) ra segment
+    before muộn hơn mốc retention -> ValueError (dữ liệu còn trong hạn giữ không bao giờ bị xóa)
+    - đọc theo keyset (created_at, id) mọi row < before (cả row đến trễ trước watermark cũ),
+      gom theo thiết bị, ghi nối thêm vào file từng ngày (value_numeric và value_string)
+    - ghi xong mới dời watermark rồi chỉ xóa đúng các id đã ghi - row chèn vào trong lúc chạy
+      không bị xóa, lần chạy sau sẽ lưu trữ
+    Lỗi giữa chừng: watermark giữ nguyên, chạy lại an toàn (row trùng id bị bỏ khi đọc)
+    Raise RuntimeError nếu database lỗi khi đọc
+    """
+    archive = archive or sensor_archive
+    retention = (datetime.now(timezone.utc) - timedelta(days=int(settings.SENSOR_RETENTION_DAYS))).isoformat()
+    if before is None:
+        before = retention
+    cutoff_ms = iso_to_ms(before)
+    if cutoff_ms > iso_to_ms(retention):
+        raise ValueError(f"before phải trước {retention} (SENSOR_RETENTION_DAYS={settings.SENSOR_RETENTION_DAYS})")
+    cutoff = ms_to_iso(cutoff_ms)                 # tron mili giay - trung moc voi timestamp trong segment
+    watermark = archive.watermark
+    if watermark is not None and cutoff_ms <= watermark:
+        return {"rows": 0, "blocks": 0, "watermark": ms_to_iso(watermark), "deleted": True}
+
+    pending = {}                                  # {token_verify: ([pin], [ms], [id], [value], [string])}
+    archived = array('q')
+    rows_total, pending_rows, blocks, cursor = 0, 0, 0, None
+    while True:
+        rows = db.execute_query(
+            table="sensor_data",
+            operation="select",
+            columns=ARCHIVE_COLUMNS,
+            order_by=list(HISTORY_ORDER),
+            ranges={"created_at": {"lt": cutoff}},
+            limit=MAX_PAGE_SIZE,
+            cursor=cursor,
+        )
+        if rows is None:
+            raise RuntimeError("database error")
+        for row in rows:
+            columns = pending.setdefault(row["token_verify"], ([], [], [], [], []))
+            columns[0].append(row["virtual_pin"])
+            columns[1].append(iso_to_ms(row["created_at"]))
+            columns[2].append(row["id"])
+            columns[3].append(float("nan") if row.get("value_numeric") is None else row["value_numeric"])
+            columns[4].append(row.get("value_string"))
+            archived.append(row["id"])
+        rows_total += len(rows)
+        last_page = len(rows) < MAX_PAGE_SIZE
+        pending_rows += len(rows)
+        if last_page or pending_rows >= ARCHIVE_FLUSH_ROWS:
+            # gioi han bo nho theo tong so row, khong theo tung thiet bi
+            for token_verify, columns in pending.items():
+                blocks += archive.append(token_verify, *columns)
+            pending, pending_rows = {}, 0
+        if last_page:
+            break
+        cursor = {key: rows[-1][key] for key in HISTORY_ORDER}
+
+    archive.set_watermark(cutoff_ms)
+    deleted = _delete_archived(archived)
+    print(TAG + f" Lưu trữ {rows_total} row ({blocks} block) trước {cutoff}")
+    return {"rows": rows_total, "blocks": blocks, "watermark": cutoff, "deleted": deleted}
+
+
+def _delete_archived(ids) -> bool:
+    """
+    Xóa đúng các id đã ghi vào segment: dải id liên tiếp -> 1 request id gte/lte,
+    id lẻ -> request id in (...) tối đa ARCHIVE_DELETE_CHUNK id. False nếu có request lỗi
+    """
+    ids = np.unique(np.frombuffer(ids, dtype=np.int64)) if len(ids) else np.empty(0, dtype=np.int64)
+    breaks = np.flatnonzero(np.diff(ids) != 1) + 1
+    ok, singles = True, []
+    for run in np.split(ids, breaks) if ids.size else []:
+        if run.size >= ARCHIVE_DELETE_CHUNK:
+            ok &= db.execute_query(table="sensor_data", operation="delete",
+                                   ranges={"id": {"gte": int(run[0]), "lte": int(run[-1])}}) is not None
+        else:
+            singles.extend(run.tolist())
+    for start in range(0, len(singles), ARCHIVE_DELETE_CHUNK):
+        ok &= db.execute_query(table="sensor_data", operation="delete",
+                               filters={"id": singles[start:start + ARCHIVE_DELETE_CHUNK]}) is not None
+    return ok
+
+
+async def run_archive_schedule(interval_hours: float):
+    """Task nền: archive_sensor_data (mốc retention mặc định) mỗi interval_hours giờ, chạy trên thread pool"""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval_hours * 3600)
+        try:
+            await loop.run_in_executor(None, archive_sensor_data)
+        except Exception as e:
+            print(TAG + f" ❌ Lưu trữ định kỳ lỗi: {e}")
+
+
+# cot hot tier tra duoc (khong co id / value_string)
+HOT_COLUMNS = ("token_verify", "virtual_pin", "value_numeric", "created_at")
+
+
+def _select_sensor_data(token_verify, virtual_pin, columns, descending, created_at, limit):
+    return db.execute_query(
+        table="sensor_data",
+        operation="select",
+        filters={"token_verify": token_verify, "virtual_pin": virtual_pin},
+        columns=columns,
+        order_by="-created_at" if descending else "created_at",
+        ranges={"created_at": created_at} if created_at else None,
+        limit=limit if limit > 0 else None
+    )
+
+
+def query_sensor_data(hot, token_verify: str, virtual_pin: int, limit: int = 10, since: Optional[str] = None,
+                      until: Optional[str] = None, descending: bool = False, columns: str = "*"):
+    """
+    Sensor data cho /mqtt/sensor-data - trả về (rows, source), rows = None nếu database lỗi
+    source: hot (chỉ bộ nhớ) | hot+database (phần trước mốc hot tier từ database) | database
+    - N reading mới nhất (order desc, không since): hot tier nếu ring có đủ N điểm
+    - có since: hot tier phục vụ [max(since, oldest), until), database chỉ phần cũ hơn
+    Row từ hot tier chỉ có HOT_COLUMNS; columns cần cột khác -> đọc database
+    """
+    wanted = HOT_COLUMNS if columns == "*" else tuple(col.strip() for col in columns.split(","))
+    if hot is not None and set(wanted) <= set(HOT_COLUMNS) and until is None and since is None \
+            and descending and limit > 0:
+        points = hot.latest(token_verify, virtual_pin, limit)
+        if points is not None:
+            return [_hot_row(token_verify, virtual_pin, t, v, wanted) for t, v in reversed(points)], "hot"
+
+    if hot is not None and set(wanted) <= set(HOT_COLUMNS) and since is not None:
+        since_ts = to_epoch(since)
+        until_ts = to_epoch(until) if until else None
+        points, covered_from = hot.window(token_verify, virtual_pin, since_ts, until_ts)
+        if covered_from is not None:
+            recent = [_hot_row(token_verify, virtual_pin, t, v, wanted) for t, v in points]
+            if since_ts >= covered_from:
+                rows = recent[::-1] if descending else recent
+                return (rows[:limit] if limit > 0 else rows), "hot"
+            older_until = _iso(min(until_ts, covered_from) if until_ts is not None else covered_from)
+            older_range = {"gte": since, "lt": older_until}
+            if descending:
+                need = limit - len(recent) if limit > 0 else 0
+                if limit > 0 and need <= 0:
+                    return recent[::-1][:limit], "hot"
+                older = _select_sensor_data(token_verify, virtual_pin, columns, True, older_range, need)
+                return (None if older is None else recent[::-1] + older), "hot+database"
+            older = _select_sensor_data(token_verify, virtual_pin, columns, False, older_range, limit)
+            if older is None:
+                return None, "hot+database"
+            rows = older + recent
+            return (rows[:limit] if limit > 0 else rows), "hot+database"
+
+    created_at = {}
+    if since:
+        created_at["gte"] = since
+    if until:
+        created_at["lt"] = until
+    return _select_sensor_data(token_verify, virtual_pin, columns, descending, created_at, limit), "database"
+
+
+def _hot_row(token_verify, virtual_pin, timestamp, value, wanted):
+    row = {"token_verify": token_verify, "virtual_pin": virtual_pin,
+           "value_numeric": value, "created_at": _iso(timestamp)}
+    return {key: row[key] for key in wanted}
+
+
+def rollup_for(resolution: float, resolutions: dict = ROLLUP_RESOLUTIONS) -> Optional[str]:
+    """Rollup lớn nhất chia hết resolution (vd 6h -> 1h, 5m -> 1m), None nếu không có"""
+    best = None
+    for name, seconds in resolutions.items():
+        if resolution % seconds == 0 and (best is None or seconds > resolutions[best]):
+            best = name
+    return best
+
+
+async def load_rollups(token_verify: str, virtual_pin: int, bounds: dict, name: str,
+                       rollups: Optional[SensorRollups] = None) -> List[dict]:
+    """Row rollup đã ghi trong khoảng thời gian (keyset theo bucket_start, id) + bucket đang mở trong bộ nhớ"""
+    result, cursor = [], None
+    while True:
+        rows = await async_db.execute_query(
+            table=ROLLUP_TABLE,
+            operation="select",
+            filters={"token_verify": token_verify, "virtual_pin": virtual_pin, "resolution": name},
+            columns="id," + ROLLUP_COLUMNS,
+            order_by=["bucket_start", "id"],
+            ranges={"bucket_start": bounds},
+            limit=MAX_PAGE_SIZE,
+            cursor=cursor,
+        )
+        if rows is None:
+            raise RuntimeError("database error")
+        result.extend(rows)
+        if len(rows) < MAX_PAGE_SIZE:
+            break
+        cursor = {"bucket_start": rows[-1]["bucket_start"], "id": rows[-1]["id"]}
+    if rollups is not None:
+        start, end = window_seconds(bounds)
+        result.extend(row for row in rollups.open_buckets(token_verify, virtual_pin, name)
+                      if start <= to_epoch(row["bucket_start"]) < end)
+    return result
+
+
+async def aggregate_history(token_verify: str, virtual_pin: int, bounds: dict, resolution: float,
+                            source: str = "raw", rollups: Optional[SensorRollups] = None) -> List[dict]:
+    """
+    min / max / avg / count / last cho mỗi bucket resolution giây (bucket căn theo bội số resolution tính từ epoch UTC)
+    source: raw = đọc sensor_data, rollup = gộp row rollup 1m / 1h (resolution phải là bội số)
+    """
+    if source == "rollup":
+        name = rollup_for(resolution)
+        if name is None:
+            raise ValueError(f"resolution {resolution}s không phải bội số của rollup {list(ROLLUP_RESOLUTIONS)}")
+        rows = await load_rollups(token_verify, virtual_pin, bounds, name, rollups)
+        result = merge_buckets(
+            [to_epoch(row["bucket_start"]) for row in rows], [row["count"] for row in rows],
+            [row["sum"] for row in rows], [row["min"] for row in rows], [row["max"] for row in rows],
+            [row["last"] for row in rows], [to_epoch(row["last_at"]) for row in rows], resolution
+        )
+    else:
+        timestamps, values = await load_series(token_verify, virtual_pin, bounds)
+        result = bucket_aggregate(timestamps, values, resolution, origin=0.0)
+    return [
+        {"t": _iso(bucket), "count": int(count), "min": low, "max": high, "avg": avg, "last": last}
+        for bucket, count, low, high, avg, last in zip(
+            result["bucket"].tolist(), result["count"].tolist(), result["min"].tolist(),
+            result["max"].tolist(), result["avg"].tolist(), result["last"].tolist()
+        )
+    ]
+
+
+async def downsample_history(token_verify: str, virtual_pin: int, bounds: dict, points: int) -> List[list]:
+    """Tối đa points điểm [t, value] chọn bằng LTTB"""
+    timestamps, values = await load_series(token_verify, virtual_pin, bounds)
+    ts, vs = lttb(timestamps, values, points)
+    return [[_iso(t), v] for t, v in zip(ts.tolist(), vs.tolist())]
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Hashed timing wheel - một thread duy nhất quản lý mọi timer của broker
+
+Mỗi message QoS 1 đang chờ PUBACK cần một timer gửi lại; tạo 1 thread.Timer
+cho mỗi message thì hàng nghìn message = hàng nghìn thread. Timing wheel chia
+thời gian thành các ô (slot), mỗi tick chỉ xử lý đúng 1 ô:
+- schedule / cancel: O(1)
+- mỗi tick: O(số timer trong ô đó)
+Timer dài hơn một vòng bánh xe được giữ lại với số vòng (rounds) còn lại.
+"""
+
+import threading
+import time
+
+
+class TimerHandle:
+    __slots__ = ('callback', 'args', 'rounds', 'cancelled')
+
+    def __init__(self, callback, args, rounds):
+        self.callback = callback
+        self.args = args
+        self.rounds = rounds
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel:
+    """
+    tick: độ phân giải (giây); slots: số ô của bánh xe
+    Callback chạy trên thread của wheel nên phải ngắn và không block lâu.
+    """
+
+    def __init__(self, tick=0.1, slots=512):
+        self.tick = tick
+        self.slots = slots
+        self._wheel = [[] for _ in range(slots)]
+        self._cursor = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self.pending = 0
+
+    def schedule(self, delay, callback, *args):
+        """Gọi callback(*args) sau khoảng delay giây (làm tròn lên theo tick)"""
+        ticks = max(1, int(-(-delay // self.tick)))
+        with self._lock:
+            rounds, offset = divmod(ticks, self.slots)
+            if offset == 0:
+                rounds -= 1
+            handle = TimerHandle(callback, args, rounds)
+            self._wheel[(self._cursor + offset) % self.slots].append(handle)
+            self.pending += 1
+        return handle
+
+    def advance(self):
+        """Quay bánh xe 1 tick, chạy các timer đến hạn (thread của wheel gọi; test có thể gọi tay)"""
+        due = []
+        with self._lock:
+            self._cursor = (self._cursor + 1) % self.slots
+            bucket = self._wheel[self._cursor]
+            keep = []
+            for handle in bucket:
+                if handle.cancelled:
+                    self.pending -= 1
+                elif handle.rounds > 0:
+                    handle.rounds -= 1
+                    keep.append(handle)
+                else:
+                    self.pending -= 1
+                    due.append(handle)
+            self._wheel[self._cursor] = keep
+        for handle in due:
+            if handle.cancelled:
+                continue
+            try:
+                handle.callback(*handle.args)
+            except Exception as e:
+                print(f"❌ Lỗi trong timer callback: {e}")
+
+    def _run(self):
+        next_tick = time.monotonic() + self.tick
+        while not self._stop.is_set():
+            delay = next_tick - time.monotonic()
+            if delay > 0 and self._stop.wait(delay):
+                break
+            self.advance()
+            next_tick += self.tick
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="mqtt-timer-wheel", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
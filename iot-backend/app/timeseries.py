@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Gom nhóm (bucket) và giảm mẫu (LTTB) chuỗi thời gian sensor bằng NumPy
+
+Dashboard vẽ vài tuần value_numeric: thay vì trả hàng trăm nghìn row thô,
+server trả về
+- bucket_aggregate: min / max / avg / count / last cho mỗi khoảng resolution giây
+- lttb: Largest-Triangle-Three-Buckets - giữ n điểm "hình dạng" nhất để vẽ
+- merge_buckets: gộp rollup 1m / 1h đã tính sẵn thành bucket lớn hơn (không đọc row thô)
+Kích thước response phụ thuộc resolution / n, không phụ thuộc số row thô.
+
+timestamps tính bằng giây (epoch, float), values là float (NaN bị bỏ).
+"""
+
+from datetime import datetime
+import numpy as np
+
+
+def to_epoch(created_at):
+    """created_at ISO 8601 của Supabase -> giây epoch"""
+    return datetime.fromisoformat(created_at).timestamp()
+
+
+def _clean(timestamps, values):
+    """Mảng float, bỏ điểm NaN / None, sắp xếp theo thời gian"""
+    ts = np.asarray(timestamps, dtype=np.float64)
+    vs = np.array(values, dtype=np.float64)                   # None -> NaN
+    keep = ~np.isnan(vs)
+    ts, vs = ts[keep], vs[keep]
+    if ts.size > 1 and np.any(ts[1:] < ts[:-1]):
+        order = np.argsort(ts, kind="stable")
+        ts, vs = ts[order], vs[order]
+    return ts, vs
+
+
+def _empty_result():
+    empty = np.empty(0)
+    return {"bucket": empty, "count": np.empty(0, dtype=np.int64), "min": empty,
+            "max": empty, "avg": empty, "last": empty}
+
+
+def bucket_aggregate(timestamps, values, resolution, origin=None):
+    """
+    Gom điểm vào các bucket dài resolution giây, bắt đầu từ origin (mặc định: điểm đầu tiên làm tròn xuống)
+    Trả về dict các mảng cùng độ dài (chỉ bucket có dữ liệu):
+    bucket (giây epoch đầu bucket), count, min, max, avg, last
+    """
+    if resolution <= 0:
+        raise ValueError("resolution phải > 0")
+    ts, vs = _clean(timestamps, values)
+    if ts.size == 0:
+        return _empty_result()
+    if origin is None:
+        origin = np.floor(ts[0] / resolution) * resolution
+    index = np.floor((ts - origin) / resolution).astype(np.int64)
+    keys, starts = np.unique(index, return_index=True)       # index da sap xep -> starts la dau moi bucket
+    ends = np.append(starts[1:], index.size)
+    counts = ends - starts
+    sums = np.add.reduceat(vs, starts)
+    return {
+        "bucket": origin + keys * float(resolution),
+        "count": counts,
+        "min": np.minimum.reduceat(vs, starts),
+        "max": np.maximum.reduceat(vs, starts),
+        "avg": sums / counts,
+        "last": vs[ends - 1],
+    }
+
+
+def merge_buckets(starts, counts, sums, mins, maxs, lasts, last_ats, resolution, origin=0.0):
+    """
+    Gộp các bucket rollup (có thể trùng bucket) thành bucket resolution giây
+    resolution phải là bội số độ dài bucket rollup. Kết quả cùng dạng bucket_aggregate
+    """
+    if resolution <= 0:
+        raise ValueError("resolution phải > 0")
+    starts = np.asarray(starts, dtype=np.float64)
+    if starts.size == 0:
+        return _empty_result()
+    index = np.floor((starts - origin) / resolution).astype(np.int64)
+    order = np.lexsort((np.asarray(last_ats, dtype=np.float64), index))   # theo bucket roi theo last_at
+    index = index[order]
+    counts = np.asarray(counts, dtype=np.int64)[order]
+    sums = np.asarray(sums, dtype=np.float64)[order]
+    keys, firsts = np.unique(index, return_index=True)
+    ends = np.append(firsts[1:], index.size)
+    total = np.add.reduceat(counts, firsts)
+    return {
+        "bucket": origin + keys * float(resolution),
+        "count": total,
+        "min": np.minimum.reduceat(np.asarray(mins, dtype=np.float64)[order], firsts),
+        "max": np.maximum.reduceat(np.asarray(maxs, dtype=np.float64)[order], firsts),
+        "avg": np.add.reduceat(sums, firsts) / total,
+        "last": np.asarray(lasts, dtype=np.float64)[order][ends - 1],
+    }
+
+
+def lttb(timestamps, values, points):
+    """
+    Largest-Triangle-Three-Buckets: giảm xuống tối đa points điểm, giữ điểm đầu / cuối
+    và ở mỗi bucket chọn điểm tạo tam giác lớn nhất với điểm đã chọn trước và trung bình bucket sau
+    Trả về (timestamps, values) đã giảm mẫu
+    """
+    ts, vs = _clean(timestamps, values)
+    n = ts.size
+    if points >= n or n <= 2:
+        return ts, vs
+    if points < 3:
+        raise ValueError("points phải >= 3")
+    edges = np.linspace(1, n - 1, points - 1).astype(np.int64)   # points-2 bucket giua diem dau va cuoi
+    selected = np.empty(points, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(points - 2):
+        lo, hi = edges[i], edges[i + 1]
+        next_lo = hi
+        next_hi = edges[i + 2] if i + 2 < edges.size else n
+        avg_t = ts[next_lo:next_hi].mean()
+        avg_v = vs[next_lo:next_hi].mean()
+        area = np.abs((ts[a] - avg_t) * (vs[lo:hi] - vs[a]) - (ts[a] - ts[lo:hi]) * (avg_v - vs[a]))
+        a = lo + int(area.argmax())
+        selected[i + 1] = a
+    return ts[selected], vs[selected]
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Chỉ mục subscription dạng trie theo level của topic (MQTT 3.1.1)
+
+"SS/abc/3" được tách thành các level ["SS", "abc", "3"]; mỗi node của trie là
+một level, subscriber được gắn vào node cuối của topic filter.
+
+- Hỗ trợ wildcard: "+" khớp đúng 1 level, "#" khớp mọi level còn lại (kể cả 0 level)
+- match(topic): thời gian phụ thuộc độ sâu topic, không phụ thuộc số subscription
+- Reverse index subscriber -> filters: dọn dẹp khi disconnect chỉ tốn O(số subscription của client đó)
+"""
+
+import threading
+
+SINGLE_LEVEL = '+'
+MULTI_LEVEL = '#'
+
+
+def is_valid_topic_filter(topic_filter):
+    """Kiểm tra topic filter: '+' và '#' phải chiếm trọn 1 level, '#' chỉ ở level cuối"""
+    if not topic_filter:
+        return False
+    levels = topic_filter.split('/')
+    for i, level in enumerate(levels):
+        if MULTI_LEVEL in level and (level != MULTI_LEVEL or i != len(levels) - 1):
+            return False
+        if SINGLE_LEVEL in level and level != SINGLE_LEVEL:
+            return False
+    return True
+
+
+def topic_matches(topic_filter, topic):
+    """So khớp 1 filter với 1 topic (dùng khi không cần cả trie)"""
+    filter_levels = topic_filter.split('/')
+    topic_levels = topic.split('/')
+    if topic.startswith('$') and filter_levels[0] in (SINGLE_LEVEL, MULTI_LEVEL):
+        return False
+    for i, level in enumerate(filter_levels):
+        if level == MULTI_LEVEL:
+            return True
+        if i >= len(topic_levels):
+            return False
+        if level != SINGLE_LEVEL and level != topic_levels[i]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+class _TopicNode:
+    __slots__ = ('children', 'subscribers')
+
+    def __init__(self):
+        self.children = {}       # {level: _TopicNode}
+        self.subscribers = {}    # {subscriber: qos}
+
+
+class TopicTree:
+    """
+    Trie subscription dùng chung cho broker (subscriber = client socket)
+    và WebSocket bridge (subscriber = connection_id)
+
+    Thread-safe: broker gọi subscribe/match từ nhiều thread client cùng lúc.
+    """
+
+    def __init__(self):
+        self._root = _TopicNode()
+        self._subscriber_filters = {}   # {subscriber: {topic_filter: qos}} - reverse index
+        self._filter_count = 0
+        self._lock = threading.RLock()
+
+    def subscribe(self, subscriber, topic_filter, qos=0):
+        """Đăng ký subscriber vào topic_filter. Trả về True nếu là subscription mới"""
+        if not is_valid_topic_filter(topic_filter):
+            raise ValueError(f"Topic filter không hợp lệ: {topic_filter}")
+        with self._lock:
+            node = self._root
+            for level in topic_filter.split('/'):
+                child = node.children.get(level)
+                if child is None:
+                    child = node.children[level] = _TopicNode()
+                node = child
+            is_new = subscriber not in node.subscribers
+            if not node.subscribers:
+                self._filter_count += 1
+            node.subscribers[subscriber] = qos
+            self._subscriber_filters.setdefault(subscriber, {})[topic_filter] = qos
+            return is_new
+
+    def unsubscribe(self, subscriber, topic_filter):
+        """Hủy 1 subscription, xóa các node rỗng trên đường đi. Trả về True nếu có xóa"""
+        with self._lock:
+            path = [self._root]
+            node = self._root
+            levels = topic_filter.split('/')
+            for level in levels:
+                node = node.children.get(level)
+                if node is None:
+                    return False
+                path.append(node)
+            if subscriber not in node.subscribers:
+                return False
+            del node.subscribers[subscriber]
+            if not node.subscribers:
+                self._filter_count -= 1
+            # prune node rỗng từ lá ngược lên gốc
+            for i in range(len(levels), 0, -1):
+                current = path[i]
+                if current.subscribers or current.children:
+                    break
+                del path[i - 1].children[levels[i - 1]]
+
+            filters = self._subscriber_filters.get(subscriber)
+            if filters is not None:
+                filters.pop(topic_filter, None)
+                if not filters:
+                    del self._subscriber_filters[subscriber]
+            return True
+
+    def remove_subscriber(self, subscriber):
+        """Xóa mọi subscription của subscriber (khi disconnect). Trả về dict {filter: qos} đã xóa"""
+        with self._lock:
+            filters = dict(self._subscriber_filters.get(subscriber, {}))
+            for topic_filter in filters:
+                self.unsubscribe(subscriber, topic_filter)
+            return filters
+
+    def match(self, topic):
+        """
+        Tìm mọi subscriber có filter khớp topic
+
+        Trả về {subscriber: qos}; nếu 1 subscriber khớp nhiều filter thì lấy qos lớn nhất
+        """
+        levels = topic.split('/')
+        result = {}
+        with self._lock:
+            nodes = [self._root]
+            for depth, level in enumerate(levels):
+                next_nodes = []
+                for node in nodes:
+                    # topic bắt đầu bằng '$' không khớp wildcard ở level đầu
+                    wildcard_ok = not (depth == 0 and level.startswith('$'))
+                    if wildcard_ok:
+                        multi = node.children.get(MULTI_LEVEL)
+                        if multi is not None:
+                            self._collect(multi, result)
+                        single = node.children.get(SINGLE_LEVEL)
+                        if single is not None:
+                            next_nodes.append(single)
+                    exact = node.children.get(level)
+                    if exact is not None:
+                        next_nodes.append(exact)
+                nodes = next_nodes
+                if not nodes:
+                    return result
+            for node in nodes:
+                self._collect(node, result)
+                # "a/#" cũng khớp "a" (# khớp 0 level)
+                multi = node.children.get(MULTI_LEVEL)
+                if multi is not None:
+                    self._collect(multi, result)
+        return result
+
+    @staticmethod
+    def _collect(node, result):
+        for subscriber, qos in node.subscribers.items():
+            if qos > result.get(subscriber, -1):
+                result[subscriber] = qos
+
+    def subscribers(self, topic_filter):
+        """Subscriber đăng ký đúng filter này (không so khớp wildcard)"""
+        with self._lock:
+            node = self._root
+            for level in topic_filter.split('/'):
+                node = node.children.get(level)
+                if node is None:
+                    return {}
+            return dict(node.subscribers)
+
+    def subscriptions_of(self, subscriber):
+        """{topic_filter: qos} của một subscriber"""
+        with self._lock:
+            return dict(self._subscriber_filters.get(subscriber, {}))
+
+    def filters(self):
+        """Danh sách mọi topic filter đang có subscriber"""
+        with self._lock:
+            result = []
+            stack = [(self._root, [])]
+            while stack:
+                node, prefix = stack.pop()
+                if node.subscribers and prefix:
+                    result.append('/'.join(prefix))
+                for level, child in node.children.items():
+                    stack.append((child, prefix + [level]))
+            return result
+
+    def __len__(self):
+        """Số topic filter đang có subscriber"""
+        return self._filter_count
+
+    def __contains__(self, topic_filter):
+        return bool(self.subscribers(topic_filter))
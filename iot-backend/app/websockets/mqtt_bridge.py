@@ -1,154 +1,641 @@
 # WebSocket Bridge giữa MQTT và HTTP
 # app/websockets/mqtt_bridge.py
 from fastapi import WebSocket, WebSocketDisconnect
+from collections import deque
+from itertools import islice
 from typing import Dict, List
 import json
 import asyncio
+import struct
+import time
+import uuid
 from app.services.mqtt_service import mqtt_service
+from app.topic_tree import TopicTree, topic_matches
+
+TAG = "WS_BRIDGE"
+
+DEFAULT_INBOX_SIZE = 10000      # message MQTT cho chuyen sang event loop
+DEFAULT_SEND_QUEUE = 256        # message cho gui / WebSocket
+FAN_OUT_BATCH = 256             # nhuong event loop sau moi lo
+
+# Dinh dang frame mqtt_message, chon theo tung connection (?format=binary hoac action "format")
+FRAME_FORMATS = ("json", "binary")
+# binary: type (1 byte) | seq uint64 | timestamp float64 | do dai topic uint16 | topic utf-8
+#         | message utf-8 (phan con lai)
+BINARY_MQTT_MESSAGE = 1
+BINARY_HEADER = struct.Struct("!BQdH")
+# binary mqtt_batch: type (1 byte) | do dai topic uint16 | so message uint16 | topic
+#                    | moi message: seq uint64 | timestamp float64 | do dai uint32 | message utf-8
+BINARY_MQTT_BATCH = 2
+BINARY_BATCH_HEADER = struct.Struct("!BHH")
+BINARY_BATCH_ITEM = struct.Struct("!QdI")
+
+# Che do giao theo tung subscription (action subscribe: "mode", "interval_ms")
+#   all    - moi message 1 frame, gui ngay (mac dinh)
+#   latest - chi gia tri moi nhat cua moi topic, toi da 1 frame / interval
+#   batch  - moi message cua topic gom thanh 1 frame mqtt_batch / interval
+DELIVERY_MODES = ("all", "latest", "batch")
+DEFAULT_INTERVAL_MS = 1000
+MIN_INTERVAL_MS = 50
+MAX_INTERVAL_MS = 60000
+MAX_BATCH_ITEMS = 1000          # batch qua dai thi bo message cu nhat
+FLUSH_TICK = 0.025              # nhip kiem tra topic den han gui (giay)
+RULE_CACHE_SIZE = 4096
+
+# Moi message MQTT qua bridge co 1 seq tang dan (chung cho moi topic) trong 1 stream (1 lan chay server).
+# REPLAY_SIZE message gan nhat duoc giu lai de client ket noi lai resume tu seq cuoi da nhan.
+REPLAY_SIZE = 10000
+MAX_SNAPSHOT_POINTS = 1000
+# Bridge nhan moi message MQTT (1 handler co dinh tu start() toi stop()): seq / replay lien tuc
+# ke ca khi khong WebSocket nao subscribe - resume sau khi tab cuoi dong khong bi thieu message
+BRIDGE_FILTER = "#"
+
+
+def encode_frame(frame_format: str, topic: str, message: str, received_at: float, seq: int = 0):
+    """1 message MQTT -> frame gửi WebSocket (str cho json, bytes cho binary)"""
+    if frame_format == "binary":
+        topic_bytes = topic.encode('utf-8')
+        return BINARY_HEADER.pack(BINARY_MQTT_MESSAGE, seq, received_at, len(topic_bytes)) + topic_bytes \
+            + message.encode('utf-8')
+    return json.dumps({
+        "type": "mqtt_message",
+        "topic": topic,
+        "message": message,
+        "timestamp": str(received_at),
+        "seq": seq
+    }, separators=(',', ':'))
+
+
+def encode_batch_frame(frame_format: str, topic: str, items: List[tuple]):
+    """Nhiều message của 1 topic [(seq, received_at, message)] -> 1 frame mqtt_batch (cũ -> mới)"""
+    if frame_format == "binary":
+        topic_bytes = topic.encode('utf-8')
+        parts = [BINARY_BATCH_HEADER.pack(BINARY_MQTT_BATCH, len(topic_bytes), len(items)), topic_bytes]
+        for seq, received_at, message in items:
+            message_bytes = message.encode('utf-8')
+            parts.append(BINARY_BATCH_ITEM.pack(seq, received_at, len(message_bytes)))
+            parts.append(message_bytes)
+        return b"".join(parts)
+    return json.dumps({
+        "type": "mqtt_batch",
+        "topic": topic,
+        "messages": [[seq, str(received_at), message] for seq, received_at, message in items]
+    }, separators=(',', ':'))
+
+
+def parse_delivery(mode, interval_ms):
+    """(mode, interval giây) từ action subscribe, None nếu không hợp lệ"""
+    if mode is None:
+        mode = "all"
+    if mode not in DELIVERY_MODES:
+        return None
+    if mode == "all":
+        return mode, 0.0
+    if interval_ms is None:
+        interval_ms = DEFAULT_INTERVAL_MS
+    if isinstance(interval_ms, bool) or not isinstance(interval_ms, int) \
+            or not MIN_INTERVAL_MS <= interval_ms <= MAX_INTERVAL_MS:
+        return None
+    return mode, interval_ms / 1000
+
+
+def parse_initial(snapshot, resume_from):
+    """
+    (points, resume_from) từ action subscribe, None nếu không hợp lệ
+    snapshot: "last" -> points 0 (giá trị cuối), số nguyên -> tối đa points điểm gần nhất, None -> không snapshot
+    resume_from: seq cuối client đã nhận (số nguyên >= 0) hoặc None
+    """
+    if snapshot == "last":
+        points = 0
+    elif snapshot is None:
+        points = None
+    elif isinstance(snapshot, int) and not isinstance(snapshot, bool) and 1 <= snapshot <= MAX_SNAPSHOT_POINTS:
+        points = snapshot
+    else:
+        return None
+    if resume_from is not None and (isinstance(resume_from, bool) or not isinstance(resume_from, int)
+                                    or resume_from < 0):
+        return None
+    return points, resume_from
+
+
+class ConnectionSender:
+    """
+    Hàng đợi gửi của 1 WebSocket + task ghi riêng
+
+    Trình duyệt chậm chỉ làm đầy hàng đợi của chính nó: đầy thì bỏ message cũ nhất
+    (dropped tăng), các connection khác và task fan-out không phải chờ.
+    """
+
+    def __init__(self, websocket: WebSocket, connection_id: str, max_queue: int = DEFAULT_SEND_QUEUE,
+                 frame_format: str = "json"):
+        self.websocket = websocket
+        self.connection_id = connection_id
+        self.frame_format = frame_format
+        self.max_queue = max_queue
+        self.queue = deque()
+        self.ready = asyncio.Event()
+        self.task = None
+        # filter -> (mode, interval giay), chi filter khong phai "all"
+        self.delivery: Dict[str, tuple] = {}
+        self._rules: Dict[str, tuple] = {}     # topic -> rule (cache, xoa khi delivery doi)
+        self.pending: Dict[str, list] = {}     # topic -> [mode, interval, due, items]
+        self.next_due: Dict[str, float] = {}   # topic -> lan gui ke tiep som nhat (monotonic)
+        # bo dem
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0                     # message khong thanh frame rieng (bi thay / gop batch)
+
+    def push(self, frame):
+        """Gọi trên event loop - không bao giờ chờ. frame: str (text) hoặc bytes (binary)"""
+        if len(self.queue) >= self.max_queue:
+            self.queue.popleft()
+            self.dropped += 1
+        self.queue.append(frame)
+        self.ready.set()
+
+    def set_delivery(self, topic_filter: str, mode: str, interval: float):
+        if mode == "all":
+            self.delivery.pop(topic_filter, None)
+        else:
+            self.delivery[topic_filter] = (mode, interval)
+        self._rules.clear()
+
+    def rule_for(self, topic: str, filters) -> tuple:
+        """
+        (mode, interval) áp cho topic, None = gửi ngay
+        Có filter "all" khớp thì gửi ngay; nhiều filter giãn nhịp khớp thì lấy interval nhỏ nhất
+        """
+        try:
+            return self._rules[topic]
+        except KeyError:
+            pass
+        rule = None
+        for topic_filter in filters:
+            if not topic_matches(topic_filter, topic):
+                continue
+            delivery = self.delivery.get(topic_filter)
+            if delivery is None:
+                rule = None
+                break
+            if rule is None or delivery[1] < rule[1]:
+                rule = delivery
+        if len(self._rules) >= RULE_CACHE_SIZE:
+            self._rules.clear()
+        self._rules[topic] = rule
+        return rule
+
+    def hold(self, topic: str, message: str, received_at: float, seq: int, rule: tuple, now: float):
+        """Giữ message chờ nhịp gửi của topic (latest: thay giá trị cũ, batch: nối thêm)"""
+        entry = self.pending.get(topic)
+        if entry is None:
+            mode, interval = rule
+            due = max(now, self.next_due.get(topic, 0.0))
+            self.pending[topic] = [mode, interval, due, [(seq, received_at, message)]]
+            return
+        items = entry[3]
+        if entry[0] == "latest":
+            items[0] = (seq, received_at, message)
+            self.coalesced += 1
+            return
+        if len(items) >= MAX_BATCH_ITEMS:
+            del items[0]
+            self.dropped += 1
+        items.append((seq, received_at, message))
+
+    def flush(self, now: float, frames: dict) -> int:
+        """
+        Gửi các topic đã đến hạn, trả về số frame
+        frames: cache frame latest dùng chung giữa các connection trong cùng 1 nhịp
+        """
+        count = 0
+        for topic, (mode, interval, due, items) in list(self.pending.items()):
+            if due > now:
+                continue
+            del self.pending[topic]
+            self.next_due[topic] = now + interval
+            if mode == "latest":
+                seq, received_at, message = items[0]
+                key = (self.frame_format, seq)
+                frame = frames.get(key)
+                if frame is None:
+                    frame = frames[key] = encode_frame(self.frame_format, topic, message, received_at, seq)
+            else:
+                frame = encode_batch_frame(self.frame_format, topic, items)
+                self.coalesced += len(items) - 1
+            self.push(frame)
+            count += 1
+        if len(self.next_due) > RULE_CACHE_SIZE:
+            # het han = nhu chua tung gui
+            self.next_due = {topic: due for topic, due in self.next_due.items() if due > now}
+        return count
+
+    async def run(self, on_error):
+        try:
+            while True:
+                await self.ready.wait()
+                while self.queue:
+                    frame = self.queue.popleft()
+                    if isinstance(frame, bytes):
+                        await self.websocket.send_bytes(frame)
+                    else:
+                        await self.websocket.send_text(frame)
+                    self.sent += 1
+                self.ready.clear()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"❌ Lỗi gửi data đến WebSocket {self.connection_id}: {e}")
+            on_error(self.connection_id)
+
+    def stats(self) -> dict:
+        return {
+            "format": self.frame_format,
+            "queued": len(self.queue),
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "pending_topics": len(self.pending),
+            "coalesced": self.coalesced,
+        }
+
 
 class MQTTWebSocketBridge:
     """
     WebSocket Bridge để kết nối MQTT với WebSocket clients
-    
+
     Chức năng:
     - Kết nối WebSocket clients với MQTT topics
     - Forward MQTT messages đến WebSocket clients
-    - Cho phép WebSocket clients subscribe MQTT topics
+    - Cho phép WebSocket clients subscribe MQTT topics (filter + / #, nhiều topic 1 lần)
+
+    Message MQTT đến trên thread của broker: _handle_mqtt_message chỉ append vào inbox
+    (deque giới hạn, không khóa) và đánh thức 1 task fan-out trên event loop của FastAPI
+    bằng call_soon_threadsafe. Task đó encode mỗi message 1 lần cho mỗi định dạng
+    (json / binary) rồi đẩy cùng frame đó vào ConnectionSender của mọi WebSocket đã subscribe.
+
+    Subscription nằm trong 1 TopicTree (subscriber = connection_id): 1 lần match(topic)
+    ra mọi connection khớp. Bridge đăng ký 1 handler BRIDGE_FILTER với mqtt_service từ start()
+    tới stop() - mọi message đều có seq và vào replay, fan-out chỉ tới subscription khớp.
+
+    Subscription mode latest / batch không gửi ngay: message được giữ theo topic trong
+    ConnectionSender.pending, task _flush_loop (chỉ chạy khi có topic đang chờ) mỗi FLUSH_TICK
+    gửi các topic đã đến hạn - latest chỉ giá trị cuối, batch 1 frame mqtt_batch cho cả nhịp.
+
+    Task fan-out gán cho mỗi message 1 seq tăng dần và giữ REPLAY_SIZE message gần nhất:
+    subscribe kèm snapshot nhận trạng thái hiện tại (retained + hot tier) rồi mới tới delta
+    có seq lớn hơn; kết nối lại kèm resume_from + stream nhận lại đúng phần đã lỡ.
     """
-    
-    def __init__(self):
+
+    def __init__(self, inbox_size: int = DEFAULT_INBOX_SIZE, send_queue: int = DEFAULT_SEND_QUEUE):
         self.active_connections: Dict[str, WebSocket] = {}
-        self.topic_subscriptions: Dict[str, List[str]] = {}  # {topic: [connection_ids]}
-        self.connection_topics: Dict[str, List[str]] = {}     # {connection_id: [topics]}
-        
-    async def connect(self, websocket: WebSocket, connection_id: str):
-        """Kết nối WebSocket client"""
+        self.subscriptions = TopicTree()                      # topic filter -> connection_ids
+        self.senders: Dict[str, ConnectionSender] = {}
+        self.send_queue = send_queue
+        self.loop = None
+        self._inbox = deque(maxlen=inbox_size)
+        self._wakeup = None
+        self._wakeup_pending = False
+        self._consumer = None
+        self._flusher = None
+        self._flush_wakeup = None
+        self._coalescing = set()                              # connection co topic dang cho gui
+        self._handler_registered = False
+        self.stream = uuid.uuid4().hex[:16]                   # seq chi co nghia trong 1 stream
+        self.seq = 0
+        self._replay = deque(maxlen=REPLAY_SIZE)              # (seq, topic, message, received_at)
+        # bo dem
+        self.received = 0
+        self.inbox_dropped = 0          # inbox day / chua co event loop
+        self.fanned_out = 0
+        self.encoded = 0
+        self.flushed = 0
+        self.snapshots = 0
+        self.replays = 0
+        self.resets = 0                 # resume khong duoc (khac stream / qua cu) -> snapshot
+
+    def start(self, loop=None):
+        """Gắn event loop của FastAPI và chạy task fan-out (gọi trên loop đó)"""
+        if self._consumer is not None and not self._consumer.done():
+            return
+        self.loop = loop or asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._flush_wakeup = asyncio.Event()
+        self._consumer = self.loop.create_task(self._consume())
+        self._flusher = self.loop.create_task(self._flush_loop())
+        if not self._handler_registered:
+            mqtt_service.add_message_handler(BRIDGE_FILTER, self._handle_mqtt_message)
+            self._handler_registered = True
+
+    async def stop(self):
+        if self._handler_registered:
+            mqtt_service.remove_message_handler(BRIDGE_FILTER, self._handle_mqtt_message)
+            self._handler_registered = False
+        for task in (self._consumer, self._flusher):
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self._consumer = self._flusher = None
+        self._coalescing.clear()
+        for connection_id in list(self.senders):
+            self.disconnect(connection_id)
+        self.loop = None
+
+    async def connect(self, websocket: WebSocket, connection_id: str, frame_format: str = "json"):
+        """Kết nối WebSocket client (frame_format: json | binary cho mqtt_message)"""
+        if frame_format not in FRAME_FORMATS:
+            frame_format = "json"
         await websocket.accept()
+        self.start()
         self.active_connections[connection_id] = websocket
-        self.connection_topics[connection_id] = []
+        sender = self.senders[connection_id] = ConnectionSender(websocket, connection_id, self.send_queue,
+                                                                frame_format)
+        sender.task = asyncio.get_running_loop().create_task(sender.run(self.disconnect))
         print(f"🔌 WebSocket client connected: {connection_id}")
-        
+
+    def set_format(self, connection_id: str, frame_format: str) -> bool:
+        """Đổi định dạng frame mqtt_message của connection"""
+        sender = self.senders.get(connection_id)
+        if sender is None or frame_format not in FRAME_FORMATS:
+            return False
+        sender.frame_format = frame_format
+        return True
+
     def disconnect(self, connection_id: str):
         """Ngắt kết nối WebSocket client"""
         if connection_id in self.active_connections:
             del self.active_connections[connection_id]
-            
+        sender = self.senders.pop(connection_id, None)
+        if sender is not None and sender.task is not None:
+            sender.task.cancel()
+        self._coalescing.discard(connection_id)
+
         # Xóa subscriptions
-        if connection_id in self.connection_topics:
-            topics = self.connection_topics[connection_id]
-            for topic in topics:
-                if topic in self.topic_subscriptions:
-                    if connection_id in self.topic_subscriptions[topic]:
-                        self.topic_subscriptions[topic].remove(connection_id)
-                    if not self.topic_subscriptions[topic]:
-                        del self.topic_subscriptions[topic]
-            del self.connection_topics[connection_id]
-            
+        self.subscriptions.remove_subscriber(connection_id)
+
         print(f"🔌 WebSocket client disconnected: {connection_id}")
-        
-    async def subscribe_topic(self, connection_id: str, topic: str):
-        """Subscribe WebSocket client vào MQTT topic"""
-        if connection_id not in self.active_connections:
+
+    async def subscribe_topic(self, connection_id: str, topic: str, mode: str = "all", interval_ms: int = None):
+        """
+        Subscribe WebSocket client vào MQTT topic filter (hỗ trợ + / #)
+        mode: all | latest | batch, interval_ms: nhịp gửi của latest / batch
+        Subscribe lại cùng filter chỉ đổi mode. False nếu filter / mode / interval không hợp lệ
+        """
+        sender = self.senders.get(connection_id)
+        delivery = parse_delivery(mode, interval_ms)
+        if connection_id not in self.active_connections or sender is None or delivery is None:
+            return False
+        try:
+            self.subscriptions.subscribe(connection_id, topic)
+        except ValueError:
             return False
-            
-        # Thêm vào topic subscriptions
-        if topic not in self.topic_subscriptions:
-            self.topic_subscriptions[topic] = []
-        if connection_id not in self.topic_subscriptions[topic]:
-            self.topic_subscriptions[topic].append(connection_id)
-            
-        # Thêm vào connection topics
-        if connection_id not in self.connection_topics:
-            self.connection_topics[connection_id] = []
-        if topic not in self.connection_topics[connection_id]:
-            self.connection_topics[connection_id].append(topic)
-            
-        # Đăng ký MQTT handler cho topic này
-        mqtt_service.add_message_handler(topic, self._handle_mqtt_message)
-        
-        print(f"📝 WebSocket {connection_id} subscribed to topic: {topic}")
+        sender.set_delivery(topic, *delivery)
+
+        print(f"📝 WebSocket {connection_id} subscribed to topic: {topic} ({delivery[0]})")
         return True
-        
+
+    async def subscribe_topics(self, connection_id: str, topics: List[str], mode: str = "all",
+                               interval_ms: int = None) -> Dict[str, bool]:
+        """Subscribe nhiều topic filter 1 lần (cùng mode) - {topic: success}"""
+        return {topic: await self.subscribe_topic(connection_id, topic, mode, interval_ms) for topic in topics}
+
     async def unsubscribe_topic(self, connection_id: str, topic: str):
-        """Unsubscribe WebSocket client khỏi MQTT topic"""
-        if connection_id in self.topic_subscriptions.get(topic, []):
-            self.topic_subscriptions[topic].remove(connection_id)
-            if not self.topic_subscriptions[topic]:
-                del self.topic_subscriptions[topic]
-                
-        if connection_id in self.connection_topics and topic in self.connection_topics[connection_id]:
-            self.connection_topics[connection_id].remove(topic)
-            
+        """Unsubscribe WebSocket client khỏi MQTT topic filter"""
+        self.subscriptions.unsubscribe(connection_id, topic)
+        sender = self.senders.get(connection_id)
+        if sender is not None:
+            sender.set_delivery(topic, "all", 0.0)
+
         print(f"📝 WebSocket {connection_id} unsubscribed from topic: {topic}")
         return True
-        
+
+    async def unsubscribe_topics(self, connection_id: str, topics: List[str]) -> Dict[str, bool]:
+        return {topic: await self.unsubscribe_topic(connection_id, topic) for topic in topics}
+
     def _handle_mqtt_message(self, topic: str, message: str):
-        """Handle MQTT message và forward đến WebSocket clients"""
-        if topic in self.topic_subscriptions:
-            connection_ids = self.topic_subscriptions[topic]
-            
-            # Tạo message data
-            message_data = {
-                "type": "mqtt_message",
-                "topic": topic,
-                "message": message,
-                "timestamp": str(asyncio.get_event_loop().time())
-            }
-            
-            # Forward đến tất cả subscribed connections
-            for connection_id in connection_ids:
-                if connection_id in self.active_connections:
-                    asyncio.create_task(
-                        self._send_to_websocket(connection_id, message_data)
-                    )
-                    
+        """
+        Chạy trên thread của broker: chỉ chuyển message sang event loop, không chờ
+        inbox đầy thì message cũ nhất bị bỏ (deque maxlen)
+        """
+        loop = self.loop
+        if loop is None:
+            self.inbox_dropped += 1
+            return
+        if len(self._inbox) == self._inbox.maxlen:
+            self.inbox_dropped += 1
+        self._inbox.append((topic, message, time.time()))
+        self.received += 1
+        if not self._wakeup_pending:
+            # chi 1 callback cho den khi task fan-out thuc day
+            self._wakeup_pending = True
+            try:
+                loop.call_soon_threadsafe(self._wakeup.set)
+            except RuntimeError:
+                # loop da dong (FastAPI dang tat)
+                self._wakeup_pending = False
+
+    async def _consume(self):
+        """Task duy nhất rút inbox và phân phát cho các ConnectionSender"""
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            self._wakeup_pending = False
+            handled = 0
+            while self._inbox:
+                topic, message, received_at = self._inbox.popleft()
+                self.seq += 1
+                self._replay.append((self.seq, topic, message, received_at))
+                try:
+                    self._fan_out(topic, message, received_at, self.seq)
+                except Exception as e:
+                    print(TAG + f" ❌ Lỗi fan-out {topic}: {e}")
+                handled += 1
+                if handled % FAN_OUT_BATCH == 0:
+                    await asyncio.sleep(0)
+
+    def _fan_out(self, topic: str, message: str, received_at: float, seq: int):
+        connection_ids = self.subscriptions.match(topic)
+        if not connection_ids:
+            return
+        # encode 1 lần / định dạng, mọi connection dùng chung frame
+        frames = {}
+        now = None
+        for connection_id in connection_ids:
+            sender = self.senders.get(connection_id)
+            if sender is None:
+                continue
+            if sender.delivery:
+                rule = sender.rule_for(topic, self.subscriptions.subscriptions_of(connection_id))
+                if rule is not None:
+                    if now is None:
+                        now = time.monotonic()
+                    sender.hold(topic, message, received_at, seq, rule, now)
+                    if not self._coalescing:
+                        self._flush_wakeup.set()
+                    self._coalescing.add(connection_id)
+                    continue
+            frame = frames.get(sender.frame_format)
+            if frame is None:
+                frame = frames[sender.frame_format] = encode_frame(sender.frame_format, topic, message, received_at,
+                                                                   seq)
+                self.encoded += 1
+            sender.push(frame)
+            self.fanned_out += 1
+
+    def send_initial(self, connection_id: str, topic_filters: List[str], points: int = None,
+                     resume_from: int = None, stream: str = None) -> str:
+        """
+        Trạng thái ban đầu cho các filter vừa subscribe, đẩy vào hàng đợi gửi trước mọi delta mới
+        (gọi ngay sau subscribe, không await ở giữa)
+        - resume_from cùng stream và còn trong replay -> frame "replay": mọi message seq > resume_from
+        - ngược lại -> frame "snapshot" (points None khi resume không được -> giá trị cuối, reset = true)
+        Trả về loại frame đã gửi
+        """
+        sender = self.senders.get(connection_id)
+        if sender is None:
+            return None
+        if resume_from is not None:
+            oldest = self._replay[0][0] if self._replay else self.seq + 1
+            if stream == self.stream and oldest - 1 <= resume_from <= self.seq:
+                messages = [
+                    [seq, str(received_at), topic, message]
+                    for seq, topic, message, received_at in islice(self._replay, resume_from + 1 - oldest, None)
+                    if any(topic_matches(topic_filter, topic) for topic_filter in topic_filters)
+                ]
+                sender.push(json.dumps({"type": "replay", "stream": self.stream, "seq": self.seq,
+                                        "from": resume_from, "messages": messages}))
+                self.replays += 1
+                return "replay"
+            self.resets += 1
+        sender.push(json.dumps(self._snapshot(topic_filters, points or 0, resume_from is not None)))
+        self.snapshots += 1
+        return "snapshot"
+
+    def _snapshot(self, topic_filters: List[str], points: int, reset: bool) -> dict:
+        """
+        Giá trị cuối (retained) của mọi topic khớp; points > 0: thêm tối đa points điểm
+        gần nhất của topic SS/<token_verify>/<virtual_pin> từ hot tier
+        """
+        messages, series, seen = [], {}, set()
+        for topic_filter in topic_filters:
+            for item in mqtt_service.get_retained(topic_filter):
+                topic = item["topic"]
+                if topic in seen:
+                    continue
+                seen.add(topic)
+                messages.append({"topic": topic, "message": item["message"]})
+                parts = topic.split("/")
+                if points and len(parts) == 3 and parts[0] == "SS" and parts[2].isdigit():
+                    tail = mqtt_service.hot_series.tail(parts[1], int(parts[2]), points)
+                    if tail:
+                        series[topic] = [[str(timestamp), value] for timestamp, value in tail]
+        snapshot = {"type": "snapshot", "stream": self.stream, "seq": self.seq, "reset": reset,
+                    "topics": topic_filters, "messages": messages}
+        if points:
+            snapshot["series"] = series
+        return snapshot
+
+    async def _flush_loop(self):
+        """Gửi các topic latest / batch đến hạn; ngủ khi không connection nào có topic đang chờ"""
+        while True:
+            if not self._coalescing:
+                self._flush_wakeup.clear()
+                await self._flush_wakeup.wait()
+            await asyncio.sleep(FLUSH_TICK)
+            try:
+                self._flush_due(time.monotonic())
+            except Exception as e:
+                print(TAG + f" ❌ Lỗi gửi theo nhịp: {e}")
+
+    def _flush_due(self, now: float):
+        frames = {}
+        for connection_id in list(self._coalescing):
+            sender = self.senders.get(connection_id)
+            if sender is None:
+                self._coalescing.discard(connection_id)
+                continue
+            self.flushed += sender.flush(now, frames)
+            if not sender.pending:
+                self._coalescing.discard(connection_id)
+        self.encoded += len(frames)
+
     async def _send_to_websocket(self, connection_id: str, data: dict):
-        """Gửi data đến WebSocket client"""
-        try:
-            websocket = self.active_connections[connection_id]
-            await websocket.send_text(json.dumps(data))
-        except Exception as e:
-            print(f"❌ Lỗi gửi data đến WebSocket {connection_id}: {e}")
-            # Xóa connection nếu lỗi
-            self.disconnect(connection_id)
-            
+        """Đưa data vào hàng đợi gửi của WebSocket client"""
+        sender = self.senders.get(connection_id)
+        if sender is not None:
+            sender.push(json.dumps(data))
+
     async def send_to_connection(self, connection_id: str, data: dict):
         """Gửi data đến specific WebSocket connection"""
         if connection_id in self.active_connections:
             await self._send_to_websocket(connection_id, data)
             return True
         return False
-        
+
     async def broadcast_to_topic(self, topic: str, data: dict):
-        """Broadcast data đến tất cả clients subscribed topic"""
-        if topic in self.topic_subscriptions:
-            connection_ids = self.topic_subscriptions[topic]
+        """Broadcast data đến tất cả clients có filter khớp topic"""
+        connection_ids = self.subscriptions.match(topic)
+        if connection_ids:
+            text = json.dumps(data)
             for connection_id in connection_ids:
-                await self._send_to_websocket(connection_id, data)
-                
+                sender = self.senders.get(connection_id)
+                if sender is not None:
+                    sender.push(text)
+
     def get_connection_info(self, connection_id: str) -> dict:
         """Lấy thông tin connection"""
         if connection_id in self.active_connections:
-            return {
+            info = {
                 "connection_id": connection_id,
-                "topics": self.connection_topics.get(connection_id, []),
+                "topics": list(self.subscriptions.subscriptions_of(connection_id)),
                 "connected": True
             }
+            sender = self.senders.get(connection_id)
+            if sender is not None:
+                info.update(sender.stats())
+                info["delivery"] = {
+                    topic_filter: {"mode": mode, "interval_ms": round(interval * 1000)}
+                    for topic_filter, (mode, interval) in sender.delivery.items()
+                }
+            return info
         return {"connection_id": connection_id, "connected": False}
-        
+
     def get_all_connections(self) -> List[dict]:
         """Lấy thông tin tất cả connections"""
         connections = []
         for connection_id in self.active_connections:
             connections.append(self.get_connection_info(connection_id))
         return connections
-        
+
     def get_topic_info(self, topic: str) -> dict:
-        """Lấy thông tin topic"""
+        """Lấy thông tin topic filter (connection đăng ký đúng filter này)"""
+        connection_ids = list(self.subscriptions.subscribers(topic))
         return {
             "topic": topic,
-            "subscribers": len(self.topic_subscriptions.get(topic, [])),
-            "connection_ids": self.topic_subscriptions.get(topic, [])
+            "subscribers": len(connection_ids),
+            "connection_ids": connection_ids
+        }
+
+    def get_stats(self) -> dict:
+        """Inbox (broker -> event loop) và hàng đợi gửi của từng connection"""
+        return {
+            "running": self._consumer is not None and not self._consumer.done(),
+            "inbox": len(self._inbox),
+            "inbox_size": self._inbox.maxlen,
+            "received": self.received,
+            "inbox_dropped": self.inbox_dropped,
+            "fanned_out": self.fanned_out,
+            "encoded": self.encoded,
+            "send_dropped": sum(sender.dropped for sender in self.senders.values()),
+            "coalescing_connections": len(self._coalescing),
+            "coalesced": sum(sender.coalesced for sender in self.senders.values()),
+            "flushed": self.flushed,
+            "stream": self.stream,
+            "seq": self.seq,
+            "replay": len(self._replay),
+            "snapshots": self.snapshots,
+            "replays": self.replays,
+            "resets": self.resets,
+            "connections": len(self.senders),
         }
 
 # Global WebSocket Bridge instance
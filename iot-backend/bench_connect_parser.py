@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Benchmark parse CONNECT: cắt cứng payload[12:] (cách cũ) vs parse_connect (memoryview)
+
+Chạy: cd iot-backend && python bench_connect_parser.py [số_packet]
+In ra thời gian / packet, số CONNECT xử lý được mỗi giây và % một nhân CPU
+khi broker nhận 1000 CONNECT/giây (ví dụ cả xưởng ESP32 khởi động lại cùng lúc).
+"""
+
+import struct
+import sys
+import time
+from app.mqtt_protocol import parse_connect
+
+TARGET_RATE = 1000   # CONNECT / giay
+
+
+def field(data):
+    data = data.encode('utf-8') if isinstance(data, str) else data
+    return struct.pack(">H", len(data)) + data
+
+
+def make_connect(client_id, flags=0x02, extra=b''):
+    return field("MQTT") + bytes([4, flags]) + struct.pack(">H", 60) + field(client_id) + extra
+
+
+def slicing_parser(payload):
+    """Cách cũ của MQTTService.handle_connect"""
+    return payload[12:12+len(payload)].decode('utf-8')
+
+
+def connect_parser(payload):
+    return parse_connect(payload).client_id
+
+
+def build_workload(count):
+    """Nửa giống firmware ESP32 (chỉ có client id), nửa giống paho (will + username + password)"""
+    packets = []
+    for i in range(count):
+        client_id = f"{i:08x}token"
+        if i % 2:
+            extra = field(f"SS/{client_id}/status") + field(b"offline") + field("device") + field(b"secret")
+            packets.append((client_id, make_connect(client_id, 0x02 | 0x04 | 0x08 | 0x80 | 0x40, extra)))
+        else:
+            packets.append((client_id, make_connect(client_id)))
+    return packets
+
+
+def bench(name, parser, packets, rounds=5):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _, payload in packets:
+            parser(payload)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    per_packet = best / len(packets)
+    correct = sum(1 for client_id, payload in packets if parser(payload) == client_id)
+    print(f"{name:<16} {per_packet * 1e6:8.2f} µs/packet  {1 / per_packet:12,.0f} packet/s  "
+          f"CPU @ {TARGET_RATE}/s: {per_packet * TARGET_RATE * 100:6.3f}%  "
+          f"client id đúng: {correct}/{len(packets)}")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    packets = build_workload(count)
+    print(f"📊 {count} CONNECT packet (50% kèm will + username + password)\n")
+    bench("slicing [12:]", slicing_parser, packets)
+    bench("parse_connect", connect_parser, packets)
+
+
+if __name__ == "__main__":
+    main()
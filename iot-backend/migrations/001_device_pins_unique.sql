@@ -0,0 +1,12 @@
+-- Unique index cho POST /devices/bulkConfigPin (upsert on_conflict device_token,virtual_pin)
+-- Chạy 1 lần trong Supabase SQL editor trước khi dùng bulkConfigPin
+
+-- bỏ pin trùng (giữ 1 row mỗi cặp) - index unique không tạo được nếu còn trùng
+delete from device_pins a
+using device_pins b
+where a.device_token = b.device_token
+  and a.virtual_pin = b.virtual_pin
+  and a.ctid < b.ctid;
+
+create unique index if not exists device_pins_device_token_virtual_pin_key
+    on device_pins (device_token, virtual_pin);
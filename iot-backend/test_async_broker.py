@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Test engine asyncio (AsyncMQTTBroker) qua socket loopback: CONNECT, SUBSCRIBE, PUBLISH QoS 0/1, keep alive
+Chạy: cd iot-backend && python -m pytest test_async_broker.py
+"""
+import socket
+import threading
+import time
+import pytest
+from app.async_broker_server import AsyncMQTTBroker
+from app.mqtt_client import SimpleMQTTClient
+
+
+def wait_for(condition, timeout=3.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def broker():
+    broker = AsyncMQTTBroker('127.0.0.1', free_port(), retry_interval=0.2, max_retries=2)
+    threading.Thread(target=broker.start, daemon=True).start()
+    assert broker.wait_started(3) and broker.running
+    yield broker
+    broker.stop()
+
+
+def connect_client(broker, client_id, clean_session=True, keep_alive=60):
+    client = SimpleMQTTClient('127.0.0.1', broker.port, client_id, clean_session, keep_alive)
+    client.received = []
+    client.onReciveMessage = lambda topic, message: client.received.append((topic, message))
+    threading.Thread(target=client.connect, daemon=True).start()
+    assert wait_for(lambda: client.connected)
+    return client
+
+
+def test_connect_subscribe_publish_qos0(broker):
+    sub = connect_client(broker, "sub")
+    pub = connect_client(broker, "pub")
+    assert wait_for(lambda: set(broker.clients) == {"sub", "pub"})
+    sub.subscribe("SS/+/1")
+    assert wait_for(lambda: sub.granted_qos == [0])
+
+    pub.publish("SS/abc/1", "25.5")
+    pub.publish("SS/abc/2", "khong khop")
+    assert wait_for(lambda: sub.received == [("SS/abc/1", "25.5")])
+    time.sleep(0.2)
+    assert sub.received == [("SS/abc/1", "25.5")]
+
+
+def test_qos1_delivery_and_puback(broker):
+    sub = connect_client(broker, "sub")
+    pub = connect_client(broker, "pub")
+    sub.subscribe("CT/abc/1", qos=1)
+    assert wait_for(lambda: sub.granted_qos == [1])
+
+    pub.publish("CT/abc/1", "ON", qos=1)
+    assert wait_for(lambda: sub.received == [("CT/abc/1", "ON")])
+    assert wait_for(lambda: not pub.pending_acks)                 # broker đã PUBACK cho publisher
+    session = broker.sessions["sub"]
+    assert wait_for(lambda: not session.inflight)                 # subscriber đã PUBACK cho broker
+    assert session.stats()["acked"] == 1
+
+
+def test_keep_alive_disconnects_silent_client(broker):
+    disconnected = []
+    broker.handle_disconect = lambda client_socket, client_id: disconnected.append(client_id)
+    alive = connect_client(broker, "alive", keep_alive=1)           # tự gửi PINGREQ mỗi 0.5s
+    silent = connect_client(broker, "silent", keep_alive=1)
+    silent._stop_ping.set()                                         # ESP32 mất nguồn: không gửi gì nữa
+
+    assert wait_for(lambda: disconnected == ["silent"], timeout=4)
+    assert broker.keep_alive_timeouts == 1
+    time.sleep(1.0)
+    assert list(broker.clients) == ["alive"]
+
+
+def test_only_connect_uses_thread_pool(broker):
+    offloaded = []
+    run_handler = broker._run_handler
+
+    async def counting(func, *args):
+        offloaded.append(args[3] if func == broker.process_packet else func.__name__)
+        return await run_handler(func, *args)
+    broker._run_handler = counting
+
+    sub = connect_client(broker, "sub", keep_alive=1)              # PINGREQ mỗi 0.5s
+    pub = connect_client(broker, "pub")
+    sub.subscribe("SS/+/1", qos=1)
+    assert wait_for(lambda: sub.granted_qos == [1])
+    pub.publish("SS/abc/1", "25.5")
+    pub.publish("SS/abc/1", "26", qos=1)
+    assert wait_for(lambda: len(sub.received) == 2)
+    time.sleep(0.6)
+    assert offloaded == ["CONNECT", "CONNECT"]
+
+
+def test_oversized_packet_disconnects_client(broker):
+    with socket.create_connection(('127.0.0.1', broker.port), timeout=3) as raw:
+        raw.sendall(b"\x30\x80\x80\x80\x01")                       # remaining length 2 MB > 256 KB mặc định
+        assert raw.recv(16) == b""
+    assert wait_for(lambda: broker.oversized_packets == 1)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Test hàng đợi gửi của từng kết nối broker (app/broker_connection.py)
+Chạy: cd iot-backend && python -m pytest test_broker_connection.py
+"""
+import socket
+import time
+import pytest
+from app.broker_connection import (
+    OutboundQueue, QueueOverflow, ThreadedClientConnection,
+    OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_DISCONNECT
+)
+
+
+def wait_for(condition, timeout=3.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def drain(queue):
+    items = []
+    while True:
+        item = queue.get_nowait()
+        if item is None:
+            return items
+        items.append(item)
+
+
+def test_drop_oldest_keeps_newest_packets():
+    queue = OutboundQueue(2, OVERFLOW_DROP_OLDEST)
+    assert all(queue.put(data) for data in (b"1", b"2", b"3"))
+    assert drain(queue) == [b"2", b"3"]
+    stats = queue.stats()
+    assert stats["dropped"] == 1 and stats["enqueued"] == 3 and stats["high_water"] == 2
+
+
+def test_drop_newest_rejects_incoming_packet():
+    queue = OutboundQueue(2, OVERFLOW_DROP_NEWEST)
+    assert queue.put(b"1") and queue.put(b"2")
+    assert queue.put(b"3") is False
+    assert drain(queue) == [b"1", b"2"]
+    assert queue.dropped == 1
+
+
+def test_disconnect_policy_raises_and_connection_aborts():
+    queue = OutboundQueue(1, OVERFLOW_DISCONNECT)
+    queue.put(b"1")
+    with pytest.raises(QueueOverflow):
+        queue.put(b"2")
+    assert queue.dropped == 1
+
+    # client khong doc: writer ket trong sendall() packet lon, hang doi 1 packet day -> ngat ket noi
+    server, client = socket.socketpair()
+    try:
+        connection = ThreadedClientConnection(server, "test", max_queue=1, overflow_policy=OVERFLOW_DISCONNECT)
+        connection.send(b"x" * (8 << 20))
+        assert wait_for(lambda: len(connection.queue) == 0)
+        connection.send(b"a")
+        with pytest.raises(QueueOverflow):
+            connection.send(b"b")
+        assert connection.closed and connection.queue.closed
+        with pytest.raises(ConnectionError):
+            connection.send(b"c")
+    finally:
+        client.close()
+
+
+def test_closed_queue_and_invalid_policy():
+    queue = OutboundQueue(4)
+    queue.put(b"1")
+    queue.close()
+    assert queue.get() == b"1"                               # gui not phan con lai
+    assert queue.get() is None
+    with pytest.raises(ConnectionError):
+        queue.put(b"2")
+    with pytest.raises(ValueError):
+        OutboundQueue(4, "block")
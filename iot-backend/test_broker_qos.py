@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+Test QoS 1, retained message, session bền và keep alive của SimpleMQTTBroker
+Chạy: cd iot-backend && python -m pytest test_broker_qos.py
+"""
+import socket
+import threading
+import time
+import pytest
+from app.broker_server import SimpleMQTTBroker
+from app.mqtt_client import SimpleMQTTClient
+
+
+def wait_for(condition, timeout=3.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return False
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def broker():
+    broker = SimpleMQTTBroker('127.0.0.1', free_port(), retry_interval=0.2, max_retries=2)
+    threading.Thread(target=broker.start, daemon=True).start()
+    assert wait_for(lambda: broker.running)
+    yield broker
+    broker.stop()
+
+
+def connect_client(broker, client_id, clean_session=True, keep_alive=60):
+    client = SimpleMQTTClient('127.0.0.1', broker.port, client_id, clean_session, keep_alive)
+    client.received = []
+    client.onReciveMessage = lambda topic, message: client.received.append((topic, message))
+    threading.Thread(target=client.connect, daemon=True).start()
+    assert wait_for(lambda: client.connected)
+    return client
+
+
+def session_of(broker, client):
+    return broker.sessions[client.client_id]
+
+
+def test_qos1_delivery_and_puback(broker):
+    sub = connect_client(broker, "sub")
+    pub = connect_client(broker, "pub")
+    sub.subscribe("SS/abc/3", qos=1)
+    assert wait_for(lambda: sub.granted_qos == [1])
+
+    pub.publish("SS/abc/3", "25.5", qos=1)
+    assert wait_for(lambda: sub.received == [("SS/abc/3", "25.5")])
+    assert wait_for(lambda: not pub.pending_acks)                 # broker đã PUBACK cho publisher
+    assert wait_for(lambda: not session_of(broker, sub).inflight)  # subscriber đã PUBACK cho broker
+    assert session_of(broker, sub).stats()["acked"] == 1
+
+
+def test_retransmit_with_dup_until_acked(broker):
+    sub = connect_client(broker, "sub")
+    pub = connect_client(broker, "pub")
+    sub.auto_ack = False
+    sub.subscribe("CT/abc/1", qos=1)
+    assert wait_for(lambda: sub.granted_qos == [1])
+
+    pub.publish("CT/abc/1", "ON", qos=1)
+    assert wait_for(lambda: len(sub.received) >= 2)                # bản gốc + bản gửi lại (DUP)
+    session = session_of(broker, sub)
+    assert session.retransmits >= 1
+    packet_id = next(iter(sub.unacked))
+    sub.ack(packet_id)
+    assert wait_for(lambda: not session.inflight)
+
+
+def test_downgrade_to_granted_qos(broker):
+    sub = connect_client(broker, "sub")
+    pub = connect_client(broker, "pub")
+    sub.auto_ack = False
+    sub.subscribe("SS/#", qos=0)
+    assert wait_for(lambda: sub.granted_qos == [0])
+
+    pub.publish("SS/abc/3", "1", qos=1)
+    assert wait_for(lambda: sub.received == [("SS/abc/3", "1")])
+    assert not sub.unacked                                        # nhận QoS 0 - không có packet id
+    assert not session_of(broker, sub).inflight
+
+
+def test_inflight_window_limits_unacked_messages(broker):
+    broker.max_inflight = 2
+    sub = connect_client(broker, "sub")
+    pub = connect_client(broker, "pub")
+    sub.auto_ack = False
+    sub.subscribe("SS/abc/3", qos=2)
+    assert wait_for(lambda: sub.granted_qos == [1])               # QoS 2 hạ xuống QoS 1
+
+    for i in range(4):
+        pub.publish("SS/abc/3", str(i), qos=1)
+    session = session_of(broker, sub)
+    assert wait_for(lambda: len(session.pending) == 2)
+    assert len(session.inflight) == 2
+
+    for packet_id in list(sub.unacked):
+        sub.ack(packet_id)
+    assert wait_for(lambda: not session.pending and len(session.inflight) == 2)
+
+
+def test_retained_delivered_on_wildcard_subscribe(broker):
+    pub = connect_client(broker, "pub")
+    pub.publish("CT/abc/1", "ON", retain=True)
+    pub.publish("CT/abc/2", "OFF", qos=1, retain=True)
+    assert wait_for(lambda: len(broker.retained) == 2)
+
+    sub = connect_client(broker, "sub")
+    sub.subscribe("CT/abc/+", qos=1)
+    assert wait_for(lambda: sorted(sub.received) == [("CT/abc/1", "ON"), ("CT/abc/2", "OFF")])
+
+    pub.publish("CT/abc/1", "", retain=True)                     # message rỗng = xóa retained
+    assert wait_for(lambda: len(broker.retained) == 1)
+
+
+def test_retained_snapshot_roundtrip(tmp_path):
+    from app.retained_store import RetainedStore
+    path = str(tmp_path / "retained.json")
+    store = RetainedStore(path)
+    store.set("SS/abc/3", b"25.5", qos=1)
+    store.set("SS/abc/4", "\x00\xff")
+    assert store.save()
+    assert not store.save()                                      # không đổi thì không ghi lại
+
+    restored = RetainedStore(path)
+    assert restored.load() == 2
+    assert restored.get("SS/abc/3") == (b"25.5", 1)
+    assert [t for t, _, _ in restored.match("SS/#")] == ["SS/abc/3", "SS/abc/4"]
+
+
+def test_persistent_session_replays_offline_messages(broker):
+    device = connect_client(broker, "esp32", clean_session=False)
+    device.subscribe("CT/abc/+", qos=1)
+    assert wait_for(lambda: device.granted_qos == [1])
+    device.disconnect()
+    assert wait_for(lambda: not broker.clients)
+
+    host = connect_client(broker, "host")
+    host.publish("CT/abc/1", "ON")
+    host.publish("CT/abc/2", "OFF", qos=1)
+    session = broker.sessions["esp32"]
+    assert wait_for(lambda: len(session.offline) == 2)
+
+    device = connect_client(broker, "esp32", clean_session=False)   # không subscribe lại
+    assert device.session_present
+    assert wait_for(lambda: device.received == [("CT/abc/1", "ON"), ("CT/abc/2", "OFF")])
+    assert wait_for(lambda: not session.inflight)
+
+
+def test_clean_session_and_expiry(broker):
+    broker.session_expiry = 0.2
+    clean = connect_client(broker, "clean")
+    clean.subscribe("SS/#")
+    durable = connect_client(broker, "durable", clean_session=False)
+    durable.subscribe("SS/#")
+    assert wait_for(lambda: len(broker.subscriptions.match("SS/a")) == 2)
+
+    clean.disconnect()
+    durable.disconnect()
+    assert wait_for(lambda: list(broker.sessions) == ["durable"])
+    assert wait_for(lambda: not broker.sessions)                   # hết hạn sau session_expiry
+    assert len(broker.subscriptions) == 0
+
+
+def test_session_limit_evicts_longest_offline(broker):
+    broker.max_sessions = 2
+    for client_id in ("d1", "d2", "d3"):
+        device = connect_client(broker, client_id, clean_session=False)
+        device.disconnect()
+        assert wait_for(lambda: client_id not in broker.clients)
+    assert list(broker.offline_sessions) == ["d2", "d3"]             # d1 mất kết nối lâu nhất -> bị bỏ
+    assert sorted(broker.sessions) == ["d2", "d3"]
+
+    device = connect_client(broker, "d2", clean_session=False)      # kết nối lại -> không còn offline
+    assert device.session_present
+    assert list(broker.offline_sessions) == ["d3"]
+
+
+def test_reconnect_takes_over_old_connection(broker):
+    first = connect_client(broker, "esp32", clean_session=False)
+    first.subscribe("CT/abc/1")
+    assert wait_for(lambda: first.granted_qos == [0])
+    old_socket = broker.clients["esp32"]
+
+    second = connect_client(broker, "esp32", clean_session=False)   # kết nối cũ chưa đóng
+    assert second.session_present
+    assert wait_for(lambda: broker.clients["esp32"] is not old_socket)
+    assert wait_for(lambda: not first.connected or old_socket.closed)
+
+    host = connect_client(broker, "host")
+    host.publish("CT/abc/1", "ON")
+    assert wait_for(lambda: second.received == [("CT/abc/1", "ON")])
+
+
+def test_keep_alive_disconnects_silent_client(broker):
+    disconnected = []
+    broker.handle_disconect = lambda client_socket, client_id: disconnected.append(client_id)
+    alive = connect_client(broker, "alive", keep_alive=1)           # tự gửi PINGREQ mỗi 0.5s
+    silent = connect_client(broker, "silent", keep_alive=1)
+    silent._stop_ping.set()                                         # ESP32 mất nguồn: không gửi gì nữa
+
+    assert wait_for(lambda: disconnected == ["silent"], timeout=4)
+    assert broker.keep_alive_timeouts == 1
+    time.sleep(1.0)
+    assert list(broker.clients) == ["alive"]
+
+
+def test_oversized_packet_disconnects_client():
+    broker = SimpleMQTTBroker('127.0.0.1', free_port(), max_packet_size=1024)
+    threading.Thread(target=broker.start, daemon=True).start()
+    assert wait_for(lambda: broker.running)
+    try:
+        with socket.create_connection(('127.0.0.1', broker.port), timeout=3) as raw:
+            raw.sendall(b"\x30\x80\x80\x04")                       # PUBLISH remaining length 64 KB
+            assert raw.recv(16) == b""                             # broker đóng kết nối, không chờ 64 KB
+        assert broker.oversized_packets == 1
+    finally:
+        broker.stop()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Test request PostgREST do AsyncDatabase sinh ra (httpx.MockTransport, không gọi Supabase thật)
+Chạy: cd iot-backend && python -m pytest test_database.py
+"""
+import asyncio
+import httpx
+from app.database import AsyncDatabase
+
+
+def run_query(*args, **kwargs):
+    """Chạy 1 execute_query, trả về (kết quả, [request đã gửi])"""
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(200, json=[{"id": 1}])
+
+    async def main():
+        database = AsyncDatabase(url="http://supabase.test", key="key", transport=httpx.MockTransport(handler))
+        try:
+            return await database.execute_query(*args, **kwargs)
+        finally:
+            await database.aclose()
+    return asyncio.run(main()), requests
+
+
+def params_of(request):
+    return list(request.url.params.multi_items())
+
+
+def test_delete_applies_filters_and_ranges():
+    result, requests = run_query(
+        "sensor_data", "delete",
+        filters={"token_verify": "abc"},
+        ranges={"created_at": {"lt": "2025-01-01T00:00:00+00:00"}, "id": {"lte": 42}}
+    )
+    assert result == [{"id": 1}]
+    assert requests[0].method == "DELETE" and requests[0].url.path == "/rest/v1/sensor_data"
+    assert params_of(requests[0]) == [
+        ("token_verify", "eq.abc"),
+        ("created_at", "lt.2025-01-01T00:00:00+00:00"),
+        ("id", "lte.42"),
+    ]
+
+
+def test_delete_with_ranges_only_and_guard():
+    _, requests = run_query("sensor_data", "delete", ranges={"created_at": {"lt": "2025-01-01"}})
+    assert params_of(requests[0]) == [("created_at", "lt.2025-01-01")]
+
+    result, requests = run_query("sensor_data", "delete")          # không filter / range -> chặn
+    assert result is None and requests == []
+    result, requests = run_query("sensor_data", "delete", ranges={"id": {"like": 1}})
+    assert result is None and requests == []
+
+
+def test_select_params():
+    _, requests = run_query(
+        "sensor_data", "select", filters={"virtual_pin": [1, 2]}, columns="id,created_at",
+        ranges={"created_at": {"gte": "2025-01-01"}}, order_by=["-created_at", "-id"], limit=10
+    )
+    assert requests[0].method == "GET"
+    assert params_of(requests[0]) == [
+        ("virtual_pin", 'in.("1","2")'),
+        ("select", "id,created_at"),
+        ("created_at", "gte.2025-01-01"),
+        ("order", "created_at.desc,id.desc"),
+        ("limit", "10"),
+    ]
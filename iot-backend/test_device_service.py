@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+Test cache xác thực thiết bị, PinRegistry và đăng ký / cấu hình hàng loạt (app/services/device_service.py)
+với database giả
+Chạy: cd iot-backend && python -m pytest test_device_service.py
+"""
+import time
+from types import SimpleNamespace
+import pytest
+from app.services import device_service
+from app.services.device_service import (
+    MAX_BULK_ITEMS, DeviceAuthCache, PinRegistry, bulk_config_pins, bulk_register_devices, bulk_response,
+    bulk_size_error, create_device
+)
+
+
+class FakeDb:
+    """execute_query giả: trả về rows theo (table, operation), ghi lại mọi lần gọi"""
+
+    def __init__(self, rows=None):
+        self.rows = rows or {}
+        self.calls = []
+
+    def execute_query(self, table, operation, data=None, filters=None, **kwargs):
+        self.calls.append((table, operation, filters))
+        result = self.rows.get((table, operation))
+        return result(data, filters) if callable(result) else result
+
+
+def device(token_verify, device_token=None):
+    return {"token_verify": token_verify, "device_token": device_token or "dev-" + token_verify,
+            "device_access_token": "jwt-" + token_verify}
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    fake = FakeDb()
+    monkeypatch.setattr(device_service, "db", fake)
+    # JWT hop le khi bat dau bang "jwt-"
+    monkeypatch.setattr(device_service, "verify_device_token",
+                        lambda token: {"device_id": token[4:]} if token.startswith("jwt-") else None)
+    return fake
+
+
+def devices_by_token(known):
+    return lambda data, filters: [d for d in known if d["token_verify"] == filters["token_verify"]]
+
+
+def test_auth_cache_hits_until_ttl_expires(fake_db):
+    fake_db.rows[("devices", "select")] = devices_by_token([device("a")])
+    cache = DeviceAuthCache(ttl=0.1)
+
+    found, data_device = cache.authenticate("a")
+    assert found["device_token"] == "dev-a" and data_device == {"device_id": "a"}
+    assert cache.authenticate("a")[0] is found
+    assert len(fake_db.calls) == 1 and cache.hits == 1
+
+    time.sleep(0.15)                                               # hết ttl -> hỏi lại database
+    cache.authenticate("a")
+    assert len(fake_db.calls) == 2 and cache.misses == 2
+
+
+def test_negative_cache_and_database_error(fake_db):
+    fake_db.rows[("devices", "select")] = devices_by_token([])
+    cache = DeviceAuthCache(negative_ttl=0.1)
+
+    assert cache.authenticate("missing") == (None, None)
+    assert cache.authenticate("missing") == (None, None)
+    assert len(fake_db.calls) == 1 and cache.negative_hits == 1
+    time.sleep(0.15)
+    cache.authenticate("missing")
+    assert len(fake_db.calls) == 2
+
+    fake_db.rows[("devices", "select")] = None                     # lỗi database không được cache
+    assert cache.authenticate("x") == (None, None)
+    assert cache.authenticate("x") == (None, None)
+    assert len(fake_db.calls) == 4
+
+
+def test_lru_evicts_least_recently_used(fake_db):
+    fake_db.rows[("devices", "select")] = devices_by_token([device("a"), device("b"), device("c")])
+    cache = DeviceAuthCache(max_size=2)
+    cache.authenticate("a")
+    cache.authenticate("b")
+    cache.authenticate("a")                                        # a mới dùng -> b cũ nhất
+    cache.authenticate("c")
+    assert cache.evictions == 1
+    calls = len(fake_db.calls)
+    cache.authenticate("a")
+    assert len(fake_db.calls) == calls                             # a vẫn trong cache
+    cache.authenticate("b")
+    assert len(fake_db.calls) == calls + 1                         # b đã bị bỏ
+
+
+def test_invalidate_after_update(fake_db):
+    known = [device("a", "dev-1")]
+    fake_db.rows[("devices", "select")] = devices_by_token(known)
+    cache = DeviceAuthCache()
+    assert cache.authenticate("a")[1] is not None
+
+    known[0] = dict(known[0], device_access_token="revoked")      # /devices/updateDevice đổi token
+    assert cache.authenticate("a")[1] is not None                  # còn trong cache
+    cache.invalidate(device_token="dev-1")
+    assert cache.authenticate("a")[1] is None
+
+    known[0] = device("a", "dev-1")
+    cache.invalidate(token_verify="a")                             # xóa cả entry âm
+    assert cache.authenticate("a")[1] is not None
+
+
+def test_warm_loads_all_devices_with_one_query(fake_db):
+    fake_db.rows[("devices", "select")] = [device("a"), device("b"), dict(device("c"), device_access_token="bad")]
+    cache = DeviceAuthCache()
+    assert cache.warm() == 2
+    fake_db.calls.clear()
+    assert cache.authenticate("a")[1] == {"device_id": "a"}
+    assert cache.authenticate("c") == (device("c") | {"device_access_token": "bad"}, None)   # cache âm
+    assert fake_db.calls == []
+
+
+def pins_of(table_rows):
+    """select device_pins giả: filter device_token là 1 giá trị hoặc list (in)"""
+    def select(data, filters):
+        tokens = filters["device_token"]
+        tokens = tokens if isinstance(tokens, list) else [tokens]
+        return [dict(row) for row in table_rows if row["device_token"] in tokens]
+    return select
+
+
+def pin(device_token, virtual_pin, pin_type="INPUT"):
+    return {"device_token": device_token, "virtual_pin": virtual_pin, "pin_type": pin_type,
+            "data_type": "float", "pin_label": f"pin {virtual_pin}"}
+
+
+def test_pin_registry_loads_device_once(fake_db):
+    fake_db.rows[("device_pins", "select")] = pins_of([pin("d1", 1), pin("d1", 2, "OUTPUT")])
+    registry = PinRegistry()
+    assert registry.peek("d1", 1) is None                          # peek không bao giờ hỏi database
+    assert fake_db.calls == []
+
+    assert registry.get("d1", 1)["pin_type"] == "INPUT"
+    assert registry.get("d1", "2")["pin_type"] == "OUTPUT"
+    assert registry.get("d1", 9) is None                           # thiết bị đã nạp, không có pin 9
+    assert len(fake_db.calls) == 1 and registry.hits == 2
+    assert registry.peek("d1", 1)["pin_label"] == "pin 1"
+
+
+def test_pin_registry_reload_after_config_and_delete(fake_db):
+    rows = [pin("d1", 1)]
+    fake_db.rows[("device_pins", "select")] = pins_of(rows)
+    registry = PinRegistry()
+    registry.load_device("d1")
+
+    rows[0]["pin_type"] = "OUTPUT"                                 # /devices/configPin sửa pin 1, thêm pin 3
+    rows.append(pin("d1", 3))
+    assert registry.peek("d1", 1)["pin_type"] == "INPUT"
+    assert registry.load_device("d1", force=True) == 2
+    assert registry.peek("d1", 1)["pin_type"] == "OUTPUT" and registry.peek("d1", 3) is not None
+
+    del rows[0]                                                    # /devices/deleteConfigPin pin 1
+    registry.load_device("d1", force=True)
+    assert registry.peek("d1", 1) is None and registry.peek("d1", 3) is not None
+
+    fake_db.rows[("device_pins", "select")] = None                 # nạp lại lỗi -> bỏ cấu hình cũ
+    assert registry.load_device("d1", force=True) is None
+    assert registry.peek("d1", 3) is None
+    fake_db.rows[("device_pins", "select")] = pins_of(rows)
+    calls = len(fake_db.calls)
+    assert registry.get("d1", 3) is not None                       # lần tra sau hỏi lại database
+    assert len(fake_db.calls) == calls + 1
+
+
+def test_pin_registry_load_devices_and_invalidate(fake_db):
+    fake_db.rows[("device_pins", "select")] = pins_of([pin("d1", 1), pin("d2", 1), pin("d3", 1)])
+    registry = PinRegistry()
+    assert registry.load_devices(["d1", "d2"]) == 2
+    assert fake_db.calls[-1][2] == {"device_token": ["d1", "d2"]}  # 1 query filter in
+    assert registry.stats()["devices"] == 2 and registry.stats()["pins"] == 2
+
+    registry.invalidate("d1")                                      # thiết bị bị xóa
+    assert registry.peek("d1", 1) is None and registry.peek("d2", 1) is not None
+    assert registry.stats()["devices"] == 1 and registry.stats()["pins"] == 1
+    registry.invalidate("unknown")
+
+
+def new_device(name, device_type="SLAVE"):
+    return SimpleNamespace(device_name=name, device_type=SimpleNamespace(value=device_type))
+
+
+def new_pins(device_token, *virtual_pins):
+    kind = lambda value: SimpleNamespace(value=value)
+    return SimpleNamespace(device_token=device_token, pins=[
+        SimpleNamespace(virtual_pin=v, pin_label=f"pin {v}", pin_type=kind("INPUT"), data_type=kind("float"),
+                        ai_keywords="") for v in virtual_pins
+    ])
+
+
+def test_bulk_size_limit():
+    assert bulk_size_error([]) is not None
+    assert bulk_size_error([new_device("a")] * MAX_BULK_ITEMS) is None
+    assert str(MAX_BULK_ITEMS) in bulk_size_error([new_device("a")] * (MAX_BULK_ITEMS + 1))
+
+
+def test_bulk_register_partial_failures(fake_db, monkeypatch):
+    monkeypatch.setattr(device_service, "create_device_tokens",
+                        lambda user_id, devices: ["jwt-" + token for token, _ in devices])
+    fake_db.rows[("devices", "select")] = [{"device_name": "taken"}]
+    fake_db.rows[("devices", "insert")] = lambda data, filters: [dict(row, id=i) for i, row in enumerate(data)]
+
+    results = bulk_register_devices(1, [new_device("a"), new_device("taken"), new_device(" "), new_device("a"),
+                                        new_device("b", "MASTER")])
+    assert [r["success"] for r in results] == [True, False, False, False, True]
+    assert [r.get("message") for r in results[1:4]] == [
+        "Device name already exists", "Device name is required", "Device name appears more than once in request"]
+    device = results[0]["device"]
+    assert device["device_access_token"] == "jwt-" + device["device_token"]
+    assert results[0]["device"]["device_token"] != results[4]["device"]["device_token"]
+    assert [call[1] for call in fake_db.calls] == ["select", "insert"]          # 1 select + 1 insert cả lô
+
+    response = bulk_response(results)
+    assert response["success"] is False and (response["succeeded"], response["failed"]) == (2, 3)
+    assert response["results"] is results
+
+
+def test_single_register_uses_bulk_token_generation(fake_db, monkeypatch):
+    monkeypatch.setattr(device_service, "new_device_token", lambda: "generated")
+    monkeypatch.setattr(device_service, "create_device_tokens", lambda user_id, devices: ["jwt-x"] * len(devices))
+    fake_db.rows[("devices", "select")] = []
+    fake_db.rows[("devices", "insert")] = lambda data, filters: [dict(row, id=7) for row in data]
+    result = create_device(1, new_device("a"))
+    assert result["success"] and result["device"]["device_token"] == "generated" and result["device"]["id"] == 7
+
+    fake_db.rows[("devices", "insert")] = None                     # insert lỗi -> item lỗi, không raise
+    assert create_device(1, new_device("b"))["message"] == "Failed to create device"
+
+
+def test_bulk_config_pins_partial_failures(fake_db):
+    fake_db.rows[("devices", "select")] = [{"device_token": "d1", "device_type": "SLAVE"},
+                                           {"device_token": "d2", "device_type": "SLAVE"},
+                                           {"device_token": "m", "device_type": "MASTER"}]
+    upserts = []
+    fake_db.rows[("device_pins", "upsert")] = lambda data, filters: upserts.append(data) or data
+    fake_db.rows[("device_pins", "select")] = pins_of([])
+
+    results = bulk_config_pins(1, [new_pins("d1", 1, 2), new_pins("x", 1), new_pins("m", 1), new_pins("d1", 3),
+                                   new_pins("d2", 4, 4), new_pins("d2", 5)])
+    assert [r["success"] for r in results] == [True, False, False, False, False, True]
+    assert [r["message"] for r in results[1:5]] == [
+        "Device not found", "Master device cannot be configured", "Device appears more than once in request",
+        "Duplicate virtual_pin"]
+    assert len(upserts) == 1 and [(row["device_token"], row["virtual_pin"]) for row in upserts[0]] == [
+        ("d1", 1), ("d1", 2), ("d2", 5)]
+
+    fake_db.rows[("device_pins", "upsert")] = None                 # upsert lỗi -> mọi item hợp lệ đều lỗi
+    results = bulk_config_pins(1, [new_pins("d1", 1), new_pins("x", 1)])
+    assert [r["message"] for r in results] == ["Failed to update device pins", "Device not found"]
+    assert bulk_response(results)["succeeded"] == 0
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+"""
+Test hot tier sensor (app/hot_series.py)
+Chạy: cd iot-backend && python -m pytest test_hot_series.py
+"""
+from app.hot_series import HotSeriesStore, SeriesRing
+
+
+def test_ring_overwrites_oldest_and_keeps_order():
+    ring = SeriesRing(4)
+    for t in range(6):
+        ring.append(float(t), t * 10.0)
+    assert ring.count == 4
+    assert ring.oldest() == 2.0 and ring.newest() == 5.0
+    assert ring.latest(2) == [(4.0, 40.0), (5.0, 50.0)]
+    assert ring.window(3.0, 5.0) == [(3.0, 30.0), (4.0, 40.0)]   # [since, until)
+
+    ring.append(4.5, 1.0)                                          # den tre -> khong lam hong thu tu
+    assert ring.newest() == 5.0
+
+
+def test_store_window_reports_coverage():
+    store = HotSeriesStore(capacity=3, max_series=2)
+    for t in (10.0, 20.0, 30.0, 40.0):
+        store.append("tok", 1, t, t)
+
+    assert store.latest("tok", 1, 2) == [(30.0, 30.0), (40.0, 40.0)]
+    assert store.latest("tok", 1, 5) is None                       # khong du diem -> hoi database
+    assert store.tail("tok", 1, 5) == [(20.0, 20.0), (30.0, 30.0), (40.0, 40.0)]
+    assert store.tail("tok", 2, 5) == []
+    points, covered_from = store.window("tok", 1, 25.0)
+    assert covered_from == 20.0 and points == [(30.0, 30.0), (40.0, 40.0)]
+    points, covered_from = store.window("tok", 1, 0.0, 35.0)       # phan [0, 20) nam o database
+    assert covered_from == 20.0 and points == [(20.0, 20.0), (30.0, 30.0)]
+    assert store.window("tok", 2, 0.0) == ([], None)
+
+    store.append("a", 1, 1.0, 1.0)
+    store.append("b", 1, 1.0, 1.0)                                 # vuot max_series -> bo "tok" (LRU)
+    assert store.window("tok", 1, 0.0) == ([], None)
+    assert store.stats()["evicted"] == 1
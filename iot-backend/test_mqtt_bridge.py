@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+"""
+Test WebSocket bridge (app/websockets/mqtt_bridge.py) với WebSocket và mqtt_service giả:
+inbox, encode 1 lần / định dạng, client chậm, gửi theo nhịp (latest / batch)
+Chạy: cd iot-backend && python -m pytest test_mqtt_bridge.py
+"""
+import asyncio
+import json
+import pytest
+from app.topic_tree import topic_matches
+from app.websockets import mqtt_bridge
+from app.websockets.mqtt_bridge import (
+    BINARY_BATCH_HEADER, BINARY_BATCH_ITEM, BINARY_HEADER, BINARY_MQTT_BATCH, ConnectionSender, MQTTWebSocketBridge,
+    parse_delivery
+)
+
+
+class FakeWebSocket:
+    """WebSocket giả: ghi lại frame đã gửi; blocked -> send chờ tới khi release()"""
+
+    def __init__(self, blocked=False):
+        self.frames = []
+        self.accepted = False
+        self._open = asyncio.Event()
+        if not blocked:
+            self._open.set()
+
+    def release(self):
+        self._open.set()
+
+    async def accept(self):
+        self.accepted = True
+
+    async def send_text(self, text):
+        await self._open.wait()
+        self.frames.append(text)
+
+    async def send_bytes(self, data):
+        await self._open.wait()
+        self.frames.append(data)
+
+
+class FakeHotSeries:
+    def __init__(self):
+        self.series = {}
+
+    def tail(self, token_verify, virtual_pin, points):
+        return self.series.get((token_verify, virtual_pin), [])[-points:]
+
+
+class FakeMqttService:
+    """Chỉ phần mqtt_service bridge dùng: handler đếm tham chiếu, retained, hot tier"""
+
+    def __init__(self):
+        self.handlers = {}              # filter -> so lan dang ky
+        self._callbacks = {}
+        self.retained = {}
+        self.hot_series = FakeHotSeries()
+
+    def add_message_handler(self, topic, handler):
+        self.handlers[topic] = self.handlers.get(topic, 0) + 1
+        self._callbacks[topic] = handler
+
+    def remove_message_handler(self, topic, handler):
+        self.handlers[topic] -= 1
+        if not self.handlers[topic]:
+            del self.handlers[topic], self._callbacks[topic]
+
+    def publish(self, topic, message):
+        """Như _call_message_handlers: mỗi handler có filter khớp được gọi 1 lần"""
+        for handler in {h for f, h in self._callbacks.items() if topic_matches(f, topic)}:
+            handler(topic, message)
+
+    def get_retained(self, topic_filter="#"):
+        return [{"topic": topic, "message": message, "qos": 0}
+                for topic, message in self.retained.items() if topic_matches(topic_filter, topic)]
+
+
+@pytest.fixture
+def fake_mqtt(monkeypatch):
+    fake = FakeMqttService()
+    monkeypatch.setattr(mqtt_bridge, "mqtt_service", fake)
+    return fake
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def wait_for(condition, timeout=2.0):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while loop.time() < deadline:
+        if condition():
+            return True
+        await asyncio.sleep(0.005)
+    return False
+
+
+def decode(frame):
+    """frame mqtt_message -> (seq, topic, message)"""
+    if isinstance(frame, bytes):
+        _, seq, _, topic_len = BINARY_HEADER.unpack_from(frame)
+        body = frame[BINARY_HEADER.size:]
+        return seq, body[:topic_len].decode('utf-8'), body[topic_len:].decode('utf-8')
+    data = json.loads(frame)
+    return data["seq"], data["topic"], data["message"]
+
+
+def decode_batch(frame):
+    """frame mqtt_batch -> (topic, [(seq, message)])"""
+    if isinstance(frame, bytes):
+        kind, topic_len, count = BINARY_BATCH_HEADER.unpack_from(frame)
+        assert kind == BINARY_MQTT_BATCH
+        offset = BINARY_BATCH_HEADER.size + topic_len
+        topic, items = frame[BINARY_BATCH_HEADER.size:offset].decode('utf-8'), []
+        for _ in range(count):
+            seq, _, length = BINARY_BATCH_ITEM.unpack_from(frame, offset)
+            offset += BINARY_BATCH_ITEM.size
+            items.append((seq, frame[offset:offset + length].decode('utf-8')))
+            offset += length
+        assert offset == len(frame)
+        return topic, items
+    data = json.loads(frame)
+    assert data["type"] == "mqtt_batch"
+    return data["topic"], [(seq, message) for seq, _, message in data["messages"]]
+
+
+async def open_bridge(**options):
+    bridge = MQTTWebSocketBridge(**options)
+    bridge.start()
+    return bridge
+
+
+def test_inbox_overflow_drops_oldest(fake_mqtt):
+    idle = MQTTWebSocketBridge()
+    idle._handle_mqtt_message("SS/a/1", "1")                      # chưa có event loop -> bỏ
+    assert idle.inbox_dropped == 1 and idle.received == 0
+
+    async def main():
+        bridge = await open_bridge(inbox_size=2)
+        ws = FakeWebSocket()
+        await bridge.connect(ws, "c1")
+        await bridge.subscribe_topic("c1", "SS/#")
+        for i in range(3):                                         # thread broker đẩy liền 3 message
+            bridge._handle_mqtt_message("SS/a/1", str(i))
+        assert bridge.inbox_dropped == 1 and bridge.get_stats()["inbox"] == 2
+        assert await wait_for(lambda: len(ws.frames) == 2)
+        assert [decode(frame) for frame in ws.frames] == [(1, "SS/a/1", "1"), (2, "SS/a/1", "2")]
+        await bridge.stop()
+    run(main())
+
+
+def test_encode_once_per_format(fake_mqtt):
+    async def main():
+        bridge = await open_bridge()
+        sockets = {}
+        for connection_id, frame_format in (("j1", "json"), ("j2", "json"), ("j3", "json"), ("b1", "binary")):
+            sockets[connection_id] = FakeWebSocket()
+            await bridge.connect(sockets[connection_id], connection_id, frame_format)
+            await bridge.subscribe_topic(connection_id, "SS/+/1")
+        await bridge.subscribe_topic("j1", "SS/#")                 # 2 filter khớp -> vẫn 1 frame
+        bridge._handle_mqtt_message("SS/a/1", "25.5")
+        bridge._handle_mqtt_message("CT/a/1", "ON")                # không ai subscribe
+        assert await wait_for(lambda: all(ws.frames for ws in sockets.values()))
+        await asyncio.sleep(0.02)
+
+        assert bridge.encoded == 2 and bridge.fanned_out == 4
+        assert sockets["j1"].frames[0] is sockets["j2"].frames[0] is sockets["j3"].frames[0]
+        assert [len(ws.frames) for ws in sockets.values()] == [1, 1, 1, 1]
+        assert decode(sockets["b1"].frames[0]) == decode(sockets["j1"].frames[0]) == (1, "SS/a/1", "25.5")
+        await bridge.stop()
+    run(main())
+
+
+def test_slow_client_drops_oldest_without_blocking_others(fake_mqtt):
+    async def main():
+        bridge = await open_bridge(send_queue=2)
+        slow, fast = FakeWebSocket(blocked=True), FakeWebSocket()
+        await bridge.connect(slow, "slow")
+        await bridge.connect(fast, "fast")
+        for connection_id in ("slow", "fast"):
+            await bridge.subscribe_topic(connection_id, "SS/#")
+        for i in range(1, 6):
+            bridge._handle_mqtt_message("SS/a/1", str(i))
+            assert await wait_for(lambda: len(fast.frames) == i)  # client nhanh không phải chờ client chậm
+        sender = bridge.senders["slow"]
+        # frame 1 đang gửi dở, hàng đợi 2 frame -> bỏ 2 frame cũ nhất
+        assert sender.dropped == 2 and slow.frames == [] and len(sender.queue) == 2
+
+        slow.release()
+        assert await wait_for(lambda: len(slow.frames) == 3)
+        assert [decode(frame)[2] for frame in slow.frames] == ["1", "4", "5"]
+        assert bridge.get_stats()["send_dropped"] == 2 and bridge.senders["fast"].dropped == 0
+        await bridge.stop()
+    run(main())
+
+
+def test_flush_waits_for_interval(fake_mqtt):
+    async def main():
+        bridge = await open_bridge()
+        ws = FakeWebSocket()
+        await bridge.connect(ws, "c1")
+        await bridge.subscribe_topic("c1", "SS/#", mode="latest", interval_ms=1000)
+        sender = bridge.senders["c1"]
+        bridge._fan_out("SS/a/1", "1", 1.0, 1)                     # lần đầu: đến hạn ngay ở nhịp kế tiếp
+        assert list(sender.queue) == [] and "c1" in bridge._coalescing
+        assert await wait_for(lambda: len(ws.frames) == 1)
+        assert bridge.flushed == 1 and "c1" not in bridge._coalescing
+
+        now = sender.next_due["SS/a/1"] - 1.0                      # vừa gửi xong
+        bridge._fan_out("SS/a/1", "2", 2.0, 2)
+        bridge._fan_out("SS/a/1", "3", 3.0, 3)
+        bridge._flush_due(now + 0.5)                               # chưa đến nhịp kế tiếp
+        assert list(sender.queue) == [] and sender.pending
+        bridge._flush_due(now + 1.0)
+        assert [decode(frame) for frame in sender.queue] == [(3, "SS/a/1", "3")]
+        assert sender.coalesced == 1 and not sender.pending
+        await bridge.stop()
+    run(main())
+
+
+def test_parse_delivery_bounds():
+    assert parse_delivery(None, None) == ("all", 0.0)
+    assert parse_delivery("all", 5) == ("all", 0.0)                # all bỏ qua interval
+    assert parse_delivery("latest", None) == ("latest", 1.0)
+    assert parse_delivery("batch", 50) == ("batch", 0.05)
+    assert parse_delivery("latest", 60000) == ("latest", 60.0)
+    for interval_ms in (49, 60001, 0, -1, True, 100.0, "100"):
+        assert parse_delivery("latest", interval_ms) is None
+    assert parse_delivery("fast", 100) is None
+
+
+@pytest.mark.parametrize("frame_format", ["json", "binary"])
+def test_latest_keeps_newest_and_batch_keeps_all(frame_format):
+    sender = ConnectionSender(FakeWebSocket(), "c1", frame_format=frame_format)
+    sender.set_delivery("SS/a/#", "latest", 1.0)
+    sender.set_delivery("SS/b/#", "batch", 1.0)
+    filters = ["SS/a/#", "SS/b/#"]
+    for seq, topic in enumerate(["SS/a/1", "SS/b/1", "SS/a/1", "SS/b/1", "SS/a/1"], 1):
+        sender.hold(topic, f"v{seq}", float(seq), seq, sender.rule_for(topic, filters), 0.0)
+
+    assert sender.flush(0.0, {}) == 2
+    latest, batch = sender.queue                                   # theo thứ tự topic bắt đầu chờ
+    assert decode(latest) == (5, "SS/a/1", "v5")                   # chỉ giá trị mới nhất trong nhịp
+    assert decode_batch(batch) == ("SS/b/1", [(2, "v2"), (4, "v4")])
+    assert sender.coalesced == 3                                   # 2 latest bị thay + 1 message gộp batch
+
+    sender.queue.clear()
+    sender.hold("SS/a/1", "v6", 6.0, 6, sender.rule_for("SS/a/1", filters), 0.5)
+    assert sender.flush(0.5, {}) == 0                              # nhịp kế tiếp ở 1.0
+    assert sender.flush(1.0, {}) == 1 and decode(sender.queue[0]) == (6, "SS/a/1", "v6")
+
+
+def test_rule_prefers_all_then_smallest_interval():
+    sender = ConnectionSender(FakeWebSocket(), "c1")
+    sender.set_delivery("SS/#", "latest", 2.0)
+    sender.set_delivery("SS/+/1", "batch", 0.5)
+    assert sender.rule_for("SS/a/1", ["SS/#", "SS/+/1"]) == ("batch", 0.5)
+    assert sender.rule_for("SS/a/2", ["SS/#", "SS/+/1"]) == ("latest", 2.0)
+    sender.set_delivery("SS/a/1", "all", 0.0)                      # có filter "all" khớp -> gửi ngay
+    assert sender.rule_for("SS/a/1", ["SS/#", "SS/+/1", "SS/a/1"]) is None
+
+
+def test_bridge_owns_one_handler_for_every_topic(fake_mqtt):
+    async def main():
+        bridge = await open_bridge()
+        bridge.start()
+        ws = FakeWebSocket()
+        await bridge.connect(ws, "c1")
+        await bridge.subscribe_topics("c1", ["SS/#", "CT/+/1"])
+        assert fake_mqtt.handlers == {"#": 1}                      # không đăng ký theo từng subscription
+        bridge.disconnect("c1")
+        assert fake_mqtt.handlers == {"#": 1}
+        await bridge.stop()
+        assert fake_mqtt.handlers == {}
+    run(main())
+
+
+def test_snapshot_then_deltas(fake_mqtt):
+    fake_mqtt.retained = {"SS/a/1": "25", "SS/a/2": "26", "CT/a/1": "ON"}
+    fake_mqtt.hot_series.series[("a", 1)] = [(1.0, 24.0), (2.0, 25.0)]
+
+    async def main():
+        bridge = await open_bridge()
+        ws = FakeWebSocket()
+        await bridge.connect(ws, "c1")
+        bridge._handle_mqtt_message("SS/a/1", "24")
+        assert await wait_for(lambda: bridge.seq == 1)
+        await bridge.subscribe_topic("c1", "SS/a/#")
+        assert bridge.send_initial("c1", ["SS/a/#"], points=1) == "snapshot"
+        bridge._handle_mqtt_message("SS/a/1", "27")
+        assert await wait_for(lambda: len(ws.frames) == 2)
+
+        snapshot = json.loads(ws.frames[0])
+        assert snapshot["type"] == "snapshot" and snapshot["reset"] is False
+        assert (snapshot["stream"], snapshot["seq"]) == (bridge.stream, 1)
+        assert sorted(item["topic"] for item in snapshot["messages"]) == ["SS/a/1", "SS/a/2"]
+        assert snapshot["series"] == {"SS/a/1": [["2.0", 25.0]]}
+        assert decode(ws.frames[1]) == (2, "SS/a/1", "27")         # delta sau snapshot, seq lớn hơn
+        await bridge.stop()
+    run(main())
+
+
+def test_resume_replays_messages_missed_while_no_tab_was_open(fake_mqtt):
+    async def main():
+        bridge = await open_bridge()
+        first = FakeWebSocket()
+        await bridge.connect(first, "tab1")
+        await bridge.subscribe_topic("tab1", "SS/a/#")
+        fake_mqtt.publish("SS/a/1", "1")
+        assert await wait_for(lambda: len(first.frames) == 1)
+        bridge.disconnect("tab1")                                  # tab cuối đóng
+
+        for topic, message in (("SS/a/1", "2"), ("CT/a/1", "ON"), ("SS/a/2", "3")):
+            fake_mqtt.publish(topic, message)
+        assert await wait_for(lambda: bridge.seq == 4)
+
+        second = FakeWebSocket()
+        await bridge.connect(second, "tab2")
+        await bridge.subscribe_topic("tab2", "SS/a/#")
+        assert bridge.send_initial("tab2", ["SS/a/#"], resume_from=decode(first.frames[0])[0],
+                                   stream=bridge.stream) == "replay"
+        assert await wait_for(lambda: second.frames)
+        replay = json.loads(second.frames[0])
+        assert (replay["type"], replay["from"], replay["seq"]) == ("replay", 1, 4)
+        assert [(seq, topic, message) for seq, _, topic, message in replay["messages"]] == [
+            (2, "SS/a/1", "2"), (4, "SS/a/2", "3")]
+        await bridge.stop()
+    run(main())
+
+
+def test_resume_falls_back_to_reset_snapshot(fake_mqtt, monkeypatch):
+    monkeypatch.setattr(mqtt_bridge, "REPLAY_SIZE", 3)
+    fake_mqtt.retained = {"SS/a/1": "5"}
+
+    async def main():
+        bridge = await open_bridge()
+        ws = FakeWebSocket()
+        await bridge.connect(ws, "c1")
+        await bridge.subscribe_topic("c1", "SS/a/#")
+        for i in range(1, 6):
+            bridge._handle_mqtt_message("SS/a/1", str(i))
+        assert await wait_for(lambda: len(ws.frames) == 5)
+        ws.frames.clear()
+
+        assert bridge.send_initial("c1", ["SS/a/#"], resume_from=2, stream=bridge.stream) == "replay"
+        for resume_from, stream in ((1, bridge.stream),             # seq 2 đã ra khỏi replay
+                                    (9, bridge.stream),             # seq chưa từng có
+                                    (4, "old-stream")):             # server đã khởi động lại
+            assert bridge.send_initial("c1", ["SS/a/#"], resume_from=resume_from, stream=stream) == "snapshot"
+        assert await wait_for(lambda: len(ws.frames) == 4)
+
+        replay = json.loads(ws.frames[0])
+        assert [item[0] for item in replay["messages"]] == [3, 4, 5]
+        for frame in ws.frames[1:]:
+            snapshot = json.loads(frame)
+            assert snapshot["type"] == "snapshot" and snapshot["reset"] is True
+            assert snapshot["messages"] == [{"topic": "SS/a/1", "message": "5"}] and snapshot["seq"] == 5
+        assert bridge.get_stats()["resets"] == 3 and bridge.get_stats()["replays"] == 1
+        await bridge.stop()
+    run(main())
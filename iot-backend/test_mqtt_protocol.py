@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Test bộ mã hóa / giải mã MQTT (app/mqtt_protocol.py)
+Chạy: cd iot-backend && python -m pytest test_mqtt_protocol.py
+"""
+import struct
+import pytest
+from app.mqtt_protocol import (
+    CONNACK_BAD_PROTOCOL, ConnectRefused, MQTTFrameDecoder, MQTTProtocolError, PacketTooLarge, build_packet,
+    decode_remaining_length, encode_remaining_length, parse_connect
+)
+
+
+def make_publish(topic, message):
+    topic_bytes = topic.encode('utf-8')
+    return build_packet(0x30, struct.pack(">H", len(topic_bytes)) + topic_bytes + message)
+
+
+def field(data):
+    data = data.encode('utf-8') if isinstance(data, str) else data
+    return struct.pack(">H", len(data)) + data
+
+
+def make_connect(client_id, flags=0x02, keep_alive=60, extra=b'', name="MQTT", level=4):
+    return field(name) + bytes([level, flags]) + struct.pack(">H", keep_alive) + field(client_id) + extra
+
+
+def test_remaining_length_roundtrip():
+    for length, size in [(0, 1), (127, 1), (128, 2), (16383, 2), (16384, 3), (2097152, 4), (268435455, 4)]:
+        encoded = encode_remaining_length(length)
+        assert len(encoded) == size
+        assert decode_remaining_length(b'\x30' + encoded, 1) == (length, size)
+
+
+def test_remaining_length_incomplete_and_invalid():
+    assert decode_remaining_length(b'\x30\x80', 1) == (None, 0)
+    with pytest.raises(MQTTProtocolError):
+        decode_remaining_length(b'\x30\xff\xff\xff\xff\x01', 1)
+
+
+def test_decoder_large_payload_split_across_reads():
+    packet = make_publish("SS/token/1", b"x" * 300)
+    decoder = MQTTFrameDecoder()
+    assert decoder.feed(packet[:1]) == []
+    assert decoder.feed(packet[1:2]) == []
+    assert decoder.feed(packet[2:100]) == []
+    frames = decoder.feed(packet[100:])
+    assert len(frames) == 1
+    first_byte, body = frames[0]
+    assert first_byte == 0x30
+    assert body.endswith(b"x" * 300)
+    assert decoder.pending() == 0
+
+
+def test_decoder_coalesced_packets():
+    stream = make_publish("a/b", b"1") + bytes([0xC0, 0x00]) + make_publish("a/c", b"2" * 200)
+    decoder = MQTTFrameDecoder()
+    frames = decoder.feed(stream + stream[:5])
+    assert [first_byte for first_byte, _ in frames] == [0x30, 0xC0, 0x30]
+    assert decoder.pending() == 5
+    frames = decoder.feed(stream[5:])
+    assert len(frames) == 3
+
+
+def test_decoder_rejects_oversized_packet():
+    decoder = MQTTFrameDecoder(max_packet_size=64)
+    with pytest.raises(PacketTooLarge):
+        decoder.feed(make_publish("a", b"y" * 100))
+    decoder = MQTTFrameDecoder(max_packet_size=64)
+    with pytest.raises(PacketTooLarge):                           # chỉ cần header, không chờ cả packet
+        decoder.feed(b"\x30" + encode_remaining_length(1 << 20))
+    assert issubclass(PacketTooLarge, MQTTProtocolError)
+
+
+def test_parse_connect_with_will_and_credentials():
+    # bố cục giống paho: clean session + will QoS 1 retain + username + password
+    extra = field("SS/abc/status") + field(b"offline") + field("user") + field(b"\x00secret")
+    connect = parse_connect(make_connect("abc123", 0x02 | 0x04 | 0x08 | 0x20 | 0x80 | 0x40, 15, extra))
+    assert connect.client_id == "abc123"
+    assert connect.keep_alive == 15
+    assert connect.clean_session
+    assert (connect.will_topic, bytes(connect.will_message), connect.will_qos, connect.will_retain) == \
+        ("SS/abc/status", b"offline", 1, True)
+    assert connect.username == "user"
+    assert bytes(connect.password) == b"\x00secret"
+
+    simple = parse_connect(make_connect("esp32", flags=0x00))
+    assert simple.client_id == "esp32" and not simple.clean_session and simple.will_topic is None
+
+
+def test_parse_connect_rejects_bad_packets():
+    with pytest.raises(ConnectRefused) as refused:
+        parse_connect(make_connect("abc", level=5))
+    assert refused.value.return_code == CONNACK_BAD_PROTOCOL
+    with pytest.raises(ConnectRefused):
+        parse_connect(make_connect("", flags=0x00))          # client id rỗng cần clean session
+    with pytest.raises(MQTTProtocolError):
+        parse_connect(make_connect("abc", flags=0x80))       # cờ username nhưng thiếu trường
+    with pytest.raises(MQTTProtocolError):
+        parse_connect(make_connect("abc", flags=0x03))       # bit reserved
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""
+Test luồng PUBLISH của MQTTService (app/services/mqtt_service.py) với broker giả
+Chạy: cd iot-backend && python -m pytest test_mqtt_service.py
+"""
+from app.mqtt_protocol import build_publish, decode_remaining_length
+from app.services.mqtt_service import MQTTService
+
+
+class FakeBroker:
+    def __init__(self):
+        self.retained = {}
+        self.routed = []
+
+    def retain_message(self, topic, message, qos=0):
+        self.retained[topic] = message
+
+    def route_message(self, topic, message, qos=0):
+        self.routed.append((topic, message))
+
+    def acknowledge_publish(self, client_socket, qos, packet_id):
+        pass
+
+
+def publish(service, topic, message, retain=False):
+    packet = build_publish(topic, message, retain=retain)
+    _, used = decode_remaining_length(packet)
+    service._enhanced_handle_publish(None, packet[1 + used:], packet[0] & 0x0F)
+
+
+def test_retain_only_when_flag_set():
+    service = MQTTService()
+    service.broker = FakeBroker()
+    publish(service, "CT/abc/1", "ON")
+    publish(service, "SS/abc/1", "25")
+    assert service.broker.retained == {}                           # cờ RETAIN = 0 -> không giữ
+    publish(service, "CT/abc/1", "OFF", retain=True)
+    assert service.broker.retained == {"CT/abc/1": "OFF"}
+    assert [topic for topic, _ in service.broker.routed] == ["CT/abc/1", "SS/abc/1", "CT/abc/1"]
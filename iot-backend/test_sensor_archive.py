@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Test file segment lưu trữ sensor_data (app/sensor_archive.py)
+Chạy: cd iot-backend && python -m pytest test_sensor_archive.py
+"""
+import math
+from datetime import datetime, timedelta, timezone
+import pytest
+from app.sensor_archive import SegmentArchive, iso_to_ms, ms_to_iso
+from app.services import sensor_service
+
+DAY = iso_to_ms("2025-03-01T23:59:00+00:00")
+
+
+def _fill(archive):
+    # 4 row qua 2 ngay UTC, 2 pin, 1 value None
+    archive.append("tok", [1, 2, 1, 1], [DAY, DAY + 1000, DAY + 120000, DAY + 120000],
+                   [10, 11, 13, 12], [25.5, 1.0, None, 26.25])
+
+
+def test_roundtrip_across_days(tmp_path):
+    archive = SegmentArchive(str(tmp_path))
+    _fill(archive)
+    assert sorted(p.name for p in (tmp_path / "tok").iterdir()) == ["2025-03-01.seg", "2025-03-02.seg"]
+
+    ts, ids, values = archive.read("tok", 1, DAY, DAY + 86400000)
+    assert ts.tolist() == [DAY, DAY + 120000, DAY + 120000]
+    assert ids.tolist() == [10, 12, 13]                         # cung timestamp -> theo id
+    assert values[:2].tolist() == [25.5, 26.25] and math.isnan(values[2])
+
+    blocks_read = archive.blocks_read
+    ts, ids, _ = archive.read("tok", 1, DAY, DAY + 86400000, cursor=(DAY + 120000, 12), limit=5)
+    assert ids.tolist() == [13]
+    assert archive.blocks_read == blocks_read + 1                 # file ngay truoc cursor khong doc lai
+    ts, ids, _ = archive.read("tok", 1, DAY, DAY + 86400000, cursor=(DAY + 120000, 12), descending=True)
+    assert ids.tolist() == [10]
+    assert archive.read("other", 1, DAY, DAY + 1)[0].size == 0
+
+
+def test_duplicate_export_and_torn_tail(tmp_path):
+    archive = SegmentArchive(str(tmp_path))
+    _fill(archive)
+    _fill(archive)                                              # xuat lai sau khi dung giua chung
+    assert archive.read("tok", 1, DAY, DAY + 86400000)[1].tolist() == [10, 12, 13]
+
+    with open(tmp_path / "tok" / "2025-03-02.seg", "ab") as f:
+        f.write(b"SSG2\x05")                                    # block ghi do
+    assert archive.read("tok", 1, DAY, DAY + 86400000)[1].tolist() == [10, 12, 13]
+    assert archive.corrupt_blocks == 1
+
+
+def test_value_string_roundtrip(tmp_path):
+    archive = SegmentArchive(str(tmp_path))
+    archive.append("tok", [1, 1, 1], [DAY, DAY + 1, DAY + 2], [1, 2, 3], [None, 1.5, None], ["ON", None, "nhiệt độ"])
+    ts, ids, values, strings = archive.read("tok", 1, DAY, DAY + 10, with_strings=True)
+    assert strings.tolist() == ["ON", None, "nhiệt độ"]
+    assert len(archive.read("tok", 1, DAY, DAY + 10)) == 3
+
+
+
+class ArchiveDb:
+    """sensor_data giả cho archive_sensor_data: select theo created_at < lt, delete theo id"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.deletes = []
+
+    def execute_query(self, table, operation, filters=None, ranges=None, limit=None, cursor=None, **kwargs):
+        if operation == "select":
+            rows = sorted((r for r in self.rows if r["created_at"] < ranges["created_at"]["lt"]),
+                          key=lambda r: (r["created_at"], r["id"]))
+            if cursor:
+                rows = [r for r in rows if (r["created_at"], r["id"]) > (cursor["created_at"], cursor["id"])]
+            return [dict(r) for r in rows[:limit]]
+        self.deletes.append((filters, ranges))
+        if ranges:
+            keep = lambda r: not ranges["id"]["gte"] <= r["id"] <= ranges["id"]["lte"]
+        else:
+            keep = lambda r: r["id"] not in filters["id"]
+        self.rows = [r for r in self.rows if keep(r)]
+        return []
+
+
+def _row(row_id, created_at, value=None, text=None):
+    return {"id": row_id, "token_verify": "tok", "virtual_pin": 1, "value_numeric": value,
+            "value_string": text, "created_at": ms_to_iso(created_at)}
+
+
+def test_archive_deletes_only_archived_ids(tmp_path, monkeypatch):
+    monkeypatch.setattr(sensor_service.settings, "SENSOR_RETENTION_DAYS", 30, raising=False)
+    monkeypatch.setattr(sensor_service, "MAX_PAGE_SIZE", 2)
+    monkeypatch.setattr(sensor_service, "ARCHIVE_DELETE_CHUNK", 3)
+    fake = ArchiveDb([_row(i, DAY + i, float(i)) for i in range(1, 5)] + [_row(9, DAY + 9, text="ON"),
+                                                                      _row(20, DAY + 86400000 * 2)])
+    monkeypatch.setattr(sensor_service, "db", fake)
+    archive = SegmentArchive(str(tmp_path))
+
+    result = sensor_service.archive_sensor_data(ms_to_iso(DAY + 1000), archive)
+    assert result["rows"] == 5 and result["deleted"] is True
+    assert fake.deletes == [(None, {"id": {"gte": 1, "lte": 4}}), ({"id": [9]}, None)]
+    assert [r["id"] for r in fake.rows] == [20]
+    _, ids, _, strings = archive.read("tok", 1, DAY, DAY + 1000, with_strings=True)
+    assert ids.tolist() == [1, 2, 3, 4, 9] and strings.tolist()[-1] == "ON"
+
+    # row den tre truoc watermark cu: khong bi xoa mu, lan chay sau luu tru
+    fake.rows.append(_row(21, DAY + 500, text="late"))
+    sensor_service.archive_sensor_data(ms_to_iso(DAY + 2000), archive)
+    assert [r["id"] for r in fake.rows] == [20]
+    _, ids, _, strings = archive.read("tok", 1, DAY, DAY + 1000, with_strings=True)
+    assert ids.tolist() == [1, 2, 3, 4, 9, 21] and "late" in strings.tolist()
+
+
+def test_archive_flushes_on_total_pending_rows(tmp_path, monkeypatch):
+    monkeypatch.setattr(sensor_service.settings, "SENSOR_RETENTION_DAYS", 30, raising=False)
+    monkeypatch.setattr(sensor_service, "MAX_PAGE_SIZE", 2)
+    monkeypatch.setattr(sensor_service, "ARCHIVE_FLUSH_ROWS", 2)
+    rows = [dict(_row(i, DAY + i, float(i)), token_verify=f"dev{i % 3}") for i in range(1, 6)]
+    monkeypatch.setattr(sensor_service, "db", ArchiveDb(rows))
+    archive = SegmentArchive(str(tmp_path))
+    appended = []
+    append = archive.append
+    monkeypatch.setattr(archive, "append", lambda token, *columns: appended.append(len(columns[0])) or
+                        append(token, *columns))
+
+    result = sensor_service.archive_sensor_data(ms_to_iso(DAY + 1000), archive)
+    assert result["rows"] == 5 and sum(appended) == 5
+    assert max(appended) <= 2                                   # moi trang ghi ngay, nhieu thiet bi khong don RAM
+    assert archive.read("dev1", 1, DAY, DAY + 1000)[1].tolist() == [1, 4]
+
+
+def test_watermark_persists(tmp_path):
+    archive = SegmentArchive(str(tmp_path))
+    assert archive.watermark is None
+    archive.set_watermark(iso_to_ms("2025-03-01T00:00:00.250+00:00"))
+    assert ms_to_iso(SegmentArchive(str(tmp_path)).watermark) == "2025-03-01T00:00:00.250000+00:00"
+
+
+def test_archive_rejects_cutoff_inside_retention(tmp_path, monkeypatch):
+    monkeypatch.setattr(sensor_service.settings, "SENSOR_RETENTION_DAYS", 30, raising=False)
+    archive = SegmentArchive(str(tmp_path))
+    for days in (0, 29):
+        before = (datetime.now(timezone.utc) - timedelta(days=days)).isoformat()
+        with pytest.raises(ValueError):
+            sensor_service.archive_sensor_data(before, archive)
+    assert archive.watermark is None
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+Test đọc lịch sử sensor (app/services/sensor_service.py) với database giả:
+phân trang keyset qua watermark của segment lưu trữ, hot tier + database (query_sensor_data),
+rollup 1m / 1h so với gom trực tiếp từ row thô
+Chạy: cd iot-backend && python -m pytest test_sensor_history.py
+"""
+import asyncio
+import pytest
+from app.hot_series import HotSeriesStore
+from app.sensor_archive import SegmentArchive, iso_to_ms, ms_to_iso
+from app.services import sensor_service
+from app.services.sensor_service import (
+    SensorRollups, aggregate_history, decode_cursor, encode_cursor, fetch_history_page, iter_history, load_rollups,
+    query_sensor_data
+)
+from app.timeseries import bucket_aggregate
+
+BASE = iso_to_ms("2025-03-01T23:59:55+00:00")
+TIME_COLUMNS = ("created_at", "bucket_start")
+
+
+def _key(column, value):
+    return iso_to_ms(value) if column in TIME_COLUMNS else value
+
+
+class HistoryDb:
+    """Bảng giả: lọc filters / ranges (gte, lt), sắp xếp order_by, keyset cursor, limit, chọn columns"""
+
+    def __init__(self, tables):
+        self.tables = tables
+        self.queries = 0
+
+    def select(self, table, operation, filters=None, columns="*", order_by=None, ranges=None, limit=None,
+               cursor=None, **kwargs):
+        self.queries += 1
+        rows = [r for r in self.tables.get(table, []) if all(r[k] == v for k, v in (filters or {}).items())]
+        for column, bound in (ranges or {}).items():
+            if "gte" in bound:
+                rows = [r for r in rows if _key(column, r[column]) >= _key(column, bound["gte"])]
+            if "lt" in bound:
+                rows = [r for r in rows if _key(column, r[column]) < _key(column, bound["lt"])]
+        order = [order_by] if isinstance(order_by, str) else list(order_by or [])
+        descending = bool(order) and order[0].startswith("-")
+        order = [col.lstrip("-") for col in order]
+        sort_key = lambda r: tuple(_key(col, r[col]) for col in order)
+        rows.sort(key=sort_key, reverse=descending)
+        if cursor:
+            after = sort_key(cursor)
+            rows = [r for r in rows if (sort_key(r) < after if descending else sort_key(r) > after)]
+        if limit:
+            rows = rows[:limit]
+        if columns != "*":
+            wanted = [col.strip() for col in columns.split(",")]
+            rows = [{col: r[col] for col in wanted} for r in rows]
+        return [dict(r) for r in rows]
+
+
+class SyncHistoryDb(HistoryDb):
+    def execute_query(self, *args, **kwargs):
+        return self.select(*args, **kwargs)
+
+
+class AsyncHistoryDb(HistoryDb):
+    async def execute_query(self, *args, **kwargs):
+        return self.select(*args, **kwargs)
+
+
+def _row(row_id, ms, pin=1):
+    return {"id": row_id, "token_verify": "tok", "virtual_pin": pin, "value_numeric": float(row_id),
+            "value_string": str(row_id), "created_at": ms_to_iso(ms)}
+
+
+@pytest.fixture
+def archived(tmp_path, monkeypatch):
+    """12 row pin 1 (cách nhau 1s, qua 2 ngày UTC): 6 row đầu trong segment, còn lại trong database"""
+    rows = [_row(i + 1, BASE + i * 1000) for i in range(12)] + [_row(100, BASE + 500, pin=2)]
+    watermark = BASE + 5500
+    archive = SegmentArchive(str(tmp_path))
+    old = [r for r in rows if iso_to_ms(r["created_at"]) < watermark]
+    archive.append("tok", [r["virtual_pin"] for r in old], [iso_to_ms(r["created_at"]) for r in old],
+                   [r["id"] for r in old], [r["value_numeric"] for r in old], [r["value_string"] for r in old])
+    archive.set_watermark(watermark)
+    fake = AsyncHistoryDb({"sensor_data": [r for r in rows if iso_to_ms(r["created_at"]) >= watermark]})
+    monkeypatch.setattr(sensor_service, "sensor_archive", archive)
+    monkeypatch.setattr(sensor_service, "async_db", fake)
+    return fake
+
+
+WINDOW = {"gte": ms_to_iso(BASE), "lt": ms_to_iso(BASE + 60000)}
+
+
+def test_cursor_roundtrip_and_invalid():
+    row = {"id": 7, "created_at": "2025-03-01T00:00:00.250000+00:00", "value_numeric": 1.5}
+    cursor = encode_cursor(row)
+    assert "=" not in cursor
+    assert decode_cursor(cursor) == {"created_at": row["created_at"], "id": 7}
+    for broken in ("khong-phai-cursor", encode_cursor({"created_at": "x", "id": 1})[:-3]):
+        with pytest.raises(ValueError):
+            decode_cursor(broken)
+
+
+@pytest.mark.parametrize("page_size", [3, 4, 5])
+@pytest.mark.parametrize("descending", [False, True])
+def test_iter_history_spans_watermark(archived, page_size, descending):
+    async def collect():
+        return [row async for row in iter_history("tok", 1, WINDOW, descending, page_size=page_size)]
+    rows = asyncio.run(collect())
+    expected = list(range(1, 13))
+    assert [r["id"] for r in rows] == (expected[::-1] if descending else expected)    # không thiếu, không trùng
+    assert rows[0].keys() == {"id", "virtual_pin", "value_numeric", "value_string", "created_at"}
+    assert all(r["value_string"] == str(r["id"]) for r in rows)
+
+
+@pytest.mark.parametrize("descending", [False, True])
+def test_fetch_history_page_with_encoded_cursor(archived, descending):
+    async def pages():
+        result, cursor = [], None
+        while True:
+            rows = await fetch_history_page("tok", 1, WINDOW, descending, cursor, page_size=4)
+            result.append([r["id"] for r in rows])
+            if len(rows) < 4:
+                return result
+            cursor = decode_cursor(encode_cursor(rows[-1]))        # như client gửi lại cursor của trang trước
+    result = asyncio.run(pages())
+    if descending:
+        assert result == [[12, 11, 10, 9], [8, 7, 6, 5], [4, 3, 2, 1], []]
+    else:
+        assert result == [[1, 2, 3, 4], [5, 6, 7, 8], [9, 10, 11, 12], []]
+
+
+def test_window_inside_archive_skips_database(archived):
+    bounds = {"gte": ms_to_iso(BASE + 1000), "lt": ms_to_iso(BASE + 4000)}
+    rows = asyncio.run(fetch_history_page("tok", 1, bounds, page_size=10))
+    assert [r["id"] for r in rows] == [2, 3, 4]
+    assert archived.queries == 0
+
+
+@pytest.fixture
+def hot_and_db(monkeypatch):
+    """10 reading (cách nhau 10s) trong database, ring 4 điểm giữ 4 reading mới nhất"""
+    start = 1740873600.0
+    fake = SyncHistoryDb({"sensor_data": [
+        {"id": i, "token_verify": "tok", "virtual_pin": 1, "value_numeric": float(i),
+         "created_at": sensor_service._iso(start + i * 10)} for i in range(10)
+    ]})
+    monkeypatch.setattr(sensor_service, "db", fake)
+    hot = HotSeriesStore(capacity=4)
+    for i in range(10):
+        hot.append("tok", 1, start + i * 10, float(i))
+    return hot, fake, lambda i: sensor_service._iso(start + i * 10)
+
+
+def _values(rows):
+    return [row["value_numeric"] for row in rows]
+
+
+@pytest.mark.parametrize("descending", [False, True])
+@pytest.mark.parametrize("limit", [0, 3, 5, 20])
+def test_query_since_older_than_ring_matches_database(hot_and_db, descending, limit):
+    hot, fake, at = hot_and_db
+    rows, source = query_sensor_data(hot, "tok", 1, limit, since=at(2), descending=descending)
+    expected, _ = query_sensor_data(None, "tok", 1, limit, since=at(2), descending=descending)
+    assert _values(rows) == _values(expected)                      # nối ở covered_from: không thiếu, không trùng
+    assert [iso_to_ms(r["created_at"]) for r in rows] == [iso_to_ms(r["created_at"]) for r in expected]
+    # desc: ring (6..9) đủ limit thì không hỏi database
+    assert source == ("hot" if descending and 0 < limit <= 4 else "hot+database")
+
+
+def test_query_since_inside_ring_and_until(hot_and_db):
+    hot, fake, at = hot_and_db
+    rows, source = query_sensor_data(hot, "tok", 1, 0, since=at(7))
+    assert (_values(rows), source) == ([7.0, 8.0, 9.0], "hot")
+    rows, source = query_sensor_data(hot, "tok", 1, 0, since=at(3), until=at(8), descending=True)
+    assert (_values(rows), source) == ([7.0, 6.0, 5.0, 4.0, 3.0], "hot+database")
+    rows, source = query_sensor_data(hot, "tok", 1, 0, since=at(1), until=at(5))     # until trước ring
+    assert (_values(rows), source) == ([1.0, 2.0, 3.0, 4.0], "hot+database")
+
+
+@pytest.mark.parametrize("limit", [3, 4, 5, 20])
+def test_query_latest_without_since(hot_and_db, limit):
+    hot, fake, at = hot_and_db
+    queries = fake.queries
+    rows, source = query_sensor_data(hot, "tok", 1, limit, descending=True)
+    assert _values(rows) == [float(i) for i in range(9, -1, -1)][:limit]
+    if limit <= 4:
+        assert source == "hot" and fake.queries == queries
+    else:
+        assert source == "database"                                # limit lớn hơn ring -> database
+
+
+@pytest.fixture
+def rollup_db(tmp_path, monkeypatch):
+    """~3 giờ reading thô không đều (sensor_data) + rollup của đúng các reading đó"""
+    start = 1740873600.0 + 17
+    raw = []
+    for i in range(400):
+        t = start + i * 27 + (i % 7) * 3
+        raw.append({"id": i + 1, "token_verify": "tok", "virtual_pin": 1, "value_numeric": float((i * 37) % 101) / 4,
+                    "created_at": sensor_service._iso(t)})
+    rollups = SensorRollups()
+    rollups.add_rows(raw[:300])
+    closed = [row for _, rows in rollups.collect(now=start + 300 * 27) for row in rows]
+    rollups.add_rows(raw[300:])                                    # bucket cuối còn mở trong bộ nhớ
+    closed += [row for _, rows in rollups.collect(now=start + 300 * 27) for row in rows]
+    fake = AsyncHistoryDb({"sensor_data": raw,
+                           "sensor_rollups": [dict(row, id=n + 1) for n, row in enumerate(closed)]})
+    monkeypatch.setattr(sensor_service, "async_db", fake)
+    monkeypatch.setattr(sensor_service, "sensor_archive", SegmentArchive(str(tmp_path)))
+    bounds = {"gte": sensor_service._iso(1740873600.0), "lt": sensor_service._iso(1740873600.0 + 4 * 3600)}
+    return raw, rollups, bounds
+
+
+def test_rollup_buckets_match_raw_aggregate(rollup_db):
+    raw, rollups, bounds = rollup_db
+    assert rollups.stats()["open"] == 2                            # 1m + 1h chưa ghi database
+    rows = asyncio.run(load_rollups("tok", 1, bounds, "1m", rollups))
+    assert sum(row["count"] for row in rows) == len(raw)
+    direct = bucket_aggregate([sensor_service.to_epoch(r["created_at"]) for r in raw],
+                              [r["value_numeric"] for r in raw], 60, origin=0.0)
+    assert len(rows) == len(direct["bucket"])
+
+    for resolution in (60, 300, 3600, 7200):
+        from_rollup = asyncio.run(aggregate_history("tok", 1, bounds, resolution, source="rollup", rollups=rollups))
+        from_raw = asyncio.run(aggregate_history("tok", 1, bounds, resolution, source="raw"))
+        assert [b["t"] for b in from_rollup] == [b["t"] for b in from_raw]
+        for got, want in zip(from_rollup, from_raw):
+            assert (got["count"], got["min"], got["max"], got["last"]) == \
+                   (want["count"], want["min"], want["max"], want["last"])
+            assert got["avg"] == pytest.approx(want["avg"])
+
+
+def test_rollup_rejects_resolution_not_multiple(rollup_db):
+    raw, rollups, bounds = rollup_db
+    with pytest.raises(ValueError):
+        asyncio.run(aggregate_history("tok", 1, bounds, 90, source="rollup", rollups=rollups))
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Test pipeline ghi sensor data theo lô (SensorIngestPipeline) với database giả
+Chạy: cd iot-backend && python -m pytest test_sensor_ingest.py
+"""
+import threading
+import time
+import pytest
+from app.services import sensor_service
+from app.services.sensor_service import SensorIngestPipeline
+
+
+def wait_for(condition, timeout=3.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class FakeDb:
+    """insert giả: fail_next lần đầu trả None (lỗi database), sau đó ghi nhận từng lô"""
+
+    def __init__(self, fail_next=0):
+        self.fail_next = fail_next
+        self.batches = []
+        self.attempts = 0
+        self._lock = threading.Lock()
+
+    def execute_query(self, table, operation, data=None, **kwargs):
+        with self._lock:
+            self.attempts += 1
+            if self.fail_next:
+                self.fail_next -= 1
+                return None
+            self.batches.append((table, list(data)))
+            return data
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    fake = FakeDb()
+    monkeypatch.setattr(sensor_service, "db", fake)
+    return fake
+
+
+@pytest.fixture
+def make_pipeline():
+    pipelines = []
+
+    def make(**options):
+        pipeline = SensorIngestPipeline(**options)
+        pipeline.start()
+        pipelines.append(pipeline)
+        return pipeline
+    yield make
+    for pipeline in pipelines:
+        pipeline.stop()
+
+
+def test_batches_on_size_then_flush(fake_db, make_pipeline):
+    pipeline = make_pipeline(batch_size=3, flush_interval=10)
+    for i in range(7):
+        assert pipeline.submit({"value": i})
+    assert wait_for(lambda: pipeline.inserted == 6)
+    assert [len(rows) for _, rows in fake_db.batches] == [3, 3]
+    time.sleep(0.1)
+    assert len(pipeline) == 1                                      # chưa đủ lô, chưa tới flush_interval
+
+    pipeline.flush()
+    assert wait_for(lambda: pipeline.inserted == 7)
+    assert fake_db.batches[-1] == ("sensor_data", [{"value": 6}])
+
+
+def test_flushes_partial_batch_after_interval(fake_db, make_pipeline):
+    pipeline = make_pipeline(batch_size=100, flush_interval=0.1)
+    started = time.monotonic()
+    pipeline.submit({"value": 1})
+    pipeline.submit({"value": 2})
+    assert wait_for(lambda: pipeline.inserted == 2)
+    assert time.monotonic() - started >= 0.09
+    assert len(fake_db.batches) == 1
+
+
+def test_retries_then_gives_up_on_database_failure(fake_db, make_pipeline):
+    fake_db.fail_next = 2
+    pipeline = make_pipeline(batch_size=2, flush_interval=10, retry_backoff=0.01)
+    pipeline.submit({"value": 1})
+    pipeline.submit({"value": 2})
+    assert wait_for(lambda: pipeline.inserted == 2)
+    assert pipeline.retries == 2 and pipeline.failed == 0
+
+    fake_db.fail_next = 10
+    failing = make_pipeline(batch_size=1, flush_interval=10, retry_backoff=0.01, max_retries=1)
+    failing.submit({"value": 3})
+    assert wait_for(lambda: failing.failed == 1)                   # bỏ lô sau max_retries lần thử lại
+    assert failing.inserted == 0 and fake_db.attempts == 5
+
+
+def test_prepare_rejects_and_stop_drains_queue(fake_db, make_pipeline):
+    prepare = lambda readings: [{"value": r} for r in readings if r >= 0]
+    pipeline = make_pipeline(prepare=prepare, batch_size=100, flush_interval=10, max_queue=3)
+    for reading in (-1, 1, 2, 3):                                  # hàng đợi đầy -> bỏ reading cũ nhất (-1)
+        pipeline.submit(reading)
+    assert pipeline.dropped == 1
+
+    pipeline.stop()                                                # ghi nốt phần còn lại
+    assert fake_db.batches == [("sensor_data", [{"value": 1}, {"value": 2}, {"value": 3}])]
+    assert pipeline.submit(4) is False
+
+    rejecting = make_pipeline(prepare=prepare, batch_size=2, flush_interval=10)
+    rejecting.submit(-5)
+    rejecting.submit(7)
+    assert wait_for(lambda: rejecting.inserted == 1)
+    assert rejecting.rejected == 1
+
+
+def test_rollups_only_count_inserted_rows(fake_db, make_pipeline):
+    rollups = sensor_service.SensorRollups(resolutions={"1m": 60})
+    row = lambda value: {"token_verify": "tv", "virtual_pin": 1, "value_numeric": value,
+                         "created_at": "2024-01-01T00:00:05+00:00"}
+    fake_db.fail_next = 2
+    failing = make_pipeline(batch_size=1, flush_interval=10, retry_backoff=0.01, max_retries=1,
+                            on_inserted=rollups.add_rows)
+    failing.submit(row(100.0))
+    assert wait_for(lambda: failing.failed == 1)
+    assert rollups.added == 0                                      # lô bị bỏ -> không vào rollup
+
+    pipeline = make_pipeline(batch_size=2, flush_interval=10, on_inserted=rollups.add_rows)
+    pipeline.submit(row(1.0))
+    pipeline.submit(row(3.0))
+    assert wait_for(lambda: rollups.added == 2)
+    [bucket] = rollups.open_buckets("tv", 1, "1m")
+    assert (bucket["count"], bucket["sum"], bucket["min"], bucket["max"]) == (2, 4.0, 1.0, 3.0)
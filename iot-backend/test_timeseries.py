@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Test gom bucket và LTTB (app/timeseries.py)
+Chạy: cd iot-backend && python -m pytest test_timeseries.py
+"""
+import math
+import pytest
+from app.timeseries import bucket_aggregate, lttb, merge_buckets, to_epoch
+
+
+def test_bucket_aggregate():
+    timestamps = [0, 10, 59, 60, 130, 125]                    # chưa sắp xếp
+    values = [1.0, 3.0, None, 5.0, 7.0, 2.0]                  # None bị bỏ
+    result = bucket_aggregate(timestamps, values, 60, origin=0.0)
+
+    assert result["bucket"].tolist() == [0.0, 60.0, 120.0]   # bucket rỗng không xuất hiện
+    assert result["count"].tolist() == [2, 1, 2]
+    assert result["min"].tolist() == [1.0, 5.0, 2.0]
+    assert result["max"].tolist() == [3.0, 5.0, 7.0]
+    assert result["avg"].tolist() == [2.0, 5.0, 4.5]
+    assert result["last"].tolist() == [3.0, 5.0, 7.0]        # theo thời gian, không theo thứ tự đưa vào
+
+    assert bucket_aggregate([], [], 60)["count"].size == 0
+    with pytest.raises(ValueError):
+        bucket_aggregate([0], [1.0], 0)
+
+
+def test_lttb_keeps_endpoints_and_peaks():
+    timestamps = list(range(1000))
+    values = [math.sin(t / 50) for t in timestamps]
+    values[500] = 10.0                                        # gai nhon phai duoc giu lai
+
+    ts, vs = lttb(timestamps, values, 50)
+    assert ts.size == 50
+    assert ts[0] == 0 and ts[-1] == 999
+    assert all(ts[1:] > ts[:-1])
+    assert 10.0 in vs.tolist()
+
+    ts, vs = lttb(timestamps[:10], values[:10], 50)           # ít điểm hơn points -> giữ nguyên
+    assert ts.size == 10
+
+
+def test_to_epoch():
+    assert to_epoch("1970-01-01T00:01:00+00:00") == 60.0
+    assert to_epoch("2025-01-01T00:00:00.500000+00:00") % 1 == 0.5
+
+
+def test_merge_buckets_matches_raw_aggregate():
+    timestamps = [0, 30, 61, 95, 3599, 3600, 3700]
+    values = [1.0, 4.0, 2.0, 8.0, 3.0, 6.0, 5.0]
+    minutes = bucket_aggregate(timestamps, values, 60, origin=0.0)
+    starts = minutes["bucket"].tolist()
+    counts = minutes["count"].tolist()
+    sums = (minutes["avg"] * minutes["count"]).tolist()
+    lasts = minutes["last"].tolist()
+    # bucket phut dau bi ghi 2 lan (dung broker giua chung): 2 row cung bucket_start
+    starts.append(0.0)
+    counts.append(1)
+    sums.append(10.0)
+    lasts.append(10.0)
+    mins = minutes["min"].tolist() + [10.0]
+    maxs = minutes["max"].tolist() + [10.0]
+    last_ats = [s + 59 for s in starts[:-1]] + [45.0]
+
+    hours = merge_buckets(starts, counts, sums, mins, maxs, lasts, last_ats, 3600)
+    assert hours["bucket"].tolist() == [0.0, 3600.0]
+    assert hours["count"].tolist() == [6, 2]
+    assert hours["min"].tolist() == [1.0, 5.0]
+    assert hours["max"].tolist() == [10.0, 6.0]
+    assert hours["avg"].tolist() == [28.0 / 6, 5.5]
+    assert hours["last"].tolist() == [3.0, 5.0]
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Test trie subscription (app/topic_tree.py)
+Chạy: cd iot-backend && python -m pytest test_topic_tree.py
+"""
+import pytest
+from app.topic_tree import TopicTree, is_valid_topic_filter, topic_matches
+
+
+def test_wildcard_matching():
+    tree = TopicTree()
+    tree.subscribe("dashboard", "SS/+/3")
+    tree.subscribe("logger", "SS/#")
+    tree.subscribe("esp32", "CT/abc/3", qos=1)
+    tree.subscribe("all", "#")
+
+    assert set(tree.match("SS/abc/3")) == {"dashboard", "logger", "all"}
+    assert set(tree.match("SS/abc/4")) == {"logger", "all"}
+    assert set(tree.match("SS")) == {"logger", "all"}          # '#' khớp cả 0 level
+    assert tree.match("CT/abc/3") == {"esp32": 1, "all": 0}
+    assert set(tree.match("$SYS/info")) == set()               # '$' không khớp wildcard level đầu
+
+
+def test_max_qos_when_overlapping():
+    tree = TopicTree()
+    tree.subscribe("c1", "a/+", qos=0)
+    tree.subscribe("c1", "a/b", qos=1)
+    assert tree.match("a/b") == {"c1": 1}
+
+
+def test_remove_subscriber_prunes_and_reverse_index():
+    tree = TopicTree()
+    tree.subscribe("c1", "a/b/c")
+    tree.subscribe("c1", "x/#")
+    tree.subscribe("c2", "a/b/c")
+    assert tree.remove_subscriber("c1") == {"a/b/c": 0, "x/#": 0}
+    assert tree.match("x/y") == {}
+    assert tree.filters() == ["a/b/c"]
+    assert len(tree) == 1
+    tree.unsubscribe("c2", "a/b/c")
+    assert tree.filters() == [] and len(tree) == 0
+
+
+def test_filter_validation():
+    assert is_valid_topic_filter("SS/+/1")
+    assert is_valid_topic_filter("#")
+    assert not is_valid_topic_filter("SS/#/1")
+    assert not is_valid_topic_filter("SS/a+")
+    with pytest.raises(ValueError):
+        TopicTree().subscribe("c1", "a/b#")
+
+
+def test_topic_matches_agrees_with_tree():
+    filters = ["a/+/c", "a/#", "+/b/+", "a/b/c", "#", "+"]
+    topics = ["a/b/c", "a", "a/b", "x/b/z", "a/b/c/d"]
+    tree = TopicTree()
+    for f in filters:
+        tree.subscribe(f, f)
+    for topic in topics:
+        assert set(tree.match(topic)) == {f for f in filters if topic_matches(f, topic)}